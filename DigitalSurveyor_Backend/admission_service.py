@@ -0,0 +1,266 @@
+# admission_service.py
+"""
+Admission control for the inference endpoints.
+
+Every analyze/refine request asks for a slot before it starts work:
+
+- Each endpoint has its own concurrency and a bounded wait queue
+  (ADMISSION_LIMITS, e.g. "analyze=2/8,walkaround=1/4"). A request that
+  finds the queue full is turned away immediately (503 + Retry-After)
+  instead of making every request in the worker slow.
+- The worker runs at most ADMISSION_CONCURRENCY requests at once. The
+  priority lane (/analyze/refine) is served before queued scans and has
+  ADMISSION_PRIORITY_SLOTS extra slots of its own, so a quick refine never
+  waits behind full scans.
+- Each caller has a token bucket (USER_RATE_PER_MINUTE, USER_RATE_BURST),
+  keyed by the verified session user or else the client address (never the
+  form user_id, which is free to rotate); a request costs one token per
+  image it analyzes. An empty bucket is a 429 + Retry-After.
+- Within a lane, a freed slot goes to the waiting user with the fewest
+  running requests (FIFO among equals), so one heavy user can't starve
+  the rest.
+
+All bookkeeping runs on the event loop; the work itself runs in the
+threadpool while the slot is held.
+"""
+
+import asyncio
+import itertools
+import math
+import os
+import time
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+
+from utils import metrics
+
+# Requests running at once in this worker (bulk lane)
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", "2"))
+# Extra slots only the priority lane may use
+ADMISSION_PRIORITY_SLOTS = int(os.getenv("ADMISSION_PRIORITY_SLOTS", "1"))
+# Longest a request waits in the queue before giving up with a 503
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+# Per-user token buckets (tokens = images analyzed)
+USER_RATE_PER_MINUTE = float(os.getenv("USER_RATE_PER_MINUTE", "30"))
+USER_RATE_BURST = float(os.getenv("USER_RATE_BURST", "12"))
+MAX_TRACKED_USERS = 10000
+
+PRIORITY, BULK = 0, 1
+
+# endpoint -> concurrency / queue length / lane
+DEFAULT_LIMITS = {
+    "analyze": {"concurrency": 2, "queue": 8, "lane": BULK},
+    "walkaround": {"concurrency": 1, "queue": 4, "lane": BULK},
+    "video": {"concurrency": 1, "queue": 2, "lane": BULK},
+    "refine": {"concurrency": 2, "queue": 16, "lane": PRIORITY},
+}
+
+
+def parse_limits(spec: str) -> dict:
+    """'analyze=2/8,video=1/2' -> DEFAULT_LIMITS with those concurrency/queue overrides."""
+    limits = {name: dict(limit) for name, limit in DEFAULT_LIMITS.items()}
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        name, _, value = item.partition("=")
+        concurrency, _, queue = value.partition("/")
+        if name.strip() not in limits or not concurrency.strip().isdigit():
+            print(f"⚠️ Ignoring admission limit '{item}'")
+            continue
+        limits[name.strip()]["concurrency"] = max(int(concurrency), 1)
+        if queue.strip().isdigit():
+            limits[name.strip()]["queue"] = int(queue)
+    return limits
+
+
+class AdmissionRejected(Exception):
+    """Request turned away; surfaced as `status_code` with a Retry-After header."""
+
+    def __init__(self, status_code: int, error: str, details: str, retry_after: int):
+        super().__init__(details)
+        self.status_code = status_code
+        self.error = error
+        self.details = details
+        self.retry_after = max(int(retry_after), 1)
+
+
+class TokenBuckets:
+    """Per-key token buckets, LRU-bounded so one-off keys don't pile up."""
+
+    def __init__(self, rate_per_minute: float, burst: float, max_keys: int = MAX_TRACKED_USERS):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()   # key -> (tokens, updated_at)
+
+    def take(self, key: str, cost: float = 1) -> float:
+        """Spend `cost` tokens. Returns 0 on success, else seconds until they are available."""
+        if self.rate <= 0:
+            return 0.0
+        cost = min(cost, self.burst)  # A request bigger than the burst still gets through eventually
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class _Waiter:
+    __slots__ = ("endpoint", "lane", "user", "seq", "future")
+
+    def __init__(self, endpoint, lane, user, seq, future):
+        self.endpoint = endpoint
+        self.lane = lane
+        self.user = user
+        self.seq = seq
+        self.future = future
+
+
+class AdmissionController:
+    """
+    Usage:
+        try:
+            async with get_admission().admit("analyze", user_id, cost=1):
+                return await run_in_threadpool(...)
+        except AdmissionRejected as e:
+            ...  # 429/503 with Retry-After
+    """
+
+    def __init__(self, limits: dict = None, concurrency: int = ADMISSION_CONCURRENCY,
+                 priority_slots: int = ADMISSION_PRIORITY_SLOTS,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT, buckets: TokenBuckets = None):
+        self.limits = limits or parse_limits(os.getenv("ADMISSION_LIMITS", ""))
+        self.concurrency = concurrency
+        self.priority_slots = priority_slots
+        self.queue_timeout = queue_timeout
+        self.buckets = buckets or TokenBuckets(USER_RATE_PER_MINUTE, USER_RATE_BURST)
+        self._active_total = 0
+        self._active = Counter()
+        self._active_by_user = Counter()
+        self._queued = Counter()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._service_s = {}   # endpoint -> moving average of slot hold time (Retry-After hint)
+
+    @asynccontextmanager
+    async def admit(self, endpoint: str, user: str, cost: float = 1):
+        """Hold a slot of `endpoint` for the body of the `async with`."""
+        limit = self.limits[endpoint]
+
+        if self._queued[endpoint] >= limit["queue"] and not self._can_start(endpoint, limit["lane"]):
+            metrics.increment("admission", endpoint=endpoint, result="queue_full")
+            raise AdmissionRejected(503, "Server Busy",
+                                    f"Too many {endpoint} requests in progress, please retry shortly",
+                                    self._retry_after(endpoint))
+
+        wait = self.buckets.take(user, cost)
+        if wait > 0:
+            metrics.increment("admission", endpoint=endpoint, result="rate_limited")
+            raise AdmissionRejected(429, "Rate Limit Exceeded",
+                                    f"Request limit reached for this account, retry in {math.ceil(wait)}s",
+                                    math.ceil(wait))
+
+        wait_start = time.perf_counter()
+        await self._acquire(endpoint, limit["lane"], user)
+        metrics.observe("admission_wait_ms", (time.perf_counter() - wait_start) * 1000, endpoint=endpoint)
+        metrics.increment("admission", endpoint=endpoint, result="admitted")
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            held = time.monotonic() - start
+            previous = self._service_s.get(endpoint)
+            self._service_s[endpoint] = held if previous is None else 0.8 * previous + 0.2 * held
+            self._release(endpoint, user)
+
+    async def _acquire(self, endpoint, lane, user):
+        waiter = _Waiter(endpoint, lane, user, next(self._seq), asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self._queued[endpoint] += 1
+        self._dispatch()
+        if waiter.future.done():
+            return
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done():
+                self._release(endpoint, user)  # Granted just as we gave up
+            else:
+                waiter.future.cancel()
+                self._waiters.remove(waiter)
+                self._queued[endpoint] -= 1
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            metrics.increment("admission", endpoint=endpoint, result="timeout")
+            raise AdmissionRejected(503, "Server Busy",
+                                    f"Waited {self.queue_timeout:.0f}s for a free {endpoint} slot",
+                                    self._retry_after(endpoint))
+
+    def _can_start(self, endpoint, lane):
+        capacity = self.concurrency + (self.priority_slots if lane == PRIORITY else 0)
+        return self._active[endpoint] < self.limits[endpoint]["concurrency"] and self._active_total < capacity
+
+    def _dispatch(self):
+        """Hand free slots to waiters: priority lane first, then least-busy user, then FIFO."""
+        while True:
+            ready = [w for w in self._waiters if self._can_start(w.endpoint, w.lane)]
+            if not ready:
+                return
+            waiter = min(ready, key=lambda w: (w.lane, self._active_by_user[w.user], w.seq))
+            self._waiters.remove(waiter)
+            self._queued[waiter.endpoint] -= 1
+            self._active_total += 1
+            self._active[waiter.endpoint] += 1
+            self._active_by_user[waiter.user] += 1
+            waiter.future.set_result(True)
+
+    def _release(self, endpoint, user):
+        self._active_total -= 1
+        self._active[endpoint] -= 1
+        self._active_by_user[user] -= 1
+        if self._active_by_user[user] <= 0:
+            del self._active_by_user[user]
+        self._dispatch()
+
+    def _retry_after(self, endpoint):
+        """Seconds until the queue ahead of a new request has likely drained."""
+        limit = self.limits[endpoint]
+        service_s = self._service_s.get(endpoint, 5.0)
+        return math.ceil(service_s * (self._queued[endpoint] + 1) / limit["concurrency"])
+
+    def stats(self) -> dict:
+        return {
+            "active": self._active_total,
+            "concurrency": self.concurrency,
+            "priority_slots": self.priority_slots,
+            "endpoints": {
+                name: {
+                    "active": self._active[name],
+                    "queued": self._queued[name],
+                    "concurrency": limit["concurrency"],
+                    "queue": limit["queue"],
+                    "lane": "priority" if limit["lane"] == PRIORITY else "bulk",
+                    "avg_service_s": round(self._service_s[name], 3) if name in self._service_s else None,
+                }
+                for name, limit in self.limits.items()
+            },
+            "rate_limit": {"per_minute": USER_RATE_PER_MINUTE, "burst": USER_RATE_BURST,
+                           "tracked_users": len(self.buckets._buckets)},
+        }
+
+
+_admission = None
+
+
+def get_admission() -> AdmissionController:
+    global _admission
+    if _admission is None:
+        _admission = AdmissionController()
+    return _admission
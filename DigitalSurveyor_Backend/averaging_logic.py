@@ -7,13 +7,16 @@ Analyzes 3 close-up photos from different angles to calculate average severity.
 import cv2
 import numpy as np
 from depth_service import analyze_dent_depth
+from pricing_service import get_engine
+from utils import calculate_severity
+from utils.core import SCRATCH_SEVERITY_MODE
 
 
 def calculate_average_verdict(
     images: list,
     damage_type: str,
     part_name: str,
-    base_cost: int = 10000
+    base_cost: int = None
 ) -> dict:
     """
     Analyze 3 close-up photos and return averaged verdict.
@@ -22,7 +25,7 @@ def calculate_average_verdict(
         images: List of 3 cv2 images [left, center, right]
         damage_type: e.g., "Dent", "Scratch"
         part_name: e.g., "Door", "Fender"
-        base_cost: Base repair cost for this part
+        base_cost: Base repair cost for this part (None = pricing config value)
     
     Returns:
         {
@@ -43,12 +46,14 @@ def calculate_average_verdict(
             h, w = img.shape[:2]
             full_box = [0, 0, w, h]
             
-            # Use depth analysis for dents, fixed severity for scratches
+            # Use depth analysis for dents, texture severity for scratches
             if damage_type.lower() in ['dent', 'crash']:
                 depth_result = analyze_dent_depth(img)
                 severity = int(depth_result['score'] * 100)
+            elif SCRATCH_SEVERITY_MODE == "texture":
+                severity = calculate_severity(img, full_box)
             else:
-                severity = 50  # Fixed moderate severity (contrast detection removed)
+                severity = 50  # Fixed moderate severity
             
             severity_scores.append(severity)
             print(f"📸 Photo {idx+1} severity: {severity}")
@@ -73,26 +78,19 @@ def calculate_average_verdict(
     else:
         confidence = "low"  # High disagreement
     
-    # Determine action based on average severity
-    if avg_severity > 75:
-        action = "Part Replacement"
-        cost_multiplier = 2.0
-    elif avg_severity > 50:
-        action = "Sheet Metal Repair"
-        cost_multiplier = 1.0
-    else:
-        action = "Polish/Paint"
-        cost_multiplier = 0.5
-    
-    final_cost = int(base_cost * cost_multiplier)
+    # Determine action based on average severity (same pricing tables as scans)
+    pricing = get_engine()
+    verdict = pricing.refine_verdict(avg_severity, part_name, base_cost)
+    action = verdict["action"]
     
     result = {
         "severity_scores": severity_scores,
         "final_severity": avg_severity,
         "action": action,
-        "cost": final_cost,
+        "cost": verdict["cost"],
         "confidence": confidence,
-        "std_deviation": std_dev
+        "std_deviation": std_dev,
+        "pricing_version": pricing.version
     }
     
     print(f"📊 Average Verdict: {avg_severity}/100 | Action: {action} | Confidence: {confidence}")
@@ -102,24 +100,4 @@ def calculate_average_verdict(
 
 def get_part_base_cost(part_name: str) -> int:
     """Get base repair cost for a car part."""
-    cost_map = {
-        "door": 12000,
-        "fender": 10000,
-        "bumper": 8000,
-        "hood": 15000,
-        "trunk": 12000,
-        "quarter panel": 18000,
-        "roof": 20000,
-        "windshield": 10000,
-        "headlight": 5000,
-        "taillight": 4000,
-        "mirror": 3000,
-        "wheel": 6000
-    }
-    
-    part_lower = part_name.lower()
-    for key in cost_map:
-        if key in part_lower:
-            return cost_map[key]
-    
-    return 10000  # Default
+    return get_engine().refine_base_cost(part_name)
@@ -0,0 +1,279 @@
+# batch_process.py
+"""
+Offline batch analysis of claim-photo archives (audits, model rollouts).
+
+Runs the /analyze pipeline (quality gate -> vehicle gate -> parts ->
+smart_detect -> depth -> process_damage) over a directory or manifest
+without the web app: nothing is uploaded and no database rows are written.
+Work is spread over a process pool; each worker loads the models once
+and gets an equal share of the CPU threads.
+
+    python batch_process.py photos/ --output results.jsonl --workers 4
+    python batch_process.py manifest.jsonl --output results.parquet
+
+A manifest is a text file with one image path per line, or JSONL with a
+"path" and optional "car_name" / "region" per line. Results are appended
+to a JSONL checkpoint as they finish (for Parquet output, <output>.partial.jsonl,
+converted when the run completes), so an interrupted run picks up where
+it stopped: finished images are skipped and failed ones are retried.
+
+Only the standard library is imported at module level: spawned workers
+re-import this file, and the thread budget must be applied before
+numpy/torch load (resource_manager.configure_process).
+"""
+
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+
+import resource_manager
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+# Report images have no place in an audit table (nor do "_" internals like _heatmap_image)
+STRIPPED_KEYS = ("heatmap", "overlay")
+
+
+# --- INPUT / RESUME ---
+
+def list_jobs(source: str, car_name: str = None, region: str = None) -> list:
+    """Jobs ({key, path, car_name, region}) from an image directory or a manifest."""
+    jobs = []
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for name in files:
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    path = os.path.join(root, name)
+                    jobs.append({"key": os.path.relpath(path, source), "path": path})
+        jobs.sort(key=lambda job: job["key"])
+    else:
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, encoding="utf-8") as f:
+            for line in filter(None, (line.strip() for line in f)):
+                entry = json.loads(line) if line.startswith("{") else {"path": line}
+                path = entry["path"] if os.path.isabs(entry["path"]) else os.path.join(base, entry["path"])
+                jobs.append({"key": entry["path"], "path": path,
+                             "car_name": entry.get("car_name"), "region": entry.get("region")})
+
+    for job in jobs:
+        job["car_name"] = job.get("car_name") or car_name
+        job["region"] = job.get("region") or region
+    return jobs
+
+
+def read_records(path: str) -> list:
+    """Records of a JSONL checkpoint, skipping a line cut off by an interruption."""
+    records = []
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue  # Partial last line
+    return records
+
+
+def load_checkpoint(path: str) -> dict:
+    """
+    Finished records of an earlier run ({key: record}). Failed records and a
+    cut-off line are dropped, and the file is rewritten without them so the
+    failed images are retried.
+    """
+    if not os.path.exists(path):
+        return {}
+    done = {record["key"]: record for record in read_records(path) if record.get("status") != "failed"}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for record in done.values():
+            f.write(json.dumps(record) + "\n")
+    os.replace(tmp_path, path)
+    return done
+
+
+def write_parquet(records: list, path: str):
+    """Parquet table of the records; nested fields (damages, detections) as JSON strings."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("❌ Parquet output needs pyarrow (pip install pyarrow); "
+                         "the JSONL checkpoint is complete")
+    rows = [{key: json.dumps(value) if isinstance(value, (dict, list)) else value
+             for key, value in record.items()} for record in records]
+    columns = list(dict.fromkeys(key for row in rows for key in row))
+    table = pa.Table.from_pydict({column: [row.get(column) for row in rows] for column in columns})
+    pq.write_table(table, path)
+
+
+# --- WORKER ---
+
+def _init_worker(parts_path, damage_path):
+    """Pool initializer: thread budget first, then load the models once per process."""
+    resource_manager.configure_process()
+    import detection_service
+    detection_service.load_models(parts_path, damage_path)
+    if not detection_service.models_loaded():
+        raise RuntimeError("AI models not loaded")
+    import logic  # noqa: F401  (loads the depth model now, not on the first image)
+
+
+def _strip(value):
+    if isinstance(value, dict):
+        return {k: _strip(v) for k, v in value.items() if k not in STRIPPED_KEYS and not k.startswith("_")}
+    if isinstance(value, list):
+        return [_strip(v) for v in value]
+    return value
+
+
+def analyze_image(job: dict, depth_mode: str = None, gates: bool = True) -> dict:
+    """Run the /analyze pipeline on one file. Returns its result record (never raises)."""
+    import cv2
+    import numpy as np
+    from detection_service import check_vehicle_presence, run_parts_model, smart_detect
+    from logic import compute_dent_depth, process_damage
+    from pricing_service import get_engine as get_pricing_engine
+    from quality_service import validate_image_quality
+    from utils.image_context import ImageContext
+
+    start = time.perf_counter()
+    record = {"key": job["key"], "path": job["path"], "car_name": job.get("car_name"),
+              "region": job.get("region"), "status": "ok", "error": None, "details": None}
+    try:
+        img = cv2.imdecode(np.fromfile(job["path"], np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            record.update(status="rejected", error="Invalid Image", details="Could not decode image")
+            return record
+        record["image_shape"] = [int(img.shape[0]), int(img.shape[1])]
+
+        ctx = ImageContext(img)
+        if gates:
+            quality = ctx.quality = validate_image_quality(img)
+            if not quality.passed:
+                record.update(status="rejected", error="Image Quality Issue", details=quality.reason,
+                              quality=quality.to_dict())
+                return record
+            vehicle = check_vehicle_presence([ctx])[0]
+            if not vehicle.passed:
+                record.update(status="rejected", error=vehicle.reason, details=vehicle.details,
+                              vehicle=vehicle.to_dict())
+                return record
+
+        parts_results = run_parts_model([ctx])[0]
+        damage_results, detections = smart_detect(ctx)
+        depth_results = compute_dent_depth([damage_results], [ctx], depth_mode)[0]
+        price_multiplier = get_pricing_engine().price_multiplier(job.get("car_name"), job.get("region"))
+        report = process_damage(parts_results, damage_results, ctx, price_multiplier,
+                                depth_results=depth_results)
+        record.update(_strip(report))
+        record["detections"] = detections
+    except Exception as e:
+        record.update(status="failed", error="Analysis Failed", details=str(e))
+    finally:
+        record["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        record["worker"] = os.getpid()
+    return record
+
+
+# --- DRIVER ---
+
+def run_batch(source: str, output: str, workers: int = 2, threads: int = None, depth_mode: str = None,
+              detect_mode: str = None, gates: bool = True, car_name: str = None, region: str = None,
+              parts_path: str = "parts.pt", damage_path: str = "damage.pt", progress_every: int = 25) -> dict:
+    """
+    Analyze every image of `source` into `output` (.jsonl or .parquet).
+
+    Returns:
+        Run summary (counts, elapsed seconds, images/sec)
+    """
+    fmt = "parquet" if output.endswith(".parquet") else "jsonl"
+    checkpoint = output if fmt == "jsonl" else f"{output}.partial.jsonl"
+
+    jobs = list_jobs(source, car_name, region)
+    done = load_checkpoint(checkpoint)
+    pending = [job for job in jobs if job["key"] not in done]
+    print(f"📦 {len(jobs)} image(s): {len(done)} already done, {len(pending)} to process")
+
+    # Workers read their budget and detection mode from the environment at import
+    threads = threads or max(resource_manager.available_cpus() // workers, 1)
+    os.environ["CPU_THREADS_PER_WORKER"] = str(threads)
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    if detect_mode:
+        os.environ["DAMAGE_DETECT_MODE"] = detect_mode
+
+    counts = {"ok": 0, "rejected": 0, "failed": 0}
+    start = time.perf_counter()
+
+    def report_progress(final=False):
+        processed = sum(counts.values())
+        elapsed = time.perf_counter() - start
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        label = "🏁 Done" if final else "⏱️"
+        print(f"{label} {processed}/{len(pending)} | {rate:.2f} img/s | ok={counts['ok']} "
+              f"rejected={counts['rejected']} failed={counts['failed']} | {elapsed:.1f}s")
+        return elapsed, rate
+
+    if pending:
+        # spawn: forking after torch/OpenMP initialized is unsafe
+        with open(checkpoint, "a", encoding="utf-8") as out, \
+                ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"),
+                                    initializer=_init_worker, initargs=(parts_path, damage_path)) as pool:
+            queue = iter(pending)
+            in_flight = set()
+            while True:
+                # Keep a few jobs per worker queued; results stream to disk as they finish
+                for job in queue:
+                    in_flight.add(pool.submit(analyze_image, job, depth_mode, gates))
+                    if len(in_flight) >= workers * 2:
+                        break
+                if not in_flight:
+                    break
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record = future.result()
+                    out.write(json.dumps(record) + "\n")
+                    out.flush()
+                    counts[record["status"]] += 1
+                    if record["status"] == "failed":
+                        print(f"❌ {record['key']}: {record['details']}")
+                    if sum(counts.values()) % progress_every == 0:
+                        report_progress()
+
+    elapsed, rate = report_progress(final=True)
+
+    if fmt == "parquet":
+        write_parquet(read_records(checkpoint), output)
+        if counts["failed"] == 0:
+            os.remove(checkpoint)
+        print(f"🗂️ Wrote {output}")
+
+    return {"images": len(jobs), "skipped": len(done), **counts,
+            "elapsed_s": round(elapsed, 2), "images_per_sec": round(rate, 3)}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Analyze a directory or manifest of car photos offline")
+    parser.add_argument("source", help="Image directory, or manifest (.txt paths / .jsonl with path, car_name, region)")
+    parser.add_argument("--output", required=True, help="Result file: .jsonl or .parquet")
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes")
+    parser.add_argument("--threads", type=int, help="CPU threads per worker (default: cores / workers)")
+    parser.add_argument("--depth-mode", choices=("crop", "frame"), help="Depth estimation mode")
+    parser.add_argument("--detect-mode", choices=("full", "cascade"), help="Damage detection mode")
+    parser.add_argument("--no-gates", action="store_true", help="Skip the quality and vehicle gates")
+    parser.add_argument("--car-name", help="Default car name (pricing)")
+    parser.add_argument("--region", help="Default pricing region")
+    parser.add_argument("--parts-model", default="parts.pt")
+    parser.add_argument("--damage-model", default="damage.pt")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.source):
+        sys.exit(f"❌ {args.source} not found")
+    summary = run_batch(args.source, args.output, workers=max(args.workers, 1), threads=args.threads,
+                        depth_mode=args.depth_mode, detect_mode=args.detect_mode, gates=not args.no_gates,
+                        car_name=args.car_name, region=args.region,
+                        parts_path=args.parts_model, damage_path=args.damage_model)
+    print(json.dumps(summary))
@@ -1,74 +1,262 @@
 # depth_service.py
-from transformers import pipeline
 from PIL import Image
 import numpy as np
 import cv2
 import base64
+import os
 
-# Load the Depth Model (First run downloads ~300MB, subsequent runs are instant)
-print("⏳ Loading Depth AI... (This may take a moment)")
-depth_estimator = pipeline(task="depth-estimation", model="LiheYoung/depth-anything-small-hf")
-print("✅ Depth AI Loaded.")
+from utils import metrics, tracing
+from resource_manager import cpu_stage
 
+# 'local': models run in this process; 'gateway': on inference servers (inference_client.py);
+# 'stub': latency-only stand-ins for load tests (loadtest/stub_models.py)
+INFERENCE_MODE = os.getenv("INFERENCE_MODE", "local")
 
-def analyze_dent_depth(image_crop_bgr):
+depth_estimator = None
+
+
+def load_depth_model():
+    """Load the depth model into this process (first run downloads ~300MB)."""
+    global depth_estimator
+    from transformers import pipeline
+
+    print("⏳ Loading Depth AI... (This may take a moment)")
+    depth_estimator = pipeline(task="depth-estimation", model="LiheYoung/depth-anything-small-hf")
+    print("✅ Depth AI Loaded.")
+
+
+def set_depth_estimator(estimator):
+    """Use another estimator with the pipeline's call interface (e.g. a remote one)."""
+    global depth_estimator
+    depth_estimator = estimator
+
+
+# Gateways and stub runs get another estimator and never load transformers
+if INFERENCE_MODE == "local":
+    load_depth_model()
+
+
+# Crops per forward pass when several dents are analyzed together
+DEPTH_BATCH_SIZE = 8
+
+# "crop":  depth model on each dent crop (batched)
+# "frame": depth model once per image on a downscaled full frame; each dent
+#          is scored on its slice of that map (model calls don't grow with dents)
+DEPTH_MODES = ("crop", "frame")
+DEPTH_MODE = os.getenv("DEPTH_MODE", "crop")
+# Long side of the frame fed to the depth model in "frame" mode
+DEPTH_FRAME_MAX_SIDE = int(os.getenv("DEPTH_FRAME_MAX_SIDE", "1024"))
+# Smallest dent slice (depth-map pixels) scored in "frame" mode
+MIN_SLICE = 8
+
+FAILED_DEPTH_RESULT = {"score": 0.0, "severity": 50, "heatmap": None, "overlay": None}
+
+
+def _to_pil(image_crop_bgr):
+    """Convert an OpenCV BGR crop to a PIL RGB image."""
+    img_rgb = cv2.cvtColor(image_crop_bgr, cv2.COLOR_BGR2RGB)
+    return Image.fromarray(img_rgb)
+
+
+@tracing.span("depth.crop")
+def depth_map_to_result(depth_map, image_crop_bgr, encode=True):
+    """
+    Turn a raw depth map for a dent crop into a severity score and heatmap.
+    
+    Input: depth_map (2D array from the depth model), the BGR crop it came from.
+    Output: {score, severity, heatmap, overlay} (see analyze_dent_depth)
+    """
+    # --- MATH: CALCULATE SEVERITY ---
+    # 1. Normalize Depth Map to 0-1 range globally for this crop
+    # This removes the issue of arbitrary raw value scales from the model
+    d_min, d_max = depth_map.min(), depth_map.max()
+    if d_max > d_min:
+        depth_norm = (depth_map - d_min) / (d_max - d_min)
+    else:
+        depth_norm = depth_map * 0  # Flat surface if min == max
+        
+    # 2. Calculate Standard Deviation on Normalized Map
+    # For a 0-1 range, max possible std is 0.5 (binary image). 
+    # Realistic deep dents are ~0.15 - 0.25. Scratches ~0.05.
+    depth_std = np.std(depth_norm)
+    
+    # 3. Scale to 0-1 Score
+    # 0.25 std -> 1.0 score (Very severe)
+    score = min(depth_std * 4.0, 1.0)
+    
+    print(f"📉 DEBUG: Raw Min: {d_min:.2f}, Max: {d_max:.2f} | Norm Std: {depth_std:.4f} | Final Score: {score:.2f}")
+
+    # --- VISUAL: GENERATE HEATMAP ---
+    # Reuse normalized map
+    # Apply JET colormap
+    depth_8bit = (depth_norm * 255).astype(np.uint8)
+    heatmap_colored = cv2.applyColorMap(depth_8bit, cv2.COLORMAP_JET)
+
+    # Resize heatmap to match original image dimensions
+    heatmap_resized = cv2.resize(heatmap_colored, (image_crop_bgr.shape[1], image_crop_bgr.shape[0]))
+
+    # Blend original image with heatmap (60% car, 40% heatmap for ghostly effect)
+    final_overlay = cv2.addWeighted(image_crop_bgr, 0.6, heatmap_resized, 0.4, 0)
+
+    result = {
+        "score": round(score, 2),
+        "severity": int(min(score * 100, 95)),  # Cap at 95
+        "heatmap": None,
+        "overlay": None
+    }
+
+    if not encode:
+        result["overlay"] = final_overlay
+        return result
+
+    # Encode blended result to Base64 for Frontend
+    is_success, buffer = cv2.imencode(".png", final_overlay)
+    result["heatmap"] = base64.b64encode(buffer).decode("utf-8") if is_success else None
+    return result
+
+
+@tracing.span("depth.analyze_dent")
+def analyze_dent_depth(image_crop_bgr, encode=True):
     """
     Use deep learning to analyze dent depth.
     
     Input: OpenCV Image (BGR) of just the dent.
-    Output: {score: 0.0-1.0, heatmap: base64_string}
+           encode=False skips the PNG/base64 step and returns the raw
+           overlay array instead (the API encodes it per response mode).
+    Output: {score: 0.0-1.0, heatmap: base64_string, overlay: BGR array or None}
     """
     try:
-        # Convert BGR to RGB (PIL)
-        img_rgb = cv2.cvtColor(image_crop_bgr, cv2.COLOR_BGR2RGB)
-        pil_image = Image.fromarray(img_rgb)
-
         # Run AI Inference
-        result = depth_estimator(pil_image)
+        with cpu_stage("depth"):
+            result = depth_estimator(_to_pil(image_crop_bgr))
         depth_map = np.array(result["depth"])
+        return depth_map_to_result(depth_map, image_crop_bgr, encode)
+
+    except Exception as e:
+        print(f"⚠️ Depth AI Error: {e}")
+        return dict(FAILED_DEPTH_RESULT)
 
-        # --- MATH: CALCULATE SEVERITY ---
-        # 1. Normalize Depth Map to 0-1 range globally for this crop
-        # This removes the issue of arbitrary raw value scales from the model
-        d_min, d_max = depth_map.min(), depth_map.max()
-        if d_max > d_min:
-            depth_norm = (depth_map - d_min) / (d_max - d_min)
-        else:
-            depth_norm = depth_map * 0  # Flat surface if min == max
-            
-        # 2. Calculate Standard Deviation on Normalized Map
-        # For a 0-1 range, max possible std is 0.5 (binary image). 
-        # Realistic deep dents are ~0.15 - 0.25. Scratches ~0.05.
-        depth_std = np.std(depth_norm)
-        
-        # 3. Scale to 0-1 Score
-        # 0.25 std -> 1.0 score (Very severe)
-        score = min(depth_std * 4.0, 1.0)
-        
-        print(f"📉 DEBUG: Raw Min: {d_min:.2f}, Max: {d_max:.2f} | Norm Std: {depth_std:.4f} | Final Score: {score:.2f}")
 
-        # --- VISUAL: GENERATE HEATMAP ---
-        # Reuse normalized map
-        # Apply JET colormap
-        depth_8bit = (depth_norm * 255).astype(np.uint8)
-        heatmap_colored = cv2.applyColorMap(depth_8bit, cv2.COLORMAP_JET)
+class FrameDepth:
+    """Depth map of a whole (downscaled) frame, sliced with source-pixel boxes."""
 
-        # Resize heatmap to match original image dimensions
-        heatmap_resized = cv2.resize(heatmap_colored, (image_crop_bgr.shape[1], image_crop_bgr.shape[0]))
+    def __init__(self, depth_map, source_shape):
+        self.depth_map = depth_map  # float32 (h, w) of the downscaled frame
+        self.scale_x = depth_map.shape[1] / source_shape[1]
+        self.scale_y = depth_map.shape[0] / source_shape[0]
 
-        # Blend original image with heatmap (60% car, 40% heatmap for ghostly effect)
-        final_overlay = cv2.addWeighted(image_crop_bgr, 0.6, heatmap_resized, 0.4, 0)
+    def slice(self, box):
+        """
+        Depth values under a [x1, y1, x2, y2] box. Boxes smaller than
+        MIN_SLICE depth pixels are grown around their center, so tiny dents
+        still get a measurable depth profile.
+        """
+        h, w = self.depth_map.shape
+        x1, y1, x2, y2 = box
+        dx1, dx2 = _grow_span(x1 * self.scale_x, x2 * self.scale_x, w)
+        dy1, dy2 = _grow_span(y1 * self.scale_y, y2 * self.scale_y, h)
+        return self.depth_map[dy1:dy2, dx1:dx2]
 
-        # Encode blended result to Base64 for Frontend
-        is_success, buffer = cv2.imencode(".png", final_overlay)
-        heatmap_base64 = base64.b64encode(buffer).decode("utf-8") if is_success else None
 
-        return {
-            "score": round(score, 2),
-            "severity": int(min(score * 100, 95)),  # Cap at 95
-            "heatmap": heatmap_base64
-        }
+def _grow_span(start, end, limit):
+    """Integer [start, end) covering the span, at least MIN_SLICE long, inside [0, limit)."""
+    size = min(limit, max(int(np.ceil(end)) - int(np.floor(start)), MIN_SLICE))
+    lo = int(np.floor((start + end) / 2 - size / 2))
+    lo = min(max(lo, 0), limit - size)
+    return lo, lo + size
+
+
+def _output_depth(output, size):
+    """
+    Float depth map at `size` (w, h) from a pipeline output. The raw
+    prediction keeps sub-level detail that the 8-bit "depth" image (one
+    0-255 range for the whole frame) would quantize away in small slices.
+    """
+    predicted = output.get("predicted_depth")
+    if predicted is None:
+        depth = np.asarray(output["depth"], dtype=np.float32)
+    else:
+        if hasattr(predicted, "cpu"):
+            predicted = predicted.detach().cpu().numpy()
+        depth = np.asarray(predicted, dtype=np.float32).squeeze()
+    if depth.shape != (size[1], size[0]):
+        depth = cv2.resize(depth, size, interpolation=cv2.INTER_LINEAR)
+    return depth
 
+
+def estimate_frame_depth_batch(frames_bgr, source_shapes):
+    """
+    One depth pass per downscaled frame, batched.
+    
+    Input: downscaled BGR frames and the (h, w) of the images they came from.
+    Output: FrameDepth (or None on failure) per frame.
+    """
+    if not frames_bgr:
+        return []
+    
+    try:
+        with tracing.span("depth.inference", mode="frame", inputs=len(frames_bgr)), \
+                cpu_stage("depth"), metrics.timer("depth_inference_ms", mode="frame"):
+            outputs = depth_estimator([_to_pil(frame) for frame in frames_bgr],
+                                      batch_size=DEPTH_BATCH_SIZE)
+        metrics.increment("depth_model_inputs", value=len(frames_bgr), mode="frame")
     except Exception as e:
-        print(f"⚠️ Depth AI Error: {e}")
-        return {"score": 0.0, "severity": 50, "heatmap": None}
\ No newline at end of file
+        print(f"⚠️ Frame Depth AI Error: {e}")
+        return [None] * len(frames_bgr)
+    
+    return [FrameDepth(_output_depth(output, (frame.shape[1], frame.shape[0])), shape[:2])
+            for frame, shape, output in zip(frames_bgr, source_shapes, outputs)]
+
+
+def analyze_dents_in_frame(frame_depth, image_bgr, boxes, encode=True):
+    """
+    Severity and heatmap for several dents from one frame depth map.
+    
+    Input: FrameDepth of the image, the full-resolution BGR image and the
+           dent boxes [x1, y1, x2, y2] in image pixels.
+    Output: List of results in box order (see analyze_dent_depth).
+    """
+    results = []
+    for box in boxes:
+        x1, y1, x2, y2 = map(int, box)
+        crop = image_bgr[y1:y2, x1:x2]
+        if frame_depth is None or crop.size == 0:
+            results.append(dict(FAILED_DEPTH_RESULT))
+            continue
+        try:
+            results.append(depth_map_to_result(frame_depth.slice((x1, y1, x2, y2)), crop, encode))
+        except Exception as e:
+            print(f"⚠️ Depth AI Error: {e}")
+            results.append(dict(FAILED_DEPTH_RESULT))
+    return results
+
+
+def analyze_dent_depth_batch(image_crops_bgr, encode=True):
+    """
+    Analyze several dent crops with batched depth inference.
+    
+    Input: List of BGR crops (may come from different images).
+    Output: List of results in the same order (see analyze_dent_depth).
+    """
+    if not image_crops_bgr:
+        return []
+    
+    try:
+        with tracing.span("depth.inference", mode="crop", inputs=len(image_crops_bgr)), \
+                cpu_stage("depth"), metrics.timer("depth_inference_ms", mode="crop"):
+            outputs = depth_estimator([_to_pil(crop) for crop in image_crops_bgr],
+                                      batch_size=DEPTH_BATCH_SIZE)
+        metrics.increment("depth_model_inputs", value=len(image_crops_bgr), mode="crop")
+    except Exception as e:
+        # Fall back to one-by-one so a single bad crop doesn't fail the batch
+        print(f"⚠️ Batched Depth AI Error, retrying per crop: {e}")
+        return [analyze_dent_depth(crop, encode) for crop in image_crops_bgr]
+    
+    results = []
+    for crop, output in zip(image_crops_bgr, outputs):
+        try:
+            results.append(depth_map_to_result(np.array(output["depth"]), crop, encode))
+        except Exception as e:
+            print(f"⚠️ Depth AI Error: {e}")
+            results.append(dict(FAILED_DEPTH_RESULT))
+    return results
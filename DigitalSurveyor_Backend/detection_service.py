@@ -0,0 +1,366 @@
+# detection_service.py
+"""
+YOLO models and the detection stages shared by the API and offline tools.
+
+Models load once per process (load_models()); main.py loads them at
+import (or, as a gateway, swaps in remote proxies with set_models()),
+batch_process.py in each pool worker. Everything here is
+stateless apart from the two model handles, so a process that has
+called load_models() can run parts detection, the vehicle gate and
+smart damage detection without the web app, Supabase or the outbox.
+"""
+
+import os
+
+import numpy as np
+
+import resource_manager
+from utils import metrics, tracing
+from utils.image_context import ImageContext, as_context, LETTERBOX_STRIDE
+from vehicle_gate_service import (
+    VEHICLE_GATE, VEHICLE_GATE_IMGSZ, VehiclePresence, assess_vehicle_presence,
+)
+
+# Damage detection: one 1280 pass ('full') or the adaptive-resolution cascade ('cascade')
+DAMAGE_DETECT_MODE = os.getenv("DAMAGE_DETECT_MODE", "full")
+DAMAGE_IMGSZ = 1280
+DAMAGE_CONF = 0.25
+# Cascade: low-pass size, confidence floor for candidates/uncertainty, and the
+# largest share of the frame escalated as a crop (bigger regions get a full pass)
+CASCADE_LOW_IMGSZ = int(os.getenv("CASCADE_LOW_IMGSZ", "640"))
+CASCADE_LOW_CONF = float(os.getenv("CASCADE_LOW_CONF", "0.10"))
+CASCADE_CROP_MAX_AREA = float(os.getenv("CASCADE_CROP_MAX_AREA", "0.35"))
+CASCADE_CROP_MARGIN = 0.15
+
+model_parts = None
+model_damage = None
+
+
+def load_models(parts_path="parts.pt", damage_path="damage.pt"):
+    """Load both YOLO models into this process (missing weights are reported, not fatal)."""
+    global model_parts, model_damage
+    from ultralytics import YOLO
+
+    print("------------------------------------------------")
+    print("🚀 STARTING AI ENGINE...")
+
+    if os.path.exists(parts_path):
+        model_parts = YOLO(parts_path)
+        print(f"✅ SUCCESS: '{parts_path}' loaded.")
+    else:
+        print(f"⚠️ WARNING: '{parts_path}' missing.")
+
+    if os.path.exists(damage_path):
+        model_damage = YOLO(damage_path)
+        print(f"✅ SUCCESS: '{damage_path}' loaded.")
+    else:
+        print(f"⚠️ WARNING: '{damage_path}' missing.")
+    print("------------------------------------------------")
+
+
+def set_models(parts, damage):
+    """Use other model objects with YOLO's call interface (e.g. inference_client proxies)."""
+    global model_parts, model_damage
+    model_parts, model_damage = parts, damage
+
+
+def models_loaded() -> bool:
+    return model_parts is not None and model_damage is not None
+
+def apply_clahe(image):
+    """Apply CLAHE to enhance scratches (LAB color space)."""
+    return ImageContext(image).clahe
+
+
+def model_imgsz(model, default=640):
+    """Inference size a YOLO model was trained with (what it uses by default)."""
+    imgsz = getattr(model, "overrides", {}).get("imgsz", default)
+    return max(imgsz) if isinstance(imgsz, (list, tuple)) else int(imgsz)
+
+
+def restore_result_boxes(result, view, offset=(0, 0), source_shape=None):
+    """
+    Map a YOLO result computed on a letterboxed view back to source-frame
+    coordinates. For a view of a crop, `offset` is the crop's top-left
+    corner and `source_shape` the full frame's (h, w).
+    """
+    data = result.boxes.data if result.boxes is not None else None
+    result.orig_shape = source_shape or view.source_shape
+    if data is None or len(data) == 0:
+        return result
+    mapped = data.cpu().numpy().copy()
+    mapped[:, :4] = view.to_source(mapped[:, :4]) + np.array([offset[0], offset[1]] * 2, dtype=np.float32)
+    result.update(boxes=data.new_tensor(mapped))
+    return result
+
+
+def result_boxes(result):
+    """Nx6 numpy array (x1, y1, x2, y2, conf, cls) of a YOLO result."""
+    if result.boxes is None or len(result.boxes) == 0:
+        return np.zeros((0, 6), dtype=np.float32)
+    return result.boxes.data.cpu().numpy()
+
+
+@tracing.span("yolo.parts")
+def run_parts_model(images, imgsz=None):
+    """
+    Batched parts detection on the shared letterboxed views.
+    Returns one single-element results list per image (like model_parts(img)).
+    """
+    contexts = [as_context(image) for image in images]
+    imgsz = imgsz or model_imgsz(model_parts)
+    with resource_manager.cpu_stage("opencv"):
+        views = [ctx.letterboxed(imgsz) for ctx in contexts]
+    with resource_manager.cpu_stage("yolo"):
+        results = model_parts([view.image for view in views], imgsz=imgsz, verbose=False)
+    return [[restore_result_boxes(result, view)] for result, view in zip(results, views)]
+
+
+@tracing.span("vehicle_gate")
+def check_vehicle_presence(images):
+    """
+    Vehicle gate: low-resolution parts pass deciding whether each photo
+    frames a car (see vehicle_gate_service). Returns one VehiclePresence per image.
+    """
+    contexts = [as_context(image) for image in images]
+    if not VEHICLE_GATE:
+        return [VehiclePresence() for _ in contexts]
+    with metrics.timer("vehicle_gate_ms"):
+        results = run_parts_model(contexts, imgsz=VEHICLE_GATE_IMGSZ)
+    presences = []
+    for ctx, (result,) in zip(contexts, results):
+        presence = assess_vehicle_presence(result_boxes(result), ctx.shape)
+        metrics.increment("vehicle_gate", result=presence.reason or "passed")
+        presences.append(presence)
+    return presences
+
+
+def merge_close_boxes(boxes, distance_threshold=50):
+    """
+    Merge bounding boxes that are close together (< distance_threshold pixels).
+    Turns 'dotted line' detections into single scratches.
+    """
+    if len(boxes) == 0:
+        return boxes
+    
+    merged = []
+    used = [False] * len(boxes)
+    
+    for i in range(len(boxes)):
+        if used[i]:
+            continue
+            
+        current_box = boxes[i].copy()
+        used[i] = True
+        
+        # Find all boxes close to this one
+        for j in range(i + 1, len(boxes)):
+            if used[j]:
+                continue
+                
+            # Calculate center distance
+            center1 = ((current_box[0] + current_box[2]) / 2, (current_box[1] + current_box[3]) / 2)
+            center2 = ((boxes[j][0] + boxes[j][2]) / 2, (boxes[j][1] + boxes[j][3]) / 2)
+            distance = np.sqrt((center1[0] - center2[0])**2 + (center1[1] - center2[1])**2)
+            
+            if distance < distance_threshold:
+                # Merge boxes (take min/max coordinates)
+                current_box[0] = min(current_box[0], boxes[j][0])  # x1
+                current_box[1] = min(current_box[1], boxes[j][1])  # y1
+                current_box[2] = max(current_box[2], boxes[j][2])  # x2
+                current_box[3] = max(current_box[3], boxes[j][3])  # y2
+                used[j] = True
+        
+        merged.append(current_box)
+    
+    return np.array(merged)
+
+
+def filter_reflections(boxes, image_shape, max_area_ratio=0.25, square_aspect_tolerance=0.15):
+    """
+    Filter out likely reflections:
+    - Boxes larger than 25% of image area
+    - Perfectly square boxes (aspect ratio ~1.0) unless very small
+    """
+    if len(boxes) == 0:
+        return boxes
+    
+    img_h, img_w = image_shape[:2]
+    img_area = img_h * img_w
+    filtered = []
+    
+    for box in boxes:
+        x1, y1, x2, y2 = box
+        box_w = x2 - x1
+        box_h = y2 - y1
+        box_area = box_w * box_h
+        
+        
+        
+        # Filter 2: Square aspect ratio (likely reflection, unless small)
+        aspect_ratio = box_w / box_h if box_h > 0 else 0
+        is_square = abs(aspect_ratio - 1.0) < square_aspect_tolerance
+        is_small = box_area < (img_area * 0.01)  # < 1% of image
+        
+        if is_square and not is_small:
+            continue
+        
+        filtered.append(box)
+    
+    return np.array(filtered) if filtered else np.array([])
+
+
+def extract_detections(result, image_shape):
+    """
+    Post-process one YOLO result into compact detection data:
+    merge close boxes, filter reflections. Overlays are drawn from this
+    on demand (overlay_service), never per scan.
+    
+    Returns:
+        List of {"box": [x1, y1, x2, y2], "class": int, "confidence": float}
+    """
+    # Step 3: Extract boxes
+    boxes = []
+    classes = []
+    confidences = []
+    
+    if result.boxes:
+        for box in result.boxes:
+            boxes.append(box.xyxy[0].cpu().numpy())
+            confidences.append(float(box.conf[0]))
+            classes.append(int(box.cls[0]))
+    
+    if len(boxes) == 0:
+        return []
+    
+    boxes = np.array(boxes)
+    
+    # Step 4: Merge close boxes
+    boxes = merge_close_boxes(boxes, distance_threshold=50)
+    
+    # Step 5: Filter reflections
+    boxes = filter_reflections(boxes, image_shape)
+    
+    return [{
+        "box": [int(v) for v in box],
+        "class": classes[i] if i < len(classes) else 0,
+        "confidence": round(confidences[i] if i < len(confidences) else 0.0, 4)
+    } for i, box in enumerate(boxes)]
+
+
+def run_damage_model(model, views, imgsz, conf, stage):
+    """One batched damage-model call on letterboxed views (timed per cascade stage)."""
+    metrics.observe("damage_detect_pixels", sum(view.image.shape[0] * view.image.shape[1] for view in views),
+                    stage=stage)
+    with tracing.span("yolo.damage", stage=stage, imgsz=imgsz, images=len(views)), \
+            resource_manager.cpu_stage("yolo"), metrics.timer("damage_detect_ms", stage=stage):
+        return model([view.image for view in views], conf=conf, iou=0.5, imgsz=imgsz, verbose=False)
+
+
+def cascade_crop_region(boxes, image_shape):
+    """
+    Region worth a high-resolution second look: the union of the low-pass
+    candidates plus a margin, or None when it covers too much of the frame
+    (a full-frame pass is then just as cheap).
+    """
+    h, w = image_shape[:2]
+    x1, y1 = boxes[:, 0].min(), boxes[:, 1].min()
+    x2, y2 = boxes[:, 2].max(), boxes[:, 3].max()
+    pad_x = max((x2 - x1) * CASCADE_CROP_MARGIN, LETTERBOX_STRIDE)
+    pad_y = max((y2 - y1) * CASCADE_CROP_MARGIN, LETTERBOX_STRIDE)
+    x1, y1 = int(max(0, x1 - pad_x)), int(max(0, y1 - pad_y))
+    x2, y2 = int(min(w, x2 + pad_x)), int(min(h, y2 + pad_y))
+    area = (x2 - x1) * (y2 - y1) / float(h * w)
+    metrics.observe("detect_cascade_crop_area", area)
+    if area > CASCADE_CROP_MAX_AREA or x2 <= x1 or y2 <= y1:
+        return None
+    return x1, y1, x2, y2
+
+
+def cascade_detect(contexts, model):
+    """
+    Adaptive-resolution damage detection:
+    1. Low-resolution pass (CASCADE_LOW_IMGSZ) with a lowered confidence
+       floor, so weak detections show up as uncertainty
+    2. Frames with candidates or uncertain boxes escalate: a high-resolution
+       crop around them when they are localized, else a full 1280 pass
+    3. Frames where the low pass finds nothing are confidently clean and
+       keep the (empty) low-pass result
+    
+    Returns:
+        One YOLO result per context, in source-frame coordinates
+    """
+    with resource_manager.cpu_stage("opencv"):
+        low_views = [ctx.letterboxed(CASCADE_LOW_IMGSZ, source="clahe") for ctx in contexts]
+    low_results = run_damage_model(model, low_views, CASCADE_LOW_IMGSZ, CASCADE_LOW_CONF, "low")
+    results = [restore_result_boxes(result, view) for result, view in zip(low_results, low_views)]
+    
+    full_frames, crops = [], []
+    for idx, (ctx, result) in enumerate(zip(contexts, results)):
+        boxes = result_boxes(result)
+        metrics.observe("detect_cascade_low_max_conf", float(boxes[:, 4].max()) if len(boxes) else 0.0)
+        if len(boxes) == 0:
+            metrics.increment("detect_cascade", decision="clean")
+            continue
+        reason = "candidates" if (boxes[:, 4] >= DAMAGE_CONF).any() else "uncertain"
+        region = cascade_crop_region(boxes, ctx.shape)
+        metrics.increment("detect_cascade", decision="crop" if region else "full", reason=reason)
+        if region:
+            crops.append((idx, region))
+        else:
+            full_frames.append(idx)
+    
+    if full_frames:
+        with resource_manager.cpu_stage("opencv"):
+            views = [contexts[idx].letterboxed(DAMAGE_IMGSZ, source="clahe") for idx in full_frames]
+        for idx, result, view in zip(full_frames, run_damage_model(model, views, DAMAGE_IMGSZ, DAMAGE_CONF, "full"),
+                                     views):
+            results[idx] = restore_result_boxes(result, view)
+    
+    # Crops run at native resolution (capped at DAMAGE_IMGSZ): more detail
+    # than the full-frame pass, at a fraction of its pixels
+    for idx, (x1, y1, x2, y2) in crops:
+        imgsz = min(DAMAGE_IMGSZ, -(-max(x2 - x1, y2 - y1) // LETTERBOX_STRIDE) * LETTERBOX_STRIDE)
+        with resource_manager.cpu_stage("opencv"):
+            view = ImageContext(contexts[idx].clahe[y1:y2, x1:x2]).letterboxed(imgsz)
+        result = run_damage_model(model, [view], imgsz, DAMAGE_CONF, "crop")[0]
+        results[idx] = restore_result_boxes(result, view, offset=(x1, y1), source_shape=contexts[idx].shape[:2])
+    
+    return results
+
+
+@tracing.span("smart_detect")
+def smart_detect_batch(images, model=None, mode=None):
+    """
+    Optimized detection over several images with batched YOLO calls:
+    1. Apply CLAHE preprocessing (memoized on each ImageContext)
+    2. Run YOLO (conf=0.25) on the letterboxed CLAHE views: one 1280 pass
+       ('full' mode) or the adaptive-resolution cascade ('cascade' mode)
+    3-5. Merge and filter per image (extract_detections)
+    
+    Args:
+        images: BGR frames or ImageContexts
+        model: Damage model (default: the loaded model_damage)
+        mode: 'full' | 'cascade' (default DAMAGE_DETECT_MODE)
+    
+    Returns:
+        List of (results, detections) per image, where results is a
+        one-element list like a single-image YOLO call returns
+    """
+    contexts = [as_context(image) for image in images]
+    model = model or model_damage
+    
+    if (mode or DAMAGE_DETECT_MODE) == "cascade":
+        results = cascade_detect(contexts, model)
+    else:
+        with resource_manager.cpu_stage("opencv"):
+            views = [ctx.letterboxed(DAMAGE_IMGSZ, source="clahe") for ctx in contexts]
+        results = [restore_result_boxes(result, view)
+                   for result, view in zip(run_damage_model(model, views, DAMAGE_IMGSZ, DAMAGE_CONF, "full"), views)]
+    
+    return [([result], extract_detections(result, ctx.shape)) for ctx, result in zip(contexts, results)]
+
+
+def smart_detect(image, model=None):
+    """Optimized detection for a single image or ImageContext (see smart_detect_batch)."""
+    return smart_detect_batch([image], model)[0]
@@ -0,0 +1,6 @@
+-- Migration: Thumbnail / web / full image variants per scan
+-- Run this in Supabase SQL Editor
+
+-- {"original": {"thumb": url, "web": url, "full": url}, "processed": {...}, "heatmap": {...}}
+-- The *_image_url columns keep pointing at the full-size variant
+ALTER TABLE scans ADD COLUMN IF NOT EXISTS image_variants jsonb;
@@ -0,0 +1,424 @@
+# inference_client.py
+"""
+Gateway side of the split deployment (INFERENCE_MODE=gateway).
+
+The FastAPI workers keep decoding, gates, pricing, reports and persistence
+and send every model call to a pool of inference servers
+(inference_server.py, INFERENCE_SERVERS=host:port,...):
+
+- RemoteYOLO / RemoteDepthEstimator stand in for the YOLO models and the
+  depth pipeline, so detection_service and depth_service run unchanged
+- each call goes to the healthy server with the fewest requests in
+  flight (round-robin among equals), over a pooled connection
+- a background thread health-checks every server; a server that fails a
+  call or a check is taken out of rotation until a check succeeds again,
+  and the failed call is retried on another server (inference is idempotent)
+- with no server available the call raises InferenceUnavailable (503)
+
+Frames go to servers on the same host through this process's shared-memory
+ring (utils.shm_ring) instead of the socket; remote servers get raw bytes.
+"""
+
+import itertools
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+
+import resource_manager
+from utils import metrics, rpc, tracing
+from utils.shm_ring import ShmRing
+
+INFERENCE_MODE = os.getenv("INFERENCE_MODE", "local")
+INFERENCE_SERVERS = os.getenv("INFERENCE_SERVERS", "127.0.0.1:9100")
+INFERENCE_TIMEOUT_SECONDS = float(os.getenv("INFERENCE_TIMEOUT_SECONDS", "60"))
+INFERENCE_CONNECT_TIMEOUT_SECONDS = float(os.getenv("INFERENCE_CONNECT_TIMEOUT_SECONDS", "2"))
+INFERENCE_HEALTH_INTERVAL = float(os.getenv("INFERENCE_HEALTH_INTERVAL", "5"))
+# Other servers tried after a call fails on one
+INFERENCE_RETRIES = int(os.getenv("INFERENCE_RETRIES", "1"))
+# Shared secret the servers require in hello (inference_server.INFERENCE_TOKEN)
+INFERENCE_TOKEN = os.getenv("INFERENCE_TOKEN", "")
+# Shared-memory frame handoff to same-host servers (slots sized for 1280px letterboxed views)
+INFERENCE_SHM = os.getenv("INFERENCE_SHM", "true").lower() == "true"
+INFERENCE_SHM_SLOTS = int(os.getenv("INFERENCE_SHM_SLOTS", "8"))
+INFERENCE_SHM_SLOT_MB = float(os.getenv("INFERENCE_SHM_SLOT_MB", "8"))
+MAX_IDLE_CONNECTIONS = 8   # Per server
+LATENCY_SMOOTHING = 0.2
+
+
+class InferenceUnavailable(Exception):
+    """No inference server could take the call."""
+
+
+class RemoteInferenceError(Exception):
+    """The server ran the call and it failed (not retried elsewhere)."""
+
+
+def parse_servers(spec: str) -> list:
+    """'host:port,host:port' -> [(host, port)]."""
+    servers = []
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        host, _, port = entry.rpartition(":")
+        servers.append((host or "127.0.0.1", int(port)))
+    return servers
+
+
+# --- CONNECTIONS ---
+
+class Connection:
+    """One socket to a server; a request at a time."""
+
+    def __init__(self, address, ring: ShmRing = None, timeout: float = INFERENCE_TIMEOUT_SECONDS):
+        self.sock = socket.create_connection(address, timeout=INFERENCE_CONNECT_TIMEOUT_SECONDS)
+        self.sock.settimeout(timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.ring = None
+        self._ids = itertools.count(1)
+        try:
+            self.hello = self.call({"method": "hello", "token": INFERENCE_TOKEN,
+                                    "ring": ring.name if ring else None}).header
+            if not self.hello.get("ok"):
+                raise rpc.ProtocolError(f"Handshake refused: {self.hello.get('error')}")
+        except BaseException:
+            self.close()
+            raise
+        # The server could map our ring only if it shares this host's /dev/shm
+        self.ring = ring if self.hello.get("shm") else None
+
+    def call(self, header: dict, arrays=()) -> rpc.Message:
+        header = {**header, "id": next(self._ids)}
+        handles = rpc.send_message(self.sock, header, arrays, self.ring)
+        try:
+            reply = rpc.recv_message(self.sock)
+        finally:
+            for handle in handles:
+                self.ring.release(handle)  # No-op when the server already released it
+        if reply.header.get("id") != header["id"]:
+            raise rpc.ProtocolError("Reply to another request")
+        return reply
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ServerState:
+    """Health, load and idle connections of one inference server."""
+
+    def __init__(self, address):
+        self.address = tuple(address)
+        self.name = f"{address[0]}:{address[1]}"
+        self.healthy = True   # Until a call or check says otherwise
+        self.in_flight = 0
+        self.latency_ms = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_check = None
+        self.hello = {}
+        self.shm = False
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self, ring):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        connection = Connection(self.address, ring)
+        self.hello, self.shm = connection.hello, connection.ring is not None
+        return connection
+
+    def give_back(self, connection):
+        with self._lock:
+            if self.healthy and len(self._idle) < MAX_IDLE_CONNECTIONS:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def reset(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def stats(self) -> dict:
+        return {
+            "server": self.name,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "latency_ms": round(self.latency_ms, 1),
+            "calls": self.calls,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_check_s": round(time.time() - self.last_check, 1) if self.last_check else None,
+            "shm": self.shm,
+            "idle_connections": len(self._idle),
+        }
+
+
+# --- POOL ---
+
+class InferencePool:
+    """Load-balanced, health-checked set of inference servers."""
+
+    def __init__(self, servers: list, shm: bool = INFERENCE_SHM):
+        if not servers:
+            raise ValueError("INFERENCE_SERVERS lists no servers")
+        self.servers = [ServerState(address) for address in servers]
+        self.ring = ShmRing.create(INFERENCE_SHM_SLOTS, int(INFERENCE_SHM_SLOT_MB * (1 << 20))) if shm else None
+        self._lock = threading.Lock()
+        self._turn = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Check every server once (so model metadata is known), then keep checking in the background."""
+        self.check_all()
+        up = [server.name for server in self.servers if server.healthy]
+        print(f"🛰️ Inference gateway: {len(up)}/{len(self.servers)} server(s) up {up}")
+        self._thread = threading.Thread(target=self._run, name="inference-health", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        for server in self.servers:
+            server.reset()
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+    def _run(self):
+        while not self._stop.wait(INFERENCE_HEALTH_INTERVAL):
+            self.check_all()
+
+    def check_all(self):
+        for server in self.servers:
+            self.check(server)
+
+    def check(self, server: ServerState) -> bool:
+        """Fresh connection + hello: proves the server accepts work and refreshes its model list."""
+        try:
+            connection = Connection(server.address, timeout=INFERENCE_CONNECT_TIMEOUT_SECONDS * 2)
+            connection.close()
+        except (OSError, rpc.ProtocolError) as e:
+            server.last_check = time.time()
+            if server.healthy:
+                self._mark_down(server, e, source="health")
+            return False
+        server.last_check = time.time()
+        server.hello = connection.hello
+        if not server.healthy:
+            print(f"✅ Inference server {server.name} is back")
+            metrics.increment("inference_server_recovered", server=server.name)
+        server.healthy = True
+        return True
+
+    def _mark_down(self, server: ServerState, error, source: str):
+        was_healthy = server.healthy
+        server.healthy = False
+        server.failures += 1
+        server.last_error = f"{type(error).__name__}: {error}"[:200]
+        server.reset()
+        metrics.increment("inference_server_failures", server=server.name, source=source)
+        if was_healthy:
+            print(f"⚠️ Inference server {server.name} taken out of rotation ({server.last_error})")
+
+    def _pick(self, exclude) -> ServerState:
+        with self._lock:
+            candidates = [server for server in self.servers if server.healthy and server not in exclude]
+            if not candidates:
+                return None
+            # Least in flight; ties rotate so an idle pool still spreads calls
+            self._turn += 1
+            count = len(self.servers)
+            server = min(candidates, key=lambda s: (s.in_flight, (self.servers.index(s) - self._turn) % count))
+            server.in_flight += 1
+            return server
+
+    def models(self) -> dict:
+        """Model metadata from the servers' hello replies (first server that reported any)."""
+        for server in self.servers:
+            if server.hello.get("models"):
+                return server.hello["models"]
+        return {}
+
+    def call(self, method: str, header: dict, arrays=()) -> rpc.Message:
+        """Run `method` on the least-loaded healthy server, failing over on connection errors."""
+        tried = []
+        with tracing.span(f"rpc.{method}", inputs=len(arrays)) as span:
+            for _ in range(INFERENCE_RETRIES + 1):
+                server = self._pick(tried)
+                if server is None:
+                    break
+                tried.append(server)
+                current = tracing.current_span()
+                traceparent = f"00-{current.trace_id}-{current.span_id}-01" if current is not None else None
+                start = time.perf_counter()
+                try:
+                    connection = server.acquire(self.ring)
+                    try:
+                        reply = connection.call({"method": method, "traceparent": traceparent, **header}, arrays)
+                    except BaseException:
+                        connection.close()
+                        raise
+                    server.give_back(connection)
+                except (OSError, rpc.ProtocolError) as e:
+                    self._mark_down(server, e, source="call")
+                    metrics.increment("inference_failovers", method=method)
+                    continue
+                finally:
+                    with self._lock:
+                        server.in_flight -= 1
+
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                server.calls += 1
+                server.latency_ms = elapsed_ms if server.calls == 1 else \
+                    server.latency_ms + LATENCY_SMOOTHING * (elapsed_ms - server.latency_ms)
+                metrics.observe("inference_rpc_ms", elapsed_ms, method=method)
+                if span is not None:
+                    span.set(server=server.name, attempts=len(tried))
+                if not reply.header.get("ok"):
+                    raise RemoteInferenceError(f"{server.name}: {reply.header.get('error')}")
+                return reply
+
+        metrics.increment("inference_unavailable", method=method)
+        raise InferenceUnavailable(
+            f"No inference server available for '{method}' (tried {[server.name for server in tried]})")
+
+    def stats(self) -> dict:
+        return {"servers": [server.stats() for server in self.servers],
+                "shm_ring": self.ring.stats() if self.ring is not None else None}
+
+
+# --- MODEL PROXIES ---
+
+class RemoteTensor:
+    """The part of torch.Tensor the pipeline uses on YOLO results, over a numpy array."""
+
+    def __init__(self, array):
+        self._array = np.asarray(array)
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self._array
+
+    def tolist(self):
+        return self._array.tolist()
+
+    def new_tensor(self, data):
+        return RemoteTensor(np.asarray(data, dtype=self._array.dtype))
+
+    def __getitem__(self, index):
+        item = self._array[index]
+        return RemoteTensor(item) if isinstance(item, np.ndarray) else item
+
+    def __len__(self):
+        return len(self._array)
+
+    def __array__(self, dtype=None):
+        return self._array if dtype is None else self._array.astype(dtype)
+
+
+class RemoteBox:
+    def __init__(self, row):
+        self.xyxy = RemoteTensor(row[None, :4])
+        self.conf = RemoteTensor(row[4:5])
+        self.cls = RemoteTensor(row[5:6])
+
+
+class RemoteBoxes:
+    """Boxes of a remote result: Nx6 (x1, y1, x2, y2, conf, cls) like ultralytics' boxes.data."""
+
+    def __init__(self, data):
+        self.data = data if isinstance(data, RemoteTensor) else RemoteTensor(data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return (RemoteBox(row) for row in self.data.numpy())
+
+
+class RemoteResult:
+    """YOLO result rebuilt from a server reply (boxes, names, orig_shape, update())."""
+
+    def __init__(self, boxes, names: dict, orig_shape):
+        self.boxes = RemoteBoxes(boxes)
+        self.names = names
+        self.orig_shape = orig_shape
+
+    def update(self, boxes=None):
+        if boxes is not None:
+            self.boxes = RemoteBoxes(boxes)
+
+
+class RemoteYOLO:
+    """Callable like an ultralytics YOLO model; runs on the inference servers."""
+
+    def __init__(self, pool: InferencePool, model: str):
+        self.pool = pool
+        self.model = model
+
+    def _meta(self) -> dict:
+        return self.pool.models().get(self.model) or {}
+
+    @property
+    def names(self) -> dict:
+        return {int(k): v for k, v in self._meta().get("names", {}).items()}
+
+    @property
+    def overrides(self) -> dict:
+        imgsz = self._meta().get("imgsz")
+        return {"imgsz": imgsz} if imgsz else {}
+
+    def __call__(self, source, imgsz=None, conf=None, iou=None, verbose=False):
+        images = source if isinstance(source, list) else [source]
+        kwargs = {key: value for key, value in (("imgsz", imgsz), ("conf", conf), ("iou", iou)) if value is not None}
+        reply = self.pool.call("yolo", {"model": self.model, "kwargs": kwargs}, images)
+        names = self.names
+        return [RemoteResult(boxes, names, image.shape[:2]) for boxes, image in zip(reply.arrays, images)]
+
+
+class RemoteDepthEstimator:
+    """Callable like the transformers depth pipeline (one PIL image or a list); runs on the servers."""
+
+    def __init__(self, pool: InferencePool):
+        self.pool = pool
+
+    def __call__(self, inputs, batch_size=None):
+        single = not isinstance(inputs, list)
+        images = [np.asarray(image.convert("RGB")) for image in ([inputs] if single else inputs)]
+        reply = self.pool.call("depth", {"batch_size": batch_size or 1}, images)
+        outputs = [{"depth": reply.arrays[2 * i], "predicted_depth": reply.arrays[2 * i + 1]}
+                   for i in range(len(images))]
+        return outputs[0] if single else outputs
+
+
+# --- GATEWAY SETUP ---
+
+_pool = None
+
+
+def connect_gateway(servers: str = INFERENCE_SERVERS) -> InferencePool:
+    """Point detection_service and depth_service at the inference servers (instead of loading models)."""
+    global _pool
+    import depth_service
+    import detection_service
+
+    _pool = InferencePool(parse_servers(servers))
+    _pool.start()
+    detection_service.set_models(RemoteYOLO(_pool, "parts"), RemoteYOLO(_pool, "damage"))
+    depth_service.set_depth_estimator(RemoteDepthEstimator(_pool))
+    # Waiting on a server uses no local CPU: don't hold this worker's thread budget for it
+    resource_manager.mark_remote("yolo", "depth")
+    return _pool
+
+
+def get_pool():
+    return _pool
@@ -0,0 +1,240 @@
+# inference_server.py
+"""
+Standalone inference server: the parts/damage YOLO models and the depth
+engine behind the binary RPC of utils/rpc.py. The FastAPI gateway
+(INFERENCE_MODE=gateway) keeps uploads, gates, pricing and persistence on
+small CPU nodes and sends every model call to a pool of these servers
+(inference_client.py), so the model tier scales and restarts on its own.
+
+    python inference_server.py --port 9100 [--host 0.0.0.0]
+
+Every connection starts with hello carrying INFERENCE_TOKEN, a secret
+shared with the gateways; connections that don't are dropped. The server
+refuses to bind beyond localhost without a token.
+
+Both tiers on one machine (local testing):
+    python inference_server.py --port 9100 &
+    python inference_server.py --port 9101 &
+    INFERENCE_MODE=gateway INFERENCE_SERVERS=127.0.0.1:9100,127.0.0.1:9101 python main.py
+
+Methods (request header "method"):
+- hello:  {"token", "ring": gateway's shared-memory ring or null} -> the models
+          (class names, training imgsz) and whether frames may arrive
+          through shared memory (same host only)
+- health: liveness, in-flight requests, uptime
+- yolo:   {"model": "parts" | "damage", "kwargs": {imgsz, conf, iou}} (clamped) +
+          letterboxed views -> one Nx6 (x1, y1, x2, y2, conf, cls) array per view
+- depth:  {"batch_size": n} + RGB images -> per image its "depth" image
+          (uint8) and "predicted_depth" (float32)
+A connection carries one request at a time; the gateway pools connections.
+Nothing is unpickled, and the server binds to localhost unless --host says otherwise.
+"""
+
+import hmac
+import os
+import socket
+import socketserver
+import threading
+import time
+
+# Thread budgets must be applied before torch/OpenCV/NumPy create their pools
+import resource_manager
+resource_manager.configure_process()
+
+import numpy as np
+from PIL import Image
+
+from utils import metrics, rpc, tracing
+from utils.shm_ring import SEGMENT_PREFIX, ShmRing
+
+INFERENCE_HOST = os.getenv("INFERENCE_HOST", "127.0.0.1")
+INFERENCE_PORT = int(os.getenv("INFERENCE_PORT", "9100"))
+# Shared secret every gateway sends in hello
+INFERENCE_TOKEN = os.getenv("INFERENCE_TOKEN", "")
+# Upper bound on a requested YOLO imgsz (raised to the model's training size if larger)
+MAX_YOLO_IMGSZ = 1280
+LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+_started = time.time()
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+
+
+def describe_models() -> dict:
+    """What this server hosts (sent in the hello reply; the gateway mirrors it)."""
+    import depth_service
+    import detection_service
+
+    models = {}
+    for name in ("parts", "damage"):
+        model = getattr(detection_service, f"model_{name}")
+        models[name] = None if model is None else {
+            "names": {str(k): v for k, v in model.names.items()},
+            "imgsz": detection_service.model_imgsz(model),
+        }
+    models["depth"] = depth_service.depth_estimator is not None
+    return models
+
+
+def yolo_kwargs(requested: dict, train_imgsz: int) -> dict:
+    """The peer's imgsz/conf/iou, clamped: imgsz to a stride multiple up to the model's limit, the rest to [0, 1]."""
+    kwargs = {}
+    if requested.get("imgsz") is not None:
+        limit = max(train_imgsz, MAX_YOLO_IMGSZ)
+        kwargs["imgsz"] = min(max(int(requested["imgsz"]) // 32 * 32, 32), limit)
+    for key in ("conf", "iou"):
+        if requested.get(key) is not None:
+            kwargs[key] = min(max(float(requested[key]), 0.0), 1.0)
+    return kwargs
+
+
+def run_yolo(header: dict, arrays: list):
+    import detection_service
+
+    model = getattr(detection_service, f"model_{header.get('model')}", None)
+    if model is None:
+        raise ValueError(f"Model '{header.get('model')}' is not loaded on this server")
+    kwargs = yolo_kwargs(header.get("kwargs") or {}, detection_service.model_imgsz(model))
+    with resource_manager.cpu_stage("yolo"):
+        results = model(list(arrays), verbose=False, **kwargs)
+    boxes = [detection_service.result_boxes(result).astype(np.float32) for result in results]
+    return {"count": len(boxes)}, boxes
+
+
+def run_depth(header: dict, arrays: list):
+    import depth_service
+
+    if depth_service.depth_estimator is None:
+        raise ValueError("Depth model is not loaded on this server")
+    images = [Image.fromarray(np.ascontiguousarray(array)) for array in arrays]
+    with resource_manager.cpu_stage("depth"):
+        outputs = depth_service.depth_estimator(images, batch_size=int(header.get("batch_size") or 1))
+    maps = []
+    for output in outputs:
+        predicted = output.get("predicted_depth")
+        if hasattr(predicted, "cpu"):
+            predicted = predicted.detach().cpu().numpy()
+        maps.append(np.asarray(output["depth"], dtype=np.uint8))
+        maps.append(np.asarray(predicted if predicted is not None else maps[-1], dtype=np.float32).squeeze())
+    return {"count": len(outputs)}, maps
+
+
+def health() -> dict:
+    return {"status": "ok", "pid": os.getpid(), "in_flight": _in_flight,
+            "uptime_s": round(time.time() - _started, 1)}
+
+
+METHODS = {"yolo": run_yolo, "depth": run_depth}
+
+
+class InferenceHandler(socketserver.BaseRequestHandler):
+    """One gateway connection: requests are answered in order until it closes."""
+
+    def handle(self):
+        global _in_flight
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        rings = {}  # The gateway's ring, once it announced one in hello
+        authenticated = False
+        try:
+            while True:
+                try:
+                    message = rpc.recv_message(sock, rings)
+                except (ConnectionError, OSError):
+                    return
+                except (rpc.ProtocolError, ValueError) as e:
+                    print(f"⚠️ Dropping inference connection from {self.client_address[0]}: {e}")
+                    return
+
+                method = message.header.get("method")
+                reply, arrays = {"id": message.header.get("id"), "ok": True}, []
+                if not authenticated:
+                    if method != "hello" or not hmac.compare_digest(str(message.header.get("token") or ""),
+                                                                    INFERENCE_TOKEN):
+                        message.release()
+                        print(f"⚠️ Refusing inference connection from {self.client_address[0]}: bad token")
+                        metrics.increment("inference_server_refused")
+                        reply.update(ok=False, error="Unauthorized")
+                        rpc.send_message(sock, reply)
+                        return
+                    authenticated = True
+                with _in_flight_lock:
+                    _in_flight += 1
+                root = tracing.start_trace(f"rpc.{method}", message.header.get("traceparent"), method=method)
+                start = time.perf_counter()
+                try:
+                    with tracing.activate(root):
+                        if method == "hello":
+                            reply.update(shm=self.attach_ring(message.header.get("ring"), rings),
+                                         models=describe_models(), **health())
+                        elif method == "health":
+                            reply.update(health())
+                        elif method in METHODS:
+                            result, arrays = METHODS[method](message.header, message.arrays)
+                            reply.update(result)
+                        else:
+                            raise ValueError(f"Unknown method '{method}'")
+                except Exception as e:
+                    print(f"❌ Inference '{method}' failed: {e}")
+                    metrics.increment("inference_server_errors", method=method)
+                    if root is not None:
+                        root.status = "error"
+                    reply.update(ok=False, error=f"{type(e).__name__}: {e}"[:500])
+                    arrays = []
+                finally:
+                    message.release()  # Frame slots go back to the gateway as soon as the model is done
+                    with _in_flight_lock:
+                        _in_flight -= 1
+                    if root is not None:
+                        root.end()
+                metrics.observe("inference_server_ms", (time.perf_counter() - start) * 1000, method=method)
+                rpc.send_message(sock, reply, arrays)
+        finally:
+            for ring in rings.values():
+                ring.close()
+
+    def attach_ring(self, name, rings: dict) -> bool:
+        """Map the gateway's frame ring; only possible when both share a host (and /dev/shm)."""
+        if not name or not str(name).startswith(f"{SEGMENT_PREFIX}_"):
+            return False
+        try:
+            rings[name] = ShmRing.attach(name)
+            return True
+        except (FileNotFoundError, ValueError, OSError):
+            return False
+
+
+class InferenceServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(host: str = INFERENCE_HOST, port: int = INFERENCE_PORT,
+          parts_path: str = "parts.pt", damage_path: str = "damage.pt"):
+    import depth_service
+    import detection_service
+
+    if not INFERENCE_TOKEN and host not in LOOPBACK_HOSTS:
+        raise SystemExit(f"❌ Set INFERENCE_TOKEN before serving on {host}: the server would accept anyone")
+    detection_service.load_models(parts_path, damage_path)
+    if depth_service.depth_estimator is None:
+        depth_service.load_depth_model()
+
+    with InferenceServer((host, port), InferenceHandler) as server:
+        print(f"🧠 Inference server on {host}:{port} (pid {os.getpid()})")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve the YOLO and depth models to gateway workers")
+    parser.add_argument("--host", default=INFERENCE_HOST)
+    parser.add_argument("--port", type=int, default=INFERENCE_PORT)
+    parser.add_argument("--parts-model", default="parts.pt")
+    parser.add_argument("--damage-model", default="damage.pt")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.parts_model, args.damage_model)
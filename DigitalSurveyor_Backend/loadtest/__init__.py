@@ -0,0 +1,18 @@
+# loadtest/__init__.py
+"""
+End-to-end load testing without model weights or a Supabase project.
+
+- stub_models:   YOLO / depth stand-ins with configurable latency
+                 (in the app via loadtest.app, or as stub inference servers)
+- fake_supabase: in-memory Storage + PostgREST endpoints on localhost
+- driver:        concurrent /analyze and /analyze/refine client with an
+                 image mix; throughput, p50/p95/p99 and error rates per
+                 concurrency level
+
+    python -m loadtest run --concurrency 1 4 8 16 --duration 30
+    python -m loadtest run --inference-servers 2 --yolo-ms 120
+    python -m loadtest drive --url http://staging:8000 --concurrency 4 8
+
+`run` starts the fake Supabase and the app (plus stub inference servers
+when asked) on localhost, drives it and shuts everything down.
+"""
@@ -0,0 +1,154 @@
+# loadtest/__main__.py
+"""Load-test CLI (run from DigitalSurveyor_Backend/): see loadtest/__init__.py."""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Accepted by supabase-py's key check; the fake never verifies it
+FAKE_SERVICE_KEY = "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.loadtest"
+# Signs the simulated users' session tokens (admission rate limits are per user)
+LOADTEST_JWT_SECRET = "loadtest-jwt-secret"
+
+
+def _wait_ready(url: str, procs: list, workdir: str, timeout_s: float = 180):
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        if any(proc.poll() is not None for proc in procs):
+            raise SystemExit(f"❌ A load-test process exited during startup, see the logs in {workdir}")
+        try:
+            if requests.get(url, timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise SystemExit(f"❌ {url} not ready after {timeout_s:.0f}s")
+
+
+def run(args):
+    """Fake Supabase + stub models + the app on localhost, then the sweep."""
+    workdir = tempfile.mkdtemp(prefix="loadtest_")
+    app_url = f"http://127.0.0.1:{args.port}"
+    supabase_url = f"http://127.0.0.1:{args.supabase_port}"
+    env = {
+        **os.environ,
+        "SUPABASE_URL": supabase_url,
+        "SUPABASE_SERVICE_ROLE_KEY": FAKE_SERVICE_KEY,
+        "SUPABASE_JWT_SECRET": LOADTEST_JWT_SECRET,
+        "FAKE_SUPABASE_LATENCY_MS": str(args.supabase_ms),
+        "STUB_YOLO_MS": str(args.yolo_ms),
+        "STUB_DEPTH_MS": str(args.depth_ms),
+        "STUB_CPU_BOUND": "true" if args.cpu_bound else "false",
+        "STORAGE_BACKEND": args.storage,
+        "STORAGE_LOCAL_DIR": os.path.join(workdir, "artifacts"),
+        "OUTBOX_DB_PATH": os.path.join(workdir, "outbox.db"),
+        "BACKEND_URL": app_url,
+        "WEB_CONCURRENCY": str(args.workers),
+        "INFERENCE_MODE": "stub",
+    }
+
+    procs = []
+
+    def start(name, command):
+        log = open(os.path.join(workdir, f"{name}.log"), "w")
+        procs.append(subprocess.Popen(command, env=env, cwd=BACKEND_DIR,
+                                      stdout=log, stderr=subprocess.STDOUT))
+
+    try:
+        start("fake_supabase", [sys.executable, "-m", "loadtest", "fake-supabase", "--port", str(args.supabase_port)])
+        if args.inference_servers:
+            ports = [args.inference_port + i for i in range(args.inference_servers)]
+            for port in ports:
+                start(f"stub_inference_{port}", [sys.executable, "-m", "loadtest", "stub-server", "--port", str(port)])
+            time.sleep(2)  # The gateway checks its servers once at startup
+            env.update(INFERENCE_MODE="gateway", INFERENCE_SERVERS=",".join(f"127.0.0.1:{p}" for p in ports))
+        # Stub mode runs the app through loadtest.app, which installs the stubs before importing main
+        app_module = "main:app" if args.inference_servers else "loadtest.app:app"
+        start("app", [sys.executable, "-m", "uvicorn", app_module, "--host", "127.0.0.1", "--port", str(args.port),
+                      "--workers", str(args.workers), "--log-level", "warning"])
+        print(f"🧪 Load test: app {app_url} ({env['INFERENCE_MODE']} inference, {args.workers} worker(s)), "
+              f"fake Supabase {supabase_url}, logs in {workdir}")
+        _wait_ready(f"{supabase_url}/_fake/stats", procs, workdir)
+        _wait_ready(f"{app_url}/admission", procs, workdir)
+
+        from loadtest.driver import run_sweep
+        run_sweep(app_url, args.concurrency, args.duration, args.refine_share, args.images, args.users,
+                  output=args.output, jwt_secret=LOADTEST_JWT_SECRET)
+
+        print(f"🗄️ Fake Supabase: {json.dumps(requests.get(f'{supabase_url}/_fake/stats', timeout=5).json())}")
+        print(f"📮 Outbox: {json.dumps(requests.get(f'{app_url}/outbox', timeout=5).json())}")
+    finally:
+        for proc in reversed(procs):
+            proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m loadtest", description="Load-test the analysis API")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def sweep_options(sub):
+        sub.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8], help="Concurrency levels")
+        sub.add_argument("--duration", type=float, default=30, help="Seconds per level")
+        sub.add_argument("--refine-share", type=float, default=0.2, help="Share of /analyze/refine requests")
+        sub.add_argument("--images", help="Directory of real photos (default: synthetic image mix)")
+        sub.add_argument("--users", type=int, default=50, help="Distinct user ids (per-user rate limits)")
+        sub.add_argument("--output", help="Write the result rows as JSON")
+
+    run_parser = commands.add_parser("run", help="Start fake Supabase, stub models and the app, then drive it")
+    sweep_options(run_parser)
+    run_parser.add_argument("--port", type=int, default=8765)
+    run_parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    run_parser.add_argument("--supabase-port", type=int, default=54329)
+    run_parser.add_argument("--supabase-ms", type=float, default=20, help="Fake Supabase latency per request")
+    run_parser.add_argument("--yolo-ms", type=float, default=60, help="Stub YOLO latency per 640px image")
+    run_parser.add_argument("--depth-ms", type=float, default=80, help="Stub depth latency per image")
+    run_parser.add_argument("--cpu-bound", action="store_true", help="Stubs burn CPU instead of sleeping")
+    run_parser.add_argument("--storage", choices=("supabase", "local"), default="supabase")
+    run_parser.add_argument("--inference-servers", type=int, default=0,
+                            help="Run the app as a gateway over this many stub inference servers")
+    run_parser.add_argument("--inference-port", type=int, default=9200)
+
+    drive_parser = commands.add_parser("drive", help="Drive an already running deployment")
+    sweep_options(drive_parser)
+    drive_parser.add_argument("--url", required=True, help="Base URL of the API")
+    drive_parser.add_argument("--jwt-secret", default=os.getenv("SUPABASE_JWT_SECRET"),
+                              help="Sign per-user session tokens (default: SUPABASE_JWT_SECRET)")
+
+    fake_parser = commands.add_parser("fake-supabase", help="Serve the in-memory Supabase fake")
+    fake_parser.add_argument("--host", default="127.0.0.1")
+    fake_parser.add_argument("--port", type=int, default=54329)
+
+    stub_parser = commands.add_parser("stub-server", help="Inference server backed by the stub models")
+    stub_parser.add_argument("--host", default="127.0.0.1")
+    stub_parser.add_argument("--port", type=int, default=9100)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    elif args.command == "drive":
+        from loadtest.driver import run_sweep
+        run_sweep(args.url, args.concurrency, args.duration, args.refine_share, args.images, args.users,
+                  output=args.output, jwt_secret=args.jwt_secret)
+    elif args.command == "fake-supabase":
+        from loadtest import fake_supabase
+        fake_supabase.serve(args.host, args.port)
+    else:
+        from loadtest import stub_models
+        stub_models.serve(args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+# loadtest/app.py
+"""
+The app with the stub models: `uvicorn loadtest.app:app` (what `run` starts
+unless it runs stub inference servers).
+
+The stubs are installed before main is imported, so main finds its models
+already loaded and skips the real weights; main never imports loadtest.
+"""
+
+import os
+
+# Thread budgets must be applied before torch/OpenCV/NumPy create their pools
+import resource_manager
+resource_manager.configure_process()
+
+os.environ["INFERENCE_MODE"] = "stub"  # depth_service must not load the real model
+
+from loadtest import stub_models  # noqa: E402
+
+stub_models.install()
+
+from main import app  # noqa: E402,F401
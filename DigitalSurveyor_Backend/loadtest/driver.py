@@ -0,0 +1,236 @@
+# loadtest/driver.py
+"""
+Concurrent client for /analyze and /analyze/refine.
+
+Each concurrency level runs `concurrency` client threads for a fixed
+duration; every thread sends requests back to back (closed loop), picking
+the endpoint by --refine-share and the photo from the image mix. Outcomes:
+
+- ok:       HTTP 200 with a result
+- rejected: HTTP 200 turned away by a gate (blurry, dark, no vehicle): the
+            service working as intended, counted apart from errors
+- busy:     429/503 from admission control or no inference server
+- error:    anything else (5xx, timeouts, connection errors, failed analyses)
+
+The image mix uses synthetic photos unless --images points at real ones:
+12MP and HD phone shots, web-sized uploads and a share of blurry or dark
+frames the quality gate should reject.
+
+Admission rate limits are per session user (else per client address), so
+with a JWT secret every simulated user sends its own signed session token;
+without one all requests share the driver's address bucket.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import requests
+
+# name: (width, height, share of requests)
+IMAGE_MIX = {
+    "phone_12mp": (4032, 3024, 0.25),
+    "phone_hd": (1920, 1440, 0.40),
+    "web": (1280, 960, 0.25),
+    "blurry": (1280, 960, 0.05),
+    "dark": (1280, 960, 0.05),
+}
+CLOSEUP_SIZE = (1280, 960)
+GATE_ERRORS = ("Image Quality Issue", "No Vehicle Detected", "Vehicle Too Small")
+REFINE_TARGETS = [("Door", "Dent"), ("Bumper", "Scratch"), ("Fender", "Dent"), ("Hood", "Scratch")]
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+# --- IMAGES ---
+
+def synthetic_photo(width: int, height: int, kind: str, seed: int) -> bytes:
+    """JPEG of a car-ish scene: sky/ground gradient, a body with panels, texture noise."""
+    rng = np.random.default_rng(seed)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    image = (np.array([200, 170, 140], np.float32) * (1 - y) + np.array([70, 80, 90], np.float32) * y)
+    image = np.broadcast_to(image, (height, width, 3)).copy()
+    color = rng.uniform(40, 220, size=3)
+    cv2.rectangle(image, (int(width * 0.1), int(height * 0.35)), (int(width * 0.9), int(height * 0.8)), color, -1)
+    for x in np.linspace(0.1, 0.9, 4)[1:-1]:
+        cv2.line(image, (int(width * x), int(height * 0.35)), (int(width * x), int(height * 0.8)), (20, 20, 20), 3)
+    for cx in (0.25, 0.75):
+        cv2.circle(image, (int(width * cx), int(height * 0.8)), int(height * 0.09), (25, 25, 25), -1)
+    image += rng.normal(0, 12, size=image.shape).astype(np.float32)
+    if kind == "blurry":
+        image = cv2.GaussianBlur(image, (0, 0), 12)
+    elif kind == "dark":
+        image *= 0.15
+    _, jpeg = cv2.imencode(".jpg", image.clip(0, 255).astype(np.uint8), [cv2.IMWRITE_JPEG_QUALITY, 88])
+    return jpeg.tobytes()
+
+
+def build_image_mix(image_dir: str = None, per_kind: int = 3):
+    """[(kind, jpeg bytes, share)] for /analyze, plus close-ups for /analyze/refine."""
+    if image_dir:
+        files = sorted(os.path.join(image_dir, name) for name in os.listdir(image_dir)
+                       if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp")))
+        if not files:
+            raise SystemExit(f"❌ No images in {image_dir}")
+        photos = []
+        for path in files:
+            with open(path, "rb") as f:
+                photos.append(("file", f.read(), 1 / len(files)))
+        return photos, [data for _, data, _ in photos]
+
+    photos = [(kind, synthetic_photo(w, h, kind, seed=i * 101 + n), share / per_kind)
+              for i, (kind, (w, h, share)) in enumerate(IMAGE_MIX.items()) for n in range(per_kind)]
+    closeups = [synthetic_photo(*CLOSEUP_SIZE, "closeup", seed=9000 + n) for n in range(6)]
+    return photos, closeups
+
+
+# --- CLIENT ---
+
+def _session_headers(user: str, jwt_secret: str) -> dict:
+    """Bearer header with a day-long Supabase-style session token for `user`, or {}."""
+    if not jwt_secret:
+        return {}
+    from jose import jwt
+    claims = {"sub": user, "aud": "authenticated", "role": "authenticated", "exp": int(time.time()) + 86400}
+    return {"Authorization": f"Bearer {jwt.encode(claims, jwt_secret, algorithm='HS256')}"}
+
+
+class LoadDriver:
+    def __init__(self, base_url: str, photos: list, closeups: list, refine_share: float = 0.2,
+                 users: int = 50, timeout: float = 120, jwt_secret: str = None):
+        self.base_url = base_url.rstrip("/")
+        self.photos = photos
+        self.closeups = closeups
+        self.refine_share = refine_share
+        self.users = [str(uuid.uuid4()) for _ in range(users)]
+        self.headers = {user: _session_headers(user, jwt_secret) for user in self.users}
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def one_request(self, rng: random.Random) -> dict:
+        """Send one request; returns {endpoint, kind, outcome, status, latency_ms, error}."""
+        user = rng.choice(self.users)
+        if rng.random() < self.refine_share:
+            endpoint, kind = "refine", "closeups"
+            part, damage = rng.choice(REFINE_TARGETS)
+            files = {name: (f"{name}.jpg", rng.choice(self.closeups), "image/jpeg")
+                     for name in ("file_left", "file_center", "file_right")}
+            data = {"damage_id": str(uuid.uuid4()), "part_name": part, "damage_type": damage}
+            url = f"{self.base_url}/analyze/refine"
+        else:
+            endpoint = "analyze"
+            kind, photo, _ = rng.choices(self.photos, weights=[share for _, _, share in self.photos])[0]
+            files = {"file": ("photo.jpg", photo, "image/jpeg")}
+            data = {"user_id": user, "car_name": rng.choice(["Maruti Swift", "Honda City", "BMW 3 Series"])}
+            url = f"{self.base_url}/analyze"
+
+        start = time.perf_counter()
+        record = {"endpoint": endpoint, "kind": kind, "status": None, "error": None}
+        try:
+            response = self._session().post(url, files=files, data=data, headers=self.headers[user],
+                                            timeout=self.timeout)
+            record["status"] = response.status_code
+            body = response.json() if response.headers.get("content-type", "").startswith("application/json") else {}
+            if response.status_code in (429, 503):
+                record["outcome"] = "busy"
+            elif response.status_code != 200:
+                record["outcome"], record["error"] = "error", f"HTTP {response.status_code}"
+            elif body.get("error") in GATE_ERRORS:
+                record["outcome"] = "rejected"
+            elif body.get("error") or body.get("status") == "error":
+                record["outcome"] = "error"
+                record["error"] = str(body.get("error") or body.get("message"))[:120]
+            else:
+                record["outcome"] = "ok"
+        except requests.RequestException as e:
+            record["outcome"], record["error"] = "error", type(e).__name__
+        record["latency_ms"] = (time.perf_counter() - start) * 1000
+        return record
+
+    def run_level(self, concurrency: int, duration_s: float, seed: int = 0) -> list:
+        """Closed loop: `concurrency` threads sending back to back for `duration_s`."""
+        deadline = time.perf_counter() + duration_s
+        records, lock = [], threading.Lock()
+
+        def client(index):
+            rng = random.Random(seed * 1000 + index)
+            while time.perf_counter() < deadline:
+                record = self.one_request(rng)
+                with lock:
+                    records.append(record)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(client, range(concurrency)))
+        return records
+
+
+def summarize(records: list, elapsed_s: float) -> dict:
+    """Throughput, latency percentiles (of completed requests) and outcome rates."""
+    total = len(records)
+    counts = {outcome: sum(r["outcome"] == outcome for r in records) for outcome in ("ok", "rejected", "busy", "error")}
+    served = [r["latency_ms"] for r in records if r["outcome"] in ("ok", "rejected")]
+    errors = {}
+    for r in records:
+        if r["error"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return {
+        "requests": total,
+        "throughput_rps": round(counts["ok"] / elapsed_s, 2) if elapsed_s else 0.0,
+        "p50_ms": round(_percentile(served, 50)) if served else None,
+        "p95_ms": round(_percentile(served, 95)) if served else None,
+        "p99_ms": round(_percentile(served, 99)) if served else None,
+        **{f"{outcome}_rate": round(count / total, 4) if total else 0.0 for outcome, count in counts.items()},
+        "errors": errors,
+    }
+
+
+def run_sweep(base_url: str, concurrency_levels: list, duration_s: float = 30, refine_share: float = 0.2,
+              image_dir: str = None, users: int = 50, warmup: int = 3, output: str = None,
+              jwt_secret: str = None) -> list:
+    """Drive every concurrency level in turn and print one row per level and endpoint."""
+    photos, closeups = build_image_mix(image_dir)
+    driver = LoadDriver(base_url, photos, closeups, refine_share, users, jwt_secret=jwt_secret)
+    rng = random.Random(0)
+    for _ in range(warmup):
+        driver.one_request(rng)
+
+    rows = []
+    print(f"{'conc':>4} {'endpoint':<8} {'reqs':>5} {'ok/s':>6} {'p50':>7} {'p95':>7} {'p99':>7} "
+          f"{'rejected':>8} {'busy':>6} {'errors':>6}")
+    for level, concurrency in enumerate(concurrency_levels):
+        start = time.perf_counter()
+        records = driver.run_level(concurrency, duration_s, seed=level + 1)
+        elapsed = time.perf_counter() - start
+        first = len(rows)
+        for endpoint in ("all", "analyze", "refine"):
+            subset = records if endpoint == "all" else [r for r in records if r["endpoint"] == endpoint]
+            if not subset:
+                continue
+            row = {"concurrency": concurrency, "endpoint": endpoint, **summarize(subset, elapsed)}
+            rows.append(row)
+            print(f"{concurrency:>4} {endpoint:<8} {row['requests']:>5} {row['throughput_rps']:>6.2f} "
+                  f"{row['p50_ms'] or 0:>6}ms {row['p95_ms'] or 0:>6}ms {row['p99_ms'] or 0:>6}ms "
+                  f"{row['rejected_rate']:>8.1%} {row['busy_rate']:>6.1%} {row['error_rate']:>6.1%}")
+        top_errors = sorted(rows[first]["errors"].items(), key=lambda item: -item[1])[:3]
+        if top_errors:
+            print(f"     ⚠️ top errors: {top_errors}")
+
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+        print(f"🗂️ Wrote {output}")
+    return rows
@@ -0,0 +1,248 @@
+# loadtest/fake_supabase.py
+"""
+In-memory stand-in for the parts of Supabase the backend calls, served on
+localhost so the real supabase-py client talks to it unchanged
+(SUPABASE_URL=http://127.0.0.1:<port>):
+
+- Storage: POST/PUT /storage/v1/object/<bucket>/<key> (multipart upload),
+  GET /storage/v1/object/public/<bucket>/<key>
+- PostgREST: /rest/v1/<table> with GET (filters, order, limit), POST
+  (insert, or upsert by id with Prefer: resolution=merge-duplicates),
+  PATCH and DELETE. Filters: eq, neq, lt, lte, gt, gte, is, in and or=(...)
+  with nested and(...), which covers every query in utils/supabase_client.py.
+- GET /_fake/stats: request and row counts (for load-test reports)
+
+FAKE_SUPABASE_LATENCY_MS adds a delay per request, to model the network
+round trip to a hosted project. Nothing is persisted.
+
+    python -m loadtest fake-supabase --port 54329
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+FAKE_SUPABASE_LATENCY_MS = float(os.getenv("FAKE_SUPABASE_LATENCY_MS", "0"))
+
+_lock = threading.Lock()
+_objects = {}   # "bucket/key" -> (content type, bytes)
+_tables = {}    # table -> {id: row}
+_counts = {}
+
+
+def _count(name: str):
+    _counts[name] = _counts.get(name, 0) + 1
+
+
+def stats() -> dict:
+    with _lock:
+        return {"requests": dict(_counts),
+                "objects": len(_objects),
+                "object_mb": round(sum(len(data) for _, data in _objects.values()) / (1 << 20), 1),
+                "rows": {table: len(rows) for table, rows in _tables.items()}}
+
+
+# --- POSTGREST FILTERS ---
+
+def _split_terms(text: str) -> list:
+    """Split 'a,and(b,c),"x,y"' on top-level commas."""
+    terms, depth, quoted, current = [], 0, False, ""
+    for char in text:
+        if char == '"':
+            quoted = not quoted
+        elif not quoted and char == "(":
+            depth += 1
+        elif not quoted and char == ")":
+            depth -= 1
+        elif not quoted and depth == 0 and char == ",":
+            terms.append(current)
+            current = ""
+            continue
+        current += char
+    return terms + [current] if current else terms
+
+
+def _compare(value, op: str, operand: str) -> bool:
+    operand = operand.strip('"')
+    if op == "is":
+        return value is None if operand == "null" else str(value).lower() == operand
+    if op == "in":
+        return str(value) in [item.strip('"') for item in _split_terms(operand.strip("()"))]
+    if value is None:
+        return False
+    if op in ("eq", "neq"):
+        return (str(value) == operand) == (op == "eq")
+    try:
+        left, right = float(value), float(operand)
+    except (TypeError, ValueError):
+        left, right = str(value), operand  # ISO timestamps and uuids order as strings
+    return {"lt": left < right, "lte": left <= right, "gt": left > right, "gte": left >= right}[op]
+
+
+def _parse_condition(column: str, expression: str):
+    """Predicate for 'col=op.value' (or a logical 'or=(...)' / 'and=(...)')."""
+    if column in ("or", "and"):
+        parts = [_parse_term(term) for term in _split_terms(expression.strip()[1:-1])]
+        return (lambda row: any(p(row) for p in parts)) if column == "or" \
+            else (lambda row: all(p(row) for p in parts))
+    negate = expression.startswith("not.")
+    op, _, operand = expression[4 if negate else 0:].partition(".")
+    if op not in ("eq", "neq", "lt", "lte", "gt", "gte", "is", "in"):
+        raise ValueError(f"Unsupported filter operator '{op}'")
+    return lambda row: _compare(row.get(column), op, operand) != negate
+
+
+def _parse_term(term: str):
+    """'col.op.value' or 'and(...)' / 'or(...)' inside a logical filter."""
+    match = re.match(r"^(and|or)\((.*)\)$", term)
+    if match:
+        return _parse_condition(match.group(1), f"({match.group(2)})")
+    column, _, expression = term.partition(".")
+    return _parse_condition(column, expression)
+
+
+def _select(table: str, params: list) -> list:
+    predicates, order, limit = [], [], None
+    for key, value in params:
+        if key == "order":
+            order = [item.split(".") for item in value.split(",")]
+        elif key == "limit":
+            limit = int(value)
+        elif key not in ("select", "columns", "on_conflict", "offset"):
+            predicates.append(_parse_condition(key, value))
+    rows = [row for row in _tables.get(table, {}).values() if all(p(row) for p in predicates)]
+    for column, *direction in reversed(order):
+        rows.sort(key=lambda row: (row.get(column) is None, str(row.get(column))),
+                  reverse="desc" in direction)
+    return rows[:limit] if limit is not None else rows
+
+
+# --- HTTP ---
+
+def _multipart_file(body: bytes, content_type: str):
+    """(content type, contents) of the 'file' part of a multipart/form-data body."""
+    boundary = content_type.split("boundary=", 1)[1].strip('"').encode()
+    for part in body.split(b"--" + boundary):
+        head, _, data = part.partition(b"\r\n\r\n")
+        if b'name="file"' in head:
+            match = re.search(rb"content-type:\s*([^\r\n]+)", head, re.IGNORECASE)
+            part_type = match.group(1).decode() if match else "application/octet-stream"
+            return part_type, data[:-2] if data.endswith(b"\r\n") else data
+    raise ValueError("No file part")
+
+
+class FakeSupabaseHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass  # One line per request would drown the load-test output
+
+    def _reply(self, status: int, payload=None, content_type: str = "application/json", body: bytes = None):
+        if body is None:
+            body = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _handle(self, method: str):
+        if FAKE_SUPABASE_LATENCY_MS:
+            time.sleep(FAKE_SUPABASE_LATENCY_MS / 1000)
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        params = parse_qsl(url.query, keep_blank_values=True)
+        body = self._body() if method in ("POST", "PUT", "PATCH") else b""
+        try:
+            if path == "/_fake/stats":
+                return self._reply(200, stats())
+            if path.startswith("/storage/v1/object/"):
+                return self._storage(method, path[len("/storage/v1/object/"):], body)
+            if path.startswith("/rest/v1/"):
+                return self._rest(method, path[len("/rest/v1/"):], params, body)
+            self._reply(404, {"message": f"No fake for {path}"})
+        except (ValueError, KeyError) as e:
+            self._reply(400, {"message": str(e)})
+
+    def _storage(self, method: str, path: str, body: bytes):
+        if method == "GET" and path.startswith("public/"):
+            with _lock:
+                _count("storage_download")
+                stored = _objects.get(path[len("public/"):])
+            if stored is None:
+                return self._reply(404, {"message": "Object not found"})
+            return self._reply(200, content_type=stored[0], body=stored[1])
+        if method in ("POST", "PUT"):
+            content_type = self.headers.get("Content-Type", "")
+            if content_type.startswith("multipart/"):
+                content_type, data = _multipart_file(body, content_type)
+            else:
+                data = body
+            with _lock:
+                _count("storage_upload")
+                if method == "POST" and path in _objects and self.headers.get("x-upsert") != "true":
+                    return self._reply(409, {"message": "The resource already exists"})
+                _objects[path] = (content_type, data)
+            return self._reply(200, {"Key": path})
+        self._reply(405, {"message": "Method not allowed"})
+
+    def _rest(self, method: str, table: str, params: list, body: bytes):
+        prefer = self.headers.get("Prefer", "")
+        with _lock:
+            _count(f"{table}.{method.lower()}")
+            rows = _tables.setdefault(table, {})
+            if method == "GET":
+                return self._reply(200, _select(table, params))
+            if method == "POST":
+                payload = json.loads(body or b"[]")
+                records = payload if isinstance(payload, list) else [payload]
+                merge = "resolution=merge-duplicates" in prefer
+                for record in records:
+                    key = record.get("id") or f"row-{len(rows)}"
+                    if key in rows and not merge:
+                        return self._reply(409, {"message": "duplicate key value violates unique constraint"})
+                    rows[key] = {**rows.get(key, {}), **record}
+                return self._reply(201, records if "return=representation" in prefer else None)
+            if method in ("PATCH", "DELETE"):
+                matched = _select(table, params)
+                if method == "PATCH":
+                    update = json.loads(body or b"{}")
+                    for row in matched:
+                        row.update(update)
+                else:
+                    for row in matched:
+                        rows.pop(row.get("id"), None)
+                return self._reply(200, matched if "return=representation" in prefer else None)
+        self._reply(405, {"message": "Method not allowed"})
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+def serve(host: str = "127.0.0.1", port: int = 54329):
+    server = ThreadingHTTPServer((host, port), FakeSupabaseHandler)
+    server.daemon_threads = True
+    print(f"🗄️ Fake Supabase on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,136 @@
+# loadtest/stub_models.py
+"""
+Stand-ins for the YOLO models and the depth pipeline.
+
+They take the same calls and return results of the same shape as the real
+models (inference_client's numpy-backed YOLO results, depth dicts), spend
+a configurable time per call and produce plausible, deterministic output:
+parts spanning the car, 0-3 damage boxes per image, a bowl-shaped depth
+map. Good enough to exercise every stage after inference at realistic
+rates; not a model.
+
+Latency per call scales like the real thing: YOLO with the number of
+images and the input area (STUB_YOLO_MS is per 640x640 image), depth with
+the number of images. STUB_CPU_BOUND=true burns that time in BLAS matmuls
+(contending for this worker's cores like inference would) instead of sleeping.
+"""
+
+import os
+import time
+import zlib
+
+import numpy as np
+
+STUB_YOLO_MS = float(os.getenv("STUB_YOLO_MS", "60"))
+STUB_DEPTH_MS = float(os.getenv("STUB_DEPTH_MS", "80"))
+# +/- share of random variation around each latency
+STUB_JITTER = float(os.getenv("STUB_JITTER", "0.2"))
+STUB_CPU_BOUND = os.getenv("STUB_CPU_BOUND", "false").lower() == "true"
+# Share of images the parts stub finds no car in (exercises the vehicle gate)
+STUB_NO_VEHICLE_RATE = float(os.getenv("STUB_NO_VEHICLE_RATE", "0.05"))
+
+PARTS_NAMES = {0: "front_door", 1: "rear_door", 2: "front_bumper", 3: "hood", 4: "fender", 5: "windshield"}
+DAMAGE_NAMES = {0: "dent", 1: "scratch", 2: "crack", 3: "glass shatter"}
+
+_rng = np.random.default_rng()
+_burn = np.ones((256, 256), dtype=np.float32)
+
+
+def spend(ms: float):
+    """Take about `ms` milliseconds (jittered), asleep or busy."""
+    ms *= 1 + STUB_JITTER * (2 * _rng.random() - 1)
+    deadline = time.perf_counter() + ms / 1000
+    if not STUB_CPU_BOUND:
+        time.sleep(max(ms, 0) / 1000)
+        return
+    while time.perf_counter() < deadline:
+        np.dot(_burn, _burn)
+
+
+def _image_rng(image) -> np.random.Generator:
+    """RNG seeded by a sparse sample of the pixels: the same photo gets the same boxes."""
+    sample = np.ascontiguousarray(np.asarray(image)[::53, ::53])
+    return np.random.default_rng(zlib.crc32(sample.tobytes()))
+
+
+class StubYOLO:
+    """Callable like an ultralytics YOLO model ('parts' or 'damage')."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.names = PARTS_NAMES if kind == "parts" else DAMAGE_NAMES
+        self.overrides = {"imgsz": 640}
+
+    def __call__(self, source, imgsz=None, conf=None, iou=None, verbose=False):
+        from inference_client import RemoteResult
+
+        images = source if isinstance(source, list) else [source]
+        side = imgsz or self.overrides["imgsz"]
+        spend(STUB_YOLO_MS * len(images) * (side / 640) ** 2)
+        results = []
+        for image in images:
+            h, w = image.shape[:2]
+            boxes = self._boxes(_image_rng(image), w, h)
+            if conf is not None:
+                boxes = boxes[boxes[:, 4] >= conf]
+            results.append(RemoteResult(boxes, self.names, (h, w)))
+        return results
+
+    def _boxes(self, rng, w, h) -> np.ndarray:
+        if self.kind == "parts":
+            if rng.random() < STUB_NO_VEHICLE_RATE:
+                return np.zeros((0, 6), dtype=np.float32)
+            # Three panels side by side across the middle of the frame
+            edges = np.linspace(0.1, 0.9, 4) * w
+            classes = rng.choice(len(self.names), size=3, replace=False)
+            return np.array([[edges[i], 0.3 * h, edges[i + 1], 0.8 * h, rng.uniform(0.6, 0.95), classes[i]]
+                             for i in range(3)], dtype=np.float32)
+
+        boxes = []
+        for _ in range(rng.integers(0, 4)):
+            bw, bh = rng.uniform(0.05, 0.2) * w, rng.uniform(0.05, 0.2) * h
+            x1, y1 = rng.uniform(0.1 * w, 0.9 * w - bw), rng.uniform(0.3 * h, 0.8 * h - bh)
+            boxes.append([x1, y1, x1 + bw, y1 + bh, rng.uniform(0.3, 0.95), rng.integers(0, len(self.names))])
+        return np.array(boxes, dtype=np.float32).reshape(-1, 6)
+
+
+class StubDepthEstimator:
+    """Callable like the transformers depth pipeline (one PIL image or a list)."""
+
+    def __call__(self, inputs, batch_size=None):
+        single = not isinstance(inputs, list)
+        images = [inputs] if single else inputs
+        spend(STUB_DEPTH_MS * len(images))
+        outputs = []
+        for image in images:
+            w, h = image.size
+            y, x = np.ogrid[:h, :w]
+            bowl = 1 - ((x / max(w - 1, 1) - 0.5) ** 2 + (y / max(h - 1, 1) - 0.5) ** 2) * 2
+            outputs.append({"depth": (bowl.clip(0, 1) * 255).astype(np.uint8),
+                            "predicted_depth": bowl.astype(np.float32)})
+        return outputs[0] if single else outputs
+
+
+def install():
+    """Use the stubs in this process (INFERENCE_MODE=stub)."""
+    import depth_service
+    import detection_service
+
+    detection_service.set_models(StubYOLO("parts"), StubYOLO("damage"))
+    depth_service.set_depth_estimator(StubDepthEstimator())
+    print(f"🧪 Stub models: YOLO {STUB_YOLO_MS:.0f}ms/640px image, depth {STUB_DEPTH_MS:.0f}ms/image"
+          f"{' (CPU-bound)' if STUB_CPU_BOUND else ''}")
+
+
+def serve(host: str = "127.0.0.1", port: int = 9100):
+    """Stub inference server: inference_server.py's RPC with the stubs behind it."""
+    os.environ["INFERENCE_MODE"] = "stub"  # depth_service must not load the real model
+    import inference_server
+
+    install()
+    with inference_server.InferenceServer((host, port), inference_server.InferenceHandler) as server:
+        print(f"🧠 Stub inference server on {host}:{port} (pid {os.getpid()})")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
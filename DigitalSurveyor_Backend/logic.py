@@ -1,20 +1,17 @@
 # logic.py
 from shapely.geometry import box
-from utils import encode_image_to_base64, generate_heatmap
-from depth_service import analyze_dent_depth
+from utils import calculate_severities, generate_heatmap
+from utils.core import SCRATCH_SEVERITY_MODE
+from depth_service import (
+    analyze_dent_depth_batch, analyze_dents_in_frame, estimate_frame_depth_batch,
+    DEPTH_MODE, DEPTH_FRAME_MAX_SIDE
+)
+from utils.image_context import as_context
+from utils import tracing
+from resource_manager import cpu_stage
+from pricing_service import get_engine
 import cv2
 
-# --- PRICING DATABASE (Base Prices) ---
-PRICES = {
-    "door": {"dent": 200, "scratch": 150, "replace": 900},
-    "bumper": {"dent": 180, "scratch": 120, "replace": 600},
-    "fender": {"dent": 180, "scratch": 140, "replace": 500},
-    "hood": {"dent": 300, "scratch": 200, "replace": 1100},
-    "glass": {"shatter": 400, "crack": 300, "replace": 600},
-    "unknown": {"dent": 100, "scratch": 80, "replace": 350}
-}
-
-
 def correct_damage_label(damage_type, box_coords, severity):
     """
     Correct damage labels based on geometry (aspect ratio) and severity.
@@ -67,7 +64,7 @@ def correct_damage_label(damage_type, box_coords, severity):
 
 def determine_action(severity_score, damage_type, part_name):
     """
-    Dynamically determine repair action based on severity, damage type, and part.
+    Determine the repair action for a single damage (see pricing_config.json).
     
     Args:
         severity_score: int (0-100)
@@ -76,138 +73,187 @@ def determine_action(severity_score, damage_type, part_name):
     
     Returns:
         dict: {"action": str, "base_cost": int}
-    
-    Action Categories:
-        - Buffing & Polishing (₹1,500-3,000): Light scratches, score 0-25
-        - Denting & Painting (₹4,000-8,000): Minor dents, score 26-55
-        - Sheet Metal Repair (₹8,000-15,000): Deep dents, score 56-75
-        - Part Replacement (₹12,000-50,000): Severe damage, score 76+
     """
-    damage_type = damage_type.lower()
-    part_name = part_name.lower()
-    
-    # --- CONTEXT-AWARE OVERRIDES ---
-    
-    # Override 1: Glass damage ALWAYS requires replacement
-    if part_name == "glass" or any(glass_type in damage_type for glass_type in ["crack", "shatter", "smash"]):
-        return {
-            "action": "Windshield Replacement",
-            "base_cost": 12000  # ₹12,000
-        }
+    priced = get_engine().price([part_name], [damage_type], [severity_score])
+    return {"action": priced["action"][0], "base_cost": int(priced["base_cost"][0])}
+
+
+def clean_label(label):
+    """Normalize a YOLO part label to a pricing part name."""
+    return get_engine().canonical_part(label)
+
+
+def parse_damage_detections(damage_results):
+    """Extract [{"name", "coords"}] from a YOLO damage result."""
+    damages_detected = []
+    if damage_results[0].boxes:
+        for box_data in damage_results[0].boxes:
+            damages_detected.append({
+                "name": damage_results[0].names[int(box_data.cls[0])],
+                "coords": box_data.xyxy[0].tolist()
+            })
+    return damages_detected
+
+
+def collect_dent_crops(damage_results, full_image):
+    """
+    Find the dent crops that need depth analysis.
     
-    # Override 2: Bumper with high severity requires replacement (plastic is hard to repair)
-    if part_name == "bumper" and severity_score > 60:
-        return {
-            "action": "Bumper Replacement",
-            "base_cost": 15000  # ₹15,000
-        }
+    Returns:
+        (indices, crops): positions in parse_damage_detections() order and
+        the matching BGR crops, ready for analyze_dent_depth_batch()
+    """
+    indices, crops = [], []
+    for idx, damage in enumerate(parse_damage_detections(damage_results)):
+        if "dent" not in damage['name'].lower():
+            continue
+        x1, y1, x2, y2 = map(int, damage['coords'])
+        dent_crop = full_image[y1:y2, x1:x2]
+        if dent_crop.size > 0:
+            indices.append(idx)
+            crops.append(dent_crop)
+    return indices, crops
+
+
+@tracing.span("depth")
+def compute_dent_depth(damage_results_list, images, mode=None):
+    """
+    Depth-analyze the dents of one or more images.
     
-    # --- SEVERITY-BASED THRESHOLDS ---
+    Args:
+        damage_results_list: One YOLO damage result list per image
+        images: The matching BGR images or ImageContexts
+        mode: 'crop' (all dent crops in one batched call) or 'frame' (one
+              pass per image with dents on a downscaled full frame, each dent
+              sliced from that map); defaults to DEPTH_MODE
     
-    if severity_score <= 25:
-        # Light damage - just cosmetic work needed
-        return {
-            "action": "Buffing & Polishing",
-            "base_cost": 2000  # ₹2,000
-        }
+    Returns:
+        One {damage index: analyze_dent_depth result} dict per image
+    """
+    mode = mode or DEPTH_MODE
+    tracing.annotate(mode=mode)
+    contexts = [as_context(image) for image in images]
+    per_image = [{} for _ in contexts]
     
-    elif severity_score <= 55:
-        # Moderate damage - needs dent removal and repainting
-        return {
-            "action": "Denting & Painting",
-            "base_cost": 6000  # ₹6,000
-        }
+    dents = []  # (image position, damage indices, boxes)
+    for img_pos, damage_results in enumerate(damage_results_list):
+        detections = parse_damage_detections(damage_results)
+        indices = [idx for idx, d in enumerate(detections) if "dent" in d['name'].lower()]
+        if indices:
+            dents.append((img_pos, indices, [detections[idx]['coords'] for idx in indices]))
+    if not dents:
+        return per_image
     
-    elif severity_score <= 75:
-        # Severe damage - requires sheet metal work
-        return {
-            "action": "Sheet Metal Repair",
-            "base_cost": 12000  # ₹12,000
-        }
+    if mode == "frame":
+        # The depth map is kept on the context for the rest of the request
+        missing = [img_pos for img_pos, _, _ in dents if contexts[img_pos].depth is None]
+        if missing:
+            print(f"🧠 Running Frame Depth Analysis on {len(missing)} image(s)...")
+            frame_depths = estimate_frame_depth_batch(
+                [contexts[i].resized(DEPTH_FRAME_MAX_SIDE) for i in missing],
+                [contexts[i].shape for i in missing])
+            for img_pos, frame_depth in zip(missing, frame_depths):
+                contexts[img_pos].depth = frame_depth
+        for img_pos, indices, boxes in dents:
+            ctx = contexts[img_pos]
+            results = analyze_dents_in_frame(ctx.depth, ctx.image, boxes, encode=False)
+            per_image[img_pos].update(zip(indices, results))
+        return per_image
     
-    else:  # severity_score > 75
-        # Critical damage - replacement needed
-        part_replacement_costs = {
-            "door": 18000,
-            "bumper": 15000,
-            "fender": 14000,
-            "hood": 25000,
-            "unknown": 20000
-        }
-        return {
-            "action": "Part Replacement",
-            "base_cost": part_replacement_costs.get(part_name, 20000)
-        }
-
-
-def clean_label(label):
-    label = label.lower()
-    if "door" in label:
-        return "door"
-    if "bumper" in label:
-        return "bumper"
-    if "fender" in label:
-        return "fender"
-    if "hood" in label:
-        return "hood"
-    if "glass" in label or "windshield" in label:
-        return "glass"
-    return "unknown"
+    crop_owners, all_crops = [], []
+    for img_pos, damage_results in enumerate(damage_results_list):
+        indices, crops = collect_dent_crops(damage_results, contexts[img_pos].image)
+        crop_owners.extend((img_pos, damage_idx) for damage_idx in indices)
+        all_crops.extend(crops)
+    if all_crops:
+        print(f"🧠 Running Deep Learning Depth Analysis for {len(all_crops)} dent(s)...")
+    for (img_pos, damage_idx), result in zip(crop_owners, analyze_dent_depth_batch(all_crops, encode=False)):
+        per_image[img_pos][damage_idx] = result
+    return per_image
 
 
-def process_damage(parts_results, damage_results, full_image, price_multiplier=1.0):
+@tracing.span("process_damage")
+def process_damage(parts_results, damage_results, full_image, price_multiplier=1.0, depth_results=None,
+                   depth_mode=None):
+    """
+    Turn YOLO part/damage detections into priced damages.
+    
+    depth_results: optional {damage index: analyze_dent_depth result} computed
+    by the caller (e.g. batched across several images). When omitted, the
+    dents of this image are analyzed with compute_dent_depth(depth_mode).
+    Other damages are scored from image texture, all boxes against one
+    Laplacian pass (utils.calculate_severities); full_image may be an
+    ImageContext to reuse its gray view.
+    """
+    ctx = as_context(full_image)
+    full_image = ctx.image
     damages_list = []
     total_cost = 0
+    # One engine version prices the whole scan, even if the config reloads mid-request
+    pricing = get_engine()
 
     # 1. Parse Detected Parts
     parts_detected = []
     if parts_results[0].boxes:
         for box_data in parts_results[0].boxes:
+            label = parts_results[0].names[int(box_data.cls[0])]
             parts_detected.append({
-                "name": clean_label(parts_results[0].names[int(box_data.cls[0])]),
+                "name": pricing.canonical_part(label),
+                "label": label,  # Raw YOLO label: keeps front/rear, left/right apart
                 "coords": box_data.xyxy[0].tolist()
             })
 
     # 2. Parse Detected Damages
-    damages_detected = []
-    if damage_results[0].boxes:
-        for box_data in damage_results[0].boxes:
-            damages_detected.append({
-                "name": damage_results[0].names[int(box_data.cls[0])],
-                "coords": box_data.xyxy[0].tolist()
-            })
+    damages_detected = parse_damage_detections(damage_results)
+
+    # 2b. Depth-analyze all dents (batched crops or one frame pass)
+    if depth_results is None:
+        depth_results = compute_dent_depth([damage_results], [ctx], depth_mode)[0]
+
+    # 2c. Texture severity for every non-dent box at once
+    texture_severity = {}
+    if SCRATCH_SEVERITY_MODE == "texture":
+        others = [idx for idx, d in enumerate(damages_detected) if "dent" not in d['name'].lower()]
+        with tracing.span("severity", boxes=len(others)), cpu_stage("opencv"):
+            scores = calculate_severities(ctx, [damages_detected[idx]['coords'] for idx in others])
+        texture_severity = dict(zip(others, scores))
 
     # 3. Process Each Damage Individually
-    for damage in damages_detected:
+    for damage_idx, damage in enumerate(damages_detected):
         best_part = "unknown"
+        best_part_box = None
+        best_part_label = None
         max_overlap = 0
         damage_coords = damage['coords']
         damage_type = damage['name'].lower()
 
         # --- A. CALCULATE SEVERITY (Hybrid Approach) ---
+        # Heatmaps stay as raw arrays here; the API encodes them according
+        # to the requested response mode (see utils.response_encoding).
         severity = 50
-        heatmap_base64 = None
+        # Severity the geometry correction sees: depth for dents, else the
+        # neutral 50 (texture scores aren't calibrated to relabel damage)
+        geometry_severity = 50
+        heatmap_image = None
+        heatmap_is_crop = False
         
         # DENTS: Use Deep Learning Depth Analysis
         if "dent" in damage_type:
-            x1, y1, x2, y2 = map(int, damage_coords)
-            dent_crop = full_image[y1:y2, x1:x2]
-            
-            if dent_crop.size > 0:
-                print(f"🧠 Running Deep Learning Depth Analysis for dent...")
-                depth_result = analyze_dent_depth(dent_crop)
-                severity = depth_result['severity']
-                heatmap_base64 = depth_result['heatmap']
+            depth_result = depth_results.get(damage_idx)
+            if depth_result:
+                severity = geometry_severity = depth_result['severity']
+                heatmap_image = depth_result['overlay']
+                heatmap_is_crop = True
         
-        # SCRATCHES: Use fixed moderate severity (contrast detection removed to prevent false positives)
+        # SCRATCHES etc.: Laplacian-variance texture score (50 in 'fixed' mode)
         else:
-            severity = 50  # Default moderate severity
+            severity = texture_severity.get(damage_idx, 50)
             # Generate professional heatmap with ellipses and soft alpha blending
-            heatmap_image = generate_heatmap(full_image, [{
-                'box': damage_coords,
-                'severity': severity
-            }])
-            heatmap_base64 = encode_image_to_base64(heatmap_image)
+            with tracing.span("heatmap", damage_index=damage_idx), cpu_stage("opencv"):
+                heatmap_image = generate_heatmap(full_image, [{
+                    'box': damage_coords,
+                    'severity': severity
+                }])
 
         # --- B. FIND THE PART (IoU Calculation) ---
         # --- B. FIND THE PART (IoU & Centroid) ---
@@ -231,6 +277,8 @@ def process_damage(parts_results, damage_results, full_image, price_multiplier=1
                 if coverage > max_overlap:
                     max_overlap = coverage
                     best_part = part['name']
+                    best_part_box = part['coords']
+                    best_part_label = part['label']
         
         # 2. Fallback: Centroid Check (if still unknown)
         if best_part == "unknown" and parts_detected:
@@ -239,6 +287,8 @@ def process_damage(parts_results, damage_results, full_image, price_multiplier=1
                 # Check if centroid is strictly inside part box
                 if px1 <= dx_center <= px2 and py1 <= dy_center <= py2:
                     best_part = part['name']
+                    best_part_box = part['coords']
+                    best_part_label = part['label']
                     print(f"🧩 Centroid Fallback: Found {best_part} for damage at {damage_coords}")
                     break
         
@@ -247,33 +297,42 @@ def process_damage(parts_results, damage_results, full_image, price_multiplier=1
              print(f"⚠️ Part not found. Damage Box: {damage_coords} | Parts Avail: {[p['name'] for p in parts_detected]}")
 
         # --- GEOMETRY CORRECTION ---
-        damage_type = correct_damage_label(damage_type, damage_coords, severity)
-
-        # --- C. DECISION LOGIC (Dynamic Action Determination) ---
-        action_result = determine_action(severity, damage_type, best_part)
-        action = action_result["action"]
-        base_cost = action_result["base_cost"]
-        
-        # Apply price multiplier (e.g., regional pricing, premium parts)
-        final_cost = base_cost * price_multiplier
-        total_cost += final_cost
-        
-        # Debug logging
-        print(f"📋 {damage_type.title()} on {best_part.title()} | Severity: {severity} | Action: {action} | Cost: ₹{final_cost:,.0f}")
+        damage_type = correct_damage_label(damage_type, damage_coords, geometry_severity)
 
-        # --- E. ADD TO INDIVIDUAL DAMAGES LIST ---
+        # --- C. ADD TO INDIVIDUAL DAMAGES LIST (priced below, all at once) ---
         damages_list.append({
             "type": damage_type.title(),
             "severity": severity,
-            "cost": round(final_cost, 2),
+            "cost": 0,
             "box": [int(c) for c in damage_coords],
             "part": best_part.title(),
-            "action": action,
-            "heatmap": heatmap_base64
+            "action": None,
+            "heatmap": None,
+            # Private keys, stripped by encode_damage_heatmaps() before the
+            # damages are serialized or stored
+            "_heatmap_image": heatmap_image,
+            "_heatmap_is_crop": heatmap_is_crop,
+            "_part_box": best_part_box,
+            "_part_label": best_part_label
         })
 
+    # --- D. DECISION LOGIC (one vectorized pricing call for the whole scan) ---
+    # price_multiplier covers brand/regional pricing (pricing_service.price_multiplier)
+    priced = pricing.price(
+        [d["part"] for d in damages_list],
+        [d["type"] for d in damages_list],
+        [d["severity"] for d in damages_list],
+        multiplier=price_multiplier
+    )
+    for damage, action, final_cost in zip(damages_list, priced["action"], priced["cost"]):
+        damage["action"] = action
+        damage["cost"] = round(float(final_cost), 2)
+        total_cost += float(final_cost)
+        print(f"📋 {damage['type']} on {damage['part']} | Severity: {damage['severity']} | Action: {action} | Cost: ₹{final_cost:,.0f}")
+
     return {
         "damages": damages_list,
         "total_estimate": round(total_cost, 2),
-        "currency": "INR"
+        "currency": pricing.currency,
+        "pricing_version": pricing.version
     }
\ No newline at end of file
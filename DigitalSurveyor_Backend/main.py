@@ -1,22 +1,65 @@
 # main.py
-from fastapi import FastAPI, File, UploadFile, Form
+# Thread budgets must be applied before torch/OpenCV/NumPy create their pools
+import resource_manager
+resource_manager.configure_process()
+
+from fastapi import FastAPI, File, UploadFile, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from ultralytics import YOLO
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, Response, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from typing import List, Optional
 import cv2
 import numpy as np
 import os
-from logic import process_damage
+import uuid
+import asyncio
+import threading
+import time
+from logic import process_damage, compute_dent_depth
+from depth_service import DEPTH_MODES, DEPTH_MODE
+from walkaround_logic import merge_walkaround_damages
+from video_service import select_keyframes, MAX_KEYFRAMES
 from quality_service import validate_image_quality
+import detection_service
+import inference_client
+from inference_client import INFERENCE_MODE, InferenceUnavailable
+from detection_service import run_parts_model, check_vehicle_presence, smart_detect, smart_detect_batch
 from averaging_logic import calculate_average_verdict, get_part_base_cost
-from utils.supabase_client import (
-    upload_to_storage, insert_scan_record, create_damage_records,
-    update_damage_refinement
+from utils.supabase_client import build_scan_record, build_damage_records, update_damage_refinement
+from utils import storage
+from utils.storage import upload_to_storage
+import report_service
+from report_service import get_or_render_report, prerender_report, render_reports, REPORT_BATCH_MAX_SCANS
+from utils.pdf_generator import shutdown_batch_pool
+from pricing_service import get_engine as get_pricing_engine
+import scan_history_service
+from outbox_service import OutboxBatch, get_outbox
+from admission_service import get_admission, AdmissionRejected
+from overlay_service import (
+    OVERLAY_VIEWS, OVERLAY_SIZES, detection_record, overlay_urls, remember_scan, scan_owner,
+    get_or_render_overlay
+)
+from utils.response_encoding import (
+    HEATMAP_MODES, encode_damage_heatmaps, build_analyze_response
 )
-from utils.pdf_generator import create_damage_report
+from utils import auth, metrics, tracing
+from utils.image_context import ImageContext
+from utils.deadline import RequestScope, RequestCancelled
+from utils.image_variants import stage_image_variants, IMAGE_VARIANT_FORMAT
 
 app = FastAPI()
 
+BACKEND_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:8000")
+# Render the PDF in the background right after a scan instead of on first download
+PDF_PRERENDER = os.getenv("PDF_PRERENDER", "false").lower() == "true"
+# Upper bound on photos accepted by /analyze/walkaround
+MAX_WALKAROUND_IMAGES = int(os.getenv("MAX_WALKAROUND_IMAGES", "12"))
+# Upper bound on uploaded walkaround video size
+MAX_VIDEO_MB = int(os.getenv("MAX_VIDEO_MB", "200"))
+# How often a running request checks whether its client is still connected
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.5"))
+
 # --- 1. CORS ---
 app.add_middleware(
     CORSMiddleware,
@@ -24,361 +67,644 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[tracing.TRACE_HEADER, "Server-Timing"],
 )
 
+# Compress JSON responses (base64 heatmaps shrink noticeably)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# Per-request trace: X-Trace-Id on every response, Server-Timing in debug mode
+app.add_middleware(tracing.TraceMiddleware)
+
 # --- 2. DIRECTORIES ---
+# Scratch space for uploads being processed (stored artifacts live in utils.storage)
 os.makedirs("analyzed_images", exist_ok=True)
 
-# --- 3. SERVE STATIC FILES ---
-app.mount("/analyzed", StaticFiles(directory="analyzed_images"), name="analyzed")
+# --- 3. SERVE STORED ARTIFACTS ---
+# STORAGE_BACKEND=local serves them at /artifacts (see get_artifact)
 
 # --- 4. LOAD MODELS ---
-model_parts = None
-model_damage = None
+# Gateway mode: models live on inference servers (inference_server.py)
+if INFERENCE_MODE == "gateway":
+    inference_client.connect_gateway()
+elif not detection_service.models_loaded():  # Set already when embedded (loadtest.app's stubs)
+    detection_service.load_models()
+
 
-print("------------------------------------------------")
-print("🚀 STARTING AI ENGINE...")
+def get_price_multiplier(car_name, region=None):
+    """Luxury/regional pricing: brand parsed from car_name, region from the request."""
+    return get_pricing_engine().price_multiplier(car_name, region)
 
-if os.path.exists("parts.pt"):
-    model_parts = YOLO('parts.pt')
-    print("✅ SUCCESS: 'parts.pt' loaded.")
-else:
-    print("⚠️ WARNING: 'parts.pt' missing.")
 
-if os.path.exists("damage.pt"):
-    model_damage = YOLO('damage.pt')
-    print("✅ SUCCESS: 'damage.pt' loaded.")
-else:
-    print("⚠️ WARNING: 'damage.pt' missing.")
-print("------------------------------------------------")
+def decode_image(contents):
+    """BGR image from uploaded bytes, or None if it can't be decoded."""
+    try:
+        return cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+    except Exception:
+        return None  # Reported per image by the quality gate
+
 
+def busy_response(rejected):
+    """429/503 for a request turned away by admission control."""
+    return JSONResponse(status_code=rejected.status_code,
+                        headers={"Retry-After": str(rejected.retry_after)},
+                        content={"error": rejected.error, "details": rejected.details,
+                                 "retry_after": rejected.retry_after})
 
-# --- 5. OPTIMIZED DETECTION FUNCTIONS ---
 
-def apply_clahe(image):
-    """Apply CLAHE to enhance scratches (LAB color space)."""
-    lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
-    l_channel, a_channel, b_channel = cv2.split(lab)
-    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-    l_channel_clahe = clahe.apply(l_channel)
-    lab_clahe = cv2.merge([l_channel_clahe, a_channel, b_channel])
-    enhanced = cv2.cvtColor(lab_clahe, cv2.COLOR_LAB2BGR)
-    return enhanced
+def unauthorized_response(error):
+    """401 for a missing or invalid Supabase session token."""
+    return JSONResponse(status_code=401, headers={"WWW-Authenticate": "Bearer"},
+                        content={"error": "Unauthorized", "details": str(error)})
 
 
-def merge_close_boxes(boxes, distance_threshold=50):
+def load_owned_scan(request, scan_id):
     """
-    Merge bounding boxes that are close together (< distance_threshold pixels).
-    Turns 'dotted line' detections into single scratches.
+    (scan, None) when the caller's session token owns the scan, else
+    (None, 401/404 response). A scan owned by someone else is a 404.
     """
-    if len(boxes) == 0:
-        return boxes
-    
-    merged = []
-    used = [False] * len(boxes)
-    
-    for i in range(len(boxes)):
-        if used[i]:
-            continue
-            
-        current_box = boxes[i].copy()
-        used[i] = True
-        
-        # Find all boxes close to this one
-        for j in range(i + 1, len(boxes)):
-            if used[j]:
-                continue
-                
-            # Calculate center distance
-            center1 = ((current_box[0] + current_box[2]) / 2, (current_box[1] + current_box[3]) / 2)
-            center2 = ((boxes[j][0] + boxes[j][2]) / 2, (boxes[j][1] + boxes[j][3]) / 2)
-            distance = np.sqrt((center1[0] - center2[0])**2 + (center1[1] - center2[1])**2)
-            
-            if distance < distance_threshold:
-                # Merge boxes (take min/max coordinates)
-                current_box[0] = min(current_box[0], boxes[j][0])  # x1
-                current_box[1] = min(current_box[1], boxes[j][1])  # y1
-                current_box[2] = max(current_box[2], boxes[j][2])  # x2
-                current_box[3] = max(current_box[3], boxes[j][3])  # y2
-                used[j] = True
-        
-        merged.append(current_box)
-    
-    return np.array(merged)
+    try:
+        user_id = auth.authenticated_user(request.headers)
+    except auth.AuthError as e:
+        return None, unauthorized_response(e)
+    scan = scan_history_service.get_scan_detail(scan_id)
+    if not scan or scan.get("user_id") != user_id:
+        return None, JSONResponse(status_code=404, content={"error": "Scan Not Found"})
+    return scan, None
 
 
-def filter_reflections(boxes, image_shape, max_area_ratio=0.25, square_aspect_tolerance=0.15):
+def rate_key(request):
     """
-    Filter out likely reflections:
-    - Boxes larger than 25% of image area
-    - Perfectly square boxes (aspect ratio ~1.0) unless very small
+    Admission rate-limit key: the verified session user, else the client
+    address. Never the form user_id, which any caller can rotate.
     """
-    if len(boxes) == 0:
-        return boxes
-    
-    img_h, img_w = image_shape[:2]
-    img_area = img_h * img_w
-    filtered = []
-    
-    for box in boxes:
-        x1, y1, x2, y2 = box
-        box_w = x2 - x1
-        box_h = y2 - y1
-        box_area = box_w * box_h
-        
-        
-        
-        # Filter 2: Square aspect ratio (likely reflection, unless small)
-        aspect_ratio = box_w / box_h if box_h > 0 else 0
-        is_square = abs(aspect_ratio - 1.0) < square_aspect_tolerance
-        is_small = box_area < (img_area * 0.01)  # < 1% of image
-        
-        if is_square and not is_small:
-            continue
-        
-        filtered.append(box)
-    
-    return np.array(filtered) if filtered else np.array([])
+    user_id = auth.optional_user(request.headers)
+    if user_id:
+        return f"user:{user_id}"
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
 
+def cancelled_response(scope):
+    """504 once the deadline passed; 499 when the client went away (nobody reads it)."""
+    if scope.reason == "deadline":
+        return JSONResponse(status_code=504, content={
+            "error": "Deadline Exceeded",
+            "details": f"Stopped after stage '{scope.stage}' ({scope.timeout_s:.1f}s budget)"})
+    return JSONResponse(status_code=499, content={"error": "Client Closed Request"})
 
-def smart_detect(image, model):
+
+async def run_guarded(request, scope, endpoint, cost, work):
     """
-    Optimized detection:
-    1. Apply CLAHE preprocessing
-    2. Run YOLO with conf=0.25
-    3. Merge close boxes
-    4. Filter reflections
-    5. Draw boxes on image
+    Admit a request and run `work()` while watching its client and deadline.
+    The caller's rate limit and fair share are keyed by rate_key(request).
+
+    A client disconnect or an expired deadline cancels `scope`; the pipeline
+    stops at its next scope.check(), and a request still waiting for
+    admission is dropped from the queue right away.
     """
-    # Step 1: CLAHE enhancement
-    enhanced_img = apply_clahe(image)
-    
-    # Step 2: Run YO LO detection (conf=0.25, imgsz=1280)
-    results = model(enhanced_img, conf=0.25, iou=0.5, imgsz=1280, verbose=False)
-    
-    # Step 3: Extract boxes
-    boxes = []
-    classes = []
-    confidences = []
-    
-    if results[0].boxes:
-        for box in results[0].boxes:
-            boxes.append(box.xyxy[0].cpu().numpy())
-            confidences.append(float(box.conf[0]))
-            classes.append(int(box.cls[0]))
-    
-    if len(boxes) == 0:
-        return results, []
-    
-    boxes = np.array(boxes)
-    
-    # Step 4: Merge close boxes
-    boxes = merge_close_boxes(boxes, distance_threshold=50)
-    
-    # Step 5: Filter reflections
-    boxes = filter_reflections(boxes, enhanced_img.shape)
-    
-    # Step 6: Draw boxes on enhanced image
-    annotated_img = enhanced_img.copy()
-    for i, box in enumerate(boxes):
-        x1, y1, x2, y2 = box.astype(int)
-        cls = classes[i] if i < len(classes) else 0
-        conf = confidences[i] if i < len(confidences) else 0
-        
-        cv2.rectangle(annotated_img, (x1, y1), (x2, y2), (0, 255, 0), 2)
-        label = f"Class {cls}: {conf:.2f}"
-        cv2.putText(annotated_img, label, (x1, y1 - 10), 
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-    
-    return results, annotated_img
+    async def admitted():
+        wait_start = time.time_ns()
+        async with get_admission().admit(endpoint, rate_key(request), cost=cost):
+            tracing.record(tracing.current_span(), "admission.wait", wait_start, time.time_ns(), endpoint=endpoint)
+            scope.check("admitted")
+            scope.start()
+            return await work()
+
+    task = asyncio.ensure_future(admitted())
+    while not task.done():
+        await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+        if task.done():
+            break
+        if not scope.cancelled:
+            if await request.is_disconnected():
+                scope.cancel("client_disconnected")
+            elif scope.expired:
+                scope.cancel("deadline")
+        if scope.cancelled and scope.work_started is None:
+            task.cancel()  # Still queued for admission
+
+    try:
+        return task.result()
+    except AdmissionRejected as e:
+        return busy_response(e)
+    except InferenceUnavailable as e:
+        return JSONResponse(status_code=503, headers={"Retry-After": "5"},
+                            content={"error": "Inference Unavailable", "details": str(e)})
+    except (RequestCancelled, asyncio.CancelledError):
+        scope.record()
+        tracing.annotate(cancelled=scope.reason, cancelled_stage=scope.stage)
+        return cancelled_response(scope)
+
+
+def queue_scan_records(persistence, user_id, car_name, final_report, image_urls):
+    """Stage the scan row and its damage rows, then commit the scan's outbox batch."""
+    scan_id = persistence.group_id
+    persistence.upsert("scans", [build_scan_record(user_id, car_name, final_report, image_urls, scan_id)])
+    persistence.upsert("damages", build_damage_records(scan_id, final_report.get("damages", [])))
+    persistence.commit(meta={"user_id": user_id})
+    print(f"📮 Scan {scan_id} queued for persistence ({len(persistence.ops)} writes)")
+
+
+def on_scan_persisted(scan_id, meta):
+    """Outbox hook: the scan and all its files/rows are in Supabase."""
+    scan_history_service.invalidate_user(meta.get("user_id"))
+    report_service.invalidate_scan(scan_id)
+    if PDF_PRERENDER:
+        threading.Thread(target=prerender_report, args=(scan_id,), daemon=True).start()
+
+
+@app.on_event("startup")
+def start_outbox():
+    outbox = get_outbox()
+    outbox.on_group_flushed(on_scan_persisted)
+    outbox.start()
+
+
+@app.on_event("shutdown")
+def stop_outbox():
+    get_outbox().stop()
+
+
+@app.on_event("shutdown")
+def stop_report_pool():
+    shutdown_batch_pool()
+
+
+@app.on_event("shutdown")
+def stop_inference_pool():
+    if inference_client.get_pool() is not None:
+        inference_client.get_pool().close()
 
 
 # --- 6. MAIN ENDPOINT ---
 
 @app.post("/analyze")
 async def analyze_image(
+        request: Request,
         file: UploadFile = File(...),
         user_id: str = Form(...),
-        car_name: str = Form(...)
+        car_name: str = Form(...),
+        heatmap_mode: str = Form("inline"),
+        heatmap_format: str = Form("webp"),
+        heatmap_quality: int = Form(80),
+        region: str = Form(None),
+        depth_mode: str = Form(DEPTH_MODE)
 ):
     """
     Main Endpoint: Receives Image + User ID + Car Name.
     Performs damage analysis, uploads to Supabase, and returns scan data.
+
+    heatmap_mode controls how per-damage heatmaps are returned:
+    'inline' (base64, default), 'crop' (base64 WebP/JPEG crops),
+    'url' (uploaded, URLs only) or 'multipart' (multipart/mixed binary parts).
+    heatmap_format ('webp' | 'jpeg') and heatmap_quality (1-100) apply to the
+    crop/url/multipart modes.
+    region (optional) selects a regional price multiplier from the pricing config.
+    depth_mode ('crop' | 'frame') selects per-dent or per-image depth estimation.
+    An X-Request-Timeout-Ms header shortens the request deadline; work stops
+    between stages once it passes or the client disconnects.
     """
-    if not model_parts or not model_damage:
+    if not detection_service.models_loaded():
         return {"error": "Server Error: AI Models not loaded."}
 
+    if heatmap_mode not in HEATMAP_MODES or heatmap_format not in ("webp", "jpeg"):
+        return {"error": "Invalid heatmap options",
+                "details": f"heatmap_mode must be one of {list(HEATMAP_MODES)}, heatmap_format 'webp' or 'jpeg'"}
+    heatmap_quality = min(max(heatmap_quality, 1), 100)
+    if depth_mode not in DEPTH_MODES:
+        return {"error": "Invalid depth mode", "details": f"depth_mode must be one of {list(DEPTH_MODES)}"}
+
+    contents = await file.read()
+    scope = RequestScope.from_headers("analyze", request.headers)
+    return await run_guarded(request, scope, "analyze", 1, lambda: run_in_threadpool(
+        run_analyze_pipeline, contents, user_id, car_name,
+        heatmap_mode, heatmap_format, heatmap_quality, region, depth_mode, scope))
+
+
+@tracing.span("analyze.pipeline")
+def run_analyze_pipeline(contents, user_id, car_name, heatmap_mode, heatmap_format, heatmap_quality,
+                         region, depth_mode, scope=None):
+    """Single-image analysis behind /analyze (runs in the threadpool)."""
+    scope = scope or RequestScope("analyze", timeout_s=float("inf"))
     # A. Extract car make for luxury pricing (parse from car_name)
-    luxury_brands = ["bmw", "mercedes", "audi", "lexus", "porsche", "jaguar", "land rover"]
-    price_multiplier = 2.5 if any(brand in car_name.lower() for brand in luxury_brands) else 1.0
+    price_multiplier = get_price_multiplier(car_name, region)
 
-    # B. Read image
+    # B. Decode image
     try:
-        contents = await file.read()
         nparr = np.frombuffer(contents, np.uint8)
         img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
     except Exception as e:
         return {"error": "Invalid Image", "details": str(e)}
 
-    # C. Quality check
-    quality_result = validate_image_quality(img)
-    if quality_result is not True:
-        return {"error": "Image Quality Issue", "details": quality_result}
+    # C. Quality check (all stages share one ImageContext for derived views)
+    ctx = ImageContext(img)
+    quality = ctx.quality = validate_image_quality(img)
+    if not quality.passed:
+        metrics.increment("quality_rejections", reason=quality.reason)
+        return {"error": "Image Quality Issue", "details": quality.reason, "quality": quality.to_dict()}
+
+    # Vehicle gate: don't spend the damage/depth models on photos without a car
+    scope.check("vehicle_gate")
+    vehicle = check_vehicle_presence([ctx])[0]
+    if not vehicle.passed:
+        return {"error": vehicle.reason, "details": vehicle.details, "vehicle": vehicle.to_dict()}
 
     # D. Run YOLO AI
+    scope.check("parts")
     print("🔍 Scanning for Parts & Damage...")
-    parts_results = model_parts(img)
+    parts_results = run_parts_model([ctx])[0]
     
+    scope.check("damage")
     print("🚀 Using Smart Detection (CLAHE + Merging + Filtering)...")
-    damage_results, annotated_img = smart_detect(img, model_damage)
-    
-    # E. Save images locally (temporary)
-    import uuid
-    from utils import upload_to_storage, insert_scan_record, create_damage_report
+    damage_results, detections = smart_detect(ctx)
     
-    temp_id = str(uuid.uuid4())[:8]
-    original_path = os.path.join("analyzed_images", f"original_{temp_id}.jpg")
-    processed_path = os.path.join("analyzed_images", f"processed_{temp_id}.jpg")
-    pdf_path = os.path.join("analyzed_images", f"report_{temp_id}.pdf")
-    
-    cv2.imwrite(original_path, img)
-    cv2.imwrite(processed_path, annotated_img)
+    # E. All uploads/rows of this scan go through the write-behind outbox
+    scan_id = str(uuid.uuid4())
+    temp_id = scan_id[:8]
+    persistence = OutboxBatch(scan_id)
 
     # F. Run logic + depth analysis
     try:
-        final_report = process_damage(parts_results, damage_results, img, price_multiplier)
+        scope.check("depth")
+        depth_results = compute_dent_depth([damage_results], [ctx], depth_mode)[0]
+        final_report = process_damage(parts_results, damage_results, ctx, price_multiplier,
+                                      depth_results=depth_results)
+        final_report["depth_mode"] = depth_mode
         final_report["vehicle_info"] = {
             "car_name": car_name,
-            "is_luxury": price_multiplier > 1.0
+            "is_luxury": get_pricing_engine().is_premium(car_name)
         }
         
-        # G. Generate Heatmap Image using Gaussian Splatting
-        heatmap_path = f"analyzed_images/heatmap_{temp_id}.jpg"
+        # G. Only the original is stored; the annotated and heatmap views are
+        #    rendered on demand from the detection data (/scans/{id}/overlay/...)
+        scope.check("variants")
+        variants = {"original": stage_image_variants(persistence.upload, [("original", img, "original")],
+                                                     temp_id)["original"],
+                    **overlay_urls(scan_id)}
+        final_report["detections"] = [detection_record(0, img.shape, detections,
+                                                       final_report.get("damages", []), variants["original"])]
+        remember_scan(scan_id, final_report["detections"], [img], user_id)
         
-        # Create blank mask for thermal visualization
-        mask = np.zeros(img.shape[:2], dtype=np.uint8)
+        # H. PDF is rendered lazily by /reports/{scan_id} from the stored scan
         
-        # Draw hot spots for each damage
-        for damage in final_report.get("damages", []):
-            x1, y1, x2, y2 = damage["box"]
-            severity = damage.get("severity", 50)
-            
-            # Calculate center and radius for organic spread
-            center = ((x1 + x2) // 2, (y1 + y2) // 2)
-            radius = int(max(x2 - x1, y2 - y1) * 0.7)
-            
-            # Intensity based on severity (0-100 → 0-255)
-            intensity = int((severity / 100) * 255)
-            
-            # Draw filled circle (hot spot)
-            cv2.circle(mask, center, radius, intensity, -1)
+        # I. Stored image URLs (full size) + all variants
+        image_urls = {
+            "original": variants["original"]["full"],
+            "processed": variants["processed"]["full"],
+            "heatmap": variants["heatmap"]["full"],
+            "pdf": f"{BACKEND_URL}/reports/{scan_id}",
+            "variants": variants
+        }
         
-        # Apply heavy Gaussian blur to create spreading thermal clouds
-        heatmap_blurred = cv2.GaussianBlur(mask, (101, 101), 0)
+        # I2. Encode per-damage heatmaps for the requested response mode
+        heatmap_parts = encode_damage_heatmaps(
+            final_report.get("damages", []),
+            mode=heatmap_mode,
+            fmt=heatmap_format,
+            quality=heatmap_quality,
+            upload_fn=persistence.upload
+        )
         
-        # Apply thermal color map (Blue=cold, Red=hot)
-        heatmap_colored = cv2.applyColorMap(heatmap_blurred, cv2.COLORMAP_JET)
+        # J. Scan record + individual damage records, flushed in the background
+        scope.check("persist")
+        queue_scan_records(persistence, user_id, car_name, final_report, image_urls)
         
-        # Mask out cold (blue) areas to keep car visible where no damage
-        # Only show heat where mask intensity is above threshold
-        alpha_mask = (heatmap_blurred > 30).astype(np.float32)
-        alpha_mask = cv2.cvtColor((alpha_mask * 255).astype(np.uint8), cv2.COLOR_GRAY2BGR) / 255.0
+        # L. Return response
+        final_report["scan_id"] = scan_id
+        final_report["total_cost"] = final_report.get("total_estimate", 0)  # Add total_cost for frontend
+        final_report["original_image_url"] = image_urls["original"]
+        final_report["processed_image_url"] = image_urls["processed"]
+        final_report["heatmap_image_url"] = image_urls["heatmap"]
+        final_report["pdf_url"] = image_urls["pdf"]
+        final_report["image_variants"] = variants
+        final_report["persistence"] = "queued"
         
-        # Smart overlay: blend colored heatmap only where there's heat
-        heatmap_img = img.copy().astype(np.float32)
-        heatmap_img = heatmap_img * (1 - alpha_mask * 0.4) + heatmap_colored.astype(np.float32) * (alpha_mask * 0.4)
-        heatmap_img = np.clip(heatmap_img, 0, 255).astype(np.uint8)
+        return build_analyze_response({
+            "status": "success",
+            "message": "Analysis complete",
+            **final_report
+        }, parts=heatmap_parts, mode=heatmap_mode)
         
-        cv2.imwrite(heatmap_path, heatmap_img)
+    except (RequestCancelled, InferenceUnavailable):
+        raise
+    except Exception as e:
+        print(f"❌ ERROR: {e}")
+        import traceback
+        traceback.print_exc()
+        return {"error": "Analysis Failed", "details": str(e)}
+
+
+@tracing.span("walkaround.pipeline")
+def run_walkaround_pipeline(images, user_id, car_name,
+                            heatmap_mode="inline", heatmap_format="webp", heatmap_quality=80,
+                            extra_report=None, region=None, depth_mode=None, scope=None):
+    """
+    Analyze several photos of one vehicle as a single scan.
+    
+    Quality checks run per image; both YOLO models and depth estimation run
+    batched across all accepted images; damages seen from several angles are
+    merged so each is priced once. Produces one scan record (and one PDF
+    via /reports/{scan_id}).
+    
+    Args:
+        images: List of BGR images (None entries count as undecodable)
+        extra_report: Optional dict merged into the report (e.g. video stats)
+        scope: RequestScope checked between stages (None: no deadline)
+    
+    Returns:
+        Response on success, error dict otherwise
+    Raises:
+        RequestCancelled: client disconnected or deadline passed
+    """
+    scope = scope or RequestScope("walkaround", timeout_s=float("inf"))
+    
+    # A. Quality gate per image
+    accepted, rejected = [], []
+    for idx, img in enumerate(images):
+        if img is None:
+            rejected.append({"image_index": idx, "reason": "Invalid Image"})
+            continue
+        quality = validate_image_quality(img)
+        if not quality.passed:
+            metrics.increment("quality_rejections", reason=quality.reason)
+            rejected.append({"image_index": idx, "reason": quality.reason, "quality": quality.to_dict()})
+            continue
+        accepted.append(idx)
+    
+    if not accepted:
+        return {"error": "Image Quality Issue", "details": "No usable images", "rejected_images": rejected}
+
+    # Vehicle gate (one batched low-resolution pass)
+    scope.check("vehicle_gate")
+    contexts = [ImageContext(images[idx]) for idx in accepted]
+    presences = check_vehicle_presence(contexts)
+    for idx, vehicle in zip(accepted, presences):
+        if not vehicle.passed:
+            rejected.append({"image_index": idx, "reason": vehicle.reason, "details": vehicle.details,
+                             "vehicle": vehicle.to_dict()})
+    contexts = [ctx for ctx, vehicle in zip(contexts, presences) if vehicle.passed]
+    accepted = [idx for idx, vehicle in zip(accepted, presences) if vehicle.passed]
+
+    if not accepted:
+        return {"error": "No Vehicle Detected",
+                "details": "None of the photos clearly show the car. Retake them from 1-2 metres "
+                           "away with the car filling most of the frame.",
+                "rejected_images": rejected}
+    
+    imgs = [images[idx] for idx in accepted]
+    pricing = get_pricing_engine()
+    price_multiplier = pricing.price_multiplier(car_name, region)
+    
+    try:
+        # B. Batched YOLO passes
+        scope.check("parts")
+        print(f"🔍 Scanning {len(imgs)} walkaround images for Parts & Damage...")
+        parts_results_all = run_parts_model(contexts)
+        scope.check("damage")
+        detections = smart_detect_batch(contexts)
+        
+        # C. One batched depth pass for the dents of every image
+        scope.check("depth")
+        depth_by_image = compute_dent_depth([damage_results for damage_results, _ in detections],
+                                            contexts, depth_mode)
+        
+        # D. Per-image logic, then cross-image merge
+        per_image_damages = []
+        for img_pos, ctx in enumerate(contexts):
+            report = process_damage(parts_results_all[img_pos], detections[img_pos][0], ctx,
+                                    price_multiplier, depth_results=depth_by_image[img_pos])
+            per_image_damages.append(report["damages"])
+        
+        merged = merge_walkaround_damages(per_image_damages)
+        for damage in merged["damages"]:
+            damage["image_index"] = accepted[damage["image_index"]]
+            damage["views"] = [accepted[v] for v in damage["views"]]
+        
+        # E. Stage the originals (all angles encoded in parallel); annotated and
+        #    heatmap views are rendered on demand from the detection data
+        scope.check("variants")
+        scan_id = str(uuid.uuid4())
+        persistence = OutboxBatch(scan_id)
+        originals = stage_image_variants(persistence.upload,
+                                         [(f"angle{img_pos}", img, "original") for img_pos, img in enumerate(imgs)],
+                                         scan_id[:8])
+        angles, records = [], []
+        for img_pos, img in enumerate(imgs):
+            variants = {"original": originals[f"angle{img_pos}"], **overlay_urls(scan_id, img_pos)}
+            records.append(detection_record(accepted[img_pos], img.shape, detections[img_pos][1],
+                                            per_image_damages[img_pos], variants["original"]))
+            angles.append({
+                "image_index": accepted[img_pos],
+                "original_image_url": variants["original"]["full"],
+                "processed_image_url": variants["processed"]["full"],
+                "heatmap_image_url": variants["heatmap"]["full"],
+                "image_variants": variants
+            })
+        
+        heatmap_parts = encode_damage_heatmaps(
+            merged["damages"],
+            mode=heatmap_mode,
+            fmt=heatmap_format,
+            quality=heatmap_quality,
+            upload_fn=persistence.upload
+        )
         
-        # H. Generate PDF
-        pdf_data = {
-            "car_name": car_name,
-            "user_id": user_id,
-            "scan_id": temp_id,
-            "damages": final_report.get("damages", []),
-            "total_estimate": final_report.get("total_estimate", 0),
-            "currency": final_report.get("currency", "INR"),
-            "original_image_path": original_path,
-            "processed_image_path": processed_path
+        final_report = {
+            "damages": merged["damages"],
+            "total_estimate": merged["total_estimate"],
+            "currency": pricing.currency,
+            "pricing_version": pricing.version,
+            "depth_mode": depth_mode or DEPTH_MODE,
+            "vehicle_info": {"car_name": car_name, "is_luxury": pricing.is_premium(car_name)},
+            "angles": angles,
+            "detections": records,
+            "duplicates_merged": merged["duplicates_merged"],
+            "rejected_images": rejected,
+            **(extra_report or {})
         }
         
-        pdf_success = create_damage_report(pdf_data, pdf_path)
-        if not pdf_success:
-            print("⚠️ PDF generation failed, continuing without it")
-        
-        # I. Upload to Supabase Storage
-        print("📤 Uploading to Supabase...")
+        # F. One scan record for the whole walkaround (first angle is the cover image)
         image_urls = {
-            "original": upload_to_storage(original_path, "original"),
-            "processed": upload_to_storage(processed_path, "processed"),
-            "heatmap": upload_to_storage(heatmap_path, "heatmaps"),
-            "pdf": upload_to_storage(pdf_path, "reports") if pdf_success else None
+            "original": angles[0]["original_image_url"],
+            "processed": angles[0]["processed_image_url"],
+            "heatmap": angles[0]["heatmap_image_url"],
+            "pdf": f"{BACKEND_URL}/reports/{scan_id}",
+            "variants": angles[0]["image_variants"]
         }
+        remember_scan(scan_id, records, imgs, user_id)
+        scope.check("persist")
+        queue_scan_records(persistence, user_id, car_name, final_report, image_urls)
         
-        # J. Insert scan record into database
-        scan_id = insert_scan_record(user_id, car_name, final_report, image_urls)
-        
-        # J2. Create individual damage records (NEW)
-        if scan_id and final_report.get("damages"):
-            damage_ids = create_damage_records(scan_id, final_report["damages"])
-            print(f"✅ Created {len(damage_ids)} damage records")
-        
-        # K. Cleanup local files
-        for path in [original_path, processed_path, heatmap_path, pdf_path]:
-            if os.path.exists(path):
-                os.remove(path)
-        
-        # L. Return response
         final_report["scan_id"] = scan_id
-        final_report["total_cost"] = final_report.get("total_estimate", 0)  # Add total_cost for frontend
+        final_report["total_cost"] = final_report["total_estimate"]
         final_report["original_image_url"] = image_urls["original"]
         final_report["processed_image_url"] = image_urls["processed"]
         final_report["heatmap_image_url"] = image_urls["heatmap"]
         final_report["pdf_url"] = image_urls["pdf"]
+        final_report["image_variants"] = image_urls["variants"]
+        final_report["persistence"] = "queued"
         
-        return {
+        return build_analyze_response({
             "status": "success",
-            "message": "Analysis complete",
+            "message": f"Walkaround analysis complete ({len(imgs)} images)",
             **final_report
-        }
-        
+        }, parts=heatmap_parts, mode=heatmap_mode)
+    
+    except (RequestCancelled, InferenceUnavailable):
+        raise
     except Exception as e:
-        print(f"❌ ERROR: {e}")
+        print(f"❌ Walkaround ERROR: {e}")
         import traceback
         traceback.print_exc()
         return {"error": "Analysis Failed", "details": str(e)}
 
 
+@app.post("/analyze/walkaround")
+async def analyze_walkaround(
+        request: Request,
+        files: List[UploadFile] = File(...),
+        user_id: str = Form(...),
+        car_name: str = Form(...),
+        heatmap_mode: str = Form("inline"),
+        heatmap_format: str = Form("webp"),
+        heatmap_quality: int = Form(80),
+        region: str = Form(None),
+        depth_mode: str = Form(DEPTH_MODE)
+):
+    """
+    Walkaround Endpoint: N photos of one vehicle (typically 4-8 angles).
+    Returns one consolidated estimate, with damages seen from several
+    angles merged (each damage lists the image indices it was seen in).
+    Heatmap options are the same as /analyze.
+    """
+    if not detection_service.models_loaded():
+        return {"error": "Server Error: AI Models not loaded."}
+
+    if heatmap_mode not in HEATMAP_MODES or heatmap_format not in ("webp", "jpeg"):
+        return {"error": "Invalid heatmap options",
+                "details": f"heatmap_mode must be one of {list(HEATMAP_MODES)}, heatmap_format 'webp' or 'jpeg'"}
+    heatmap_quality = min(max(heatmap_quality, 1), 100)
+    if depth_mode not in DEPTH_MODES:
+        return {"error": "Invalid depth mode", "details": f"depth_mode must be one of {list(DEPTH_MODES)}"}
+
+    if len(files) > MAX_WALKAROUND_IMAGES:
+        return {"error": "Too Many Images", "details": f"At most {MAX_WALKAROUND_IMAGES} images per walkaround"}
+
+    uploads = [await upload_file.read() for upload_file in files]
+    scope = RequestScope.from_headers("walkaround", request.headers)
 
+    async def work():
+        images = await run_in_threadpool(lambda: [decode_image(contents) for contents in uploads])
+        return await run_in_threadpool(run_walkaround_pipeline, images, user_id, car_name,
+                                       heatmap_mode, heatmap_format, heatmap_quality,
+                                       region=region, depth_mode=depth_mode, scope=scope)
+
+    return await run_guarded(request, scope, "walkaround", len(uploads), work)
+
+
+@app.post("/analyze/video")
+async def analyze_video(
+        request: Request,
+        file: UploadFile = File(...),
+        user_id: str = Form(...),
+        car_name: str = Form(...),
+        heatmap_mode: str = Form("inline"),
+        heatmap_format: str = Form("webp"),
+        heatmap_quality: int = Form(80),
+        region: str = Form(None),
+        depth_mode: str = Form(DEPTH_MODE)
+):
+    """
+    Video Walkaround Endpoint: a short video circling the vehicle.
+    The upload is streamed to disk, decoded frame by frame, and only a
+    capped set of sharp, diverse keyframes is run through the walkaround
+    pipeline. Heatmap options are the same as /analyze.
+    """
+    if not detection_service.models_loaded():
+        return {"error": "Server Error: AI Models not loaded."}
+
+    if heatmap_mode not in HEATMAP_MODES or heatmap_format not in ("webp", "jpeg"):
+        return {"error": "Invalid heatmap options",
+                "details": f"heatmap_mode must be one of {list(HEATMAP_MODES)}, heatmap_format 'webp' or 'jpeg'"}
+    heatmap_quality = min(max(heatmap_quality, 1), 100)
+    if depth_mode not in DEPTH_MODES:
+        return {"error": "Invalid depth mode", "details": f"depth_mode must be one of {list(DEPTH_MODES)}"}
+
+    scope = RequestScope.from_headers("video", request.headers)
+    return await run_guarded(request, scope, "video", MAX_KEYFRAMES, lambda: analyze_video_upload(
+        file, user_id, car_name, heatmap_mode, heatmap_format, heatmap_quality, region, depth_mode, scope))
+
+
+async def analyze_video_upload(file, user_id, car_name, heatmap_mode, heatmap_format, heatmap_quality,
+                               region, depth_mode, scope):
+    """Keyframe selection + walkaround analysis behind /analyze/video."""
+    # A. Stream the upload to a temp file in chunks (bounded memory)
+    video_path = os.path.join("analyzed_images", f"video_{uuid.uuid4().hex[:8]}{os.path.splitext(file.filename or '')[1] or '.mp4'}")
+    max_bytes = MAX_VIDEO_MB * 1024 * 1024
+    written = 0
+    try:
+        with open(video_path, "wb") as f:
+            while chunk := await file.read(1024 * 1024):
+                written += len(chunk)
+                if written > max_bytes:
+                    return {"error": "Video Too Large", "details": f"Maximum size is {MAX_VIDEO_MB} MB"}
+                f.write(chunk)
+
+        # B. Stream-decode and pick keyframes
+        scope.check("keyframes")
+        with tracing.span("video.keyframes"):
+            keyframes, video_stats = await run_in_threadpool(select_keyframes, video_path)
+        if not keyframes:
+            return {"error": "Video Quality Issue",
+                    "details": video_stats.get("error", "No usable frames found"), "video": video_stats}
+    finally:
+        if os.path.exists(video_path):
+            os.remove(video_path)
+
+    # C. Analyze only the keyframes, as one walkaround scan
+    return await run_in_threadpool(run_walkaround_pipeline, keyframes, user_id, car_name,
+                                   heatmap_mode, heatmap_format, heatmap_quality,
+                                   extra_report={"video": video_stats},
+                                   region=region, depth_mode=depth_mode, scope=scope)
 
 
 @app.post("/analyze/refine")
 async def refine_damage_analysis(
+    request: Request,
     damage_id: str = Form(...),
     part_name: str = Form(...),
     damage_type: str = Form(...),
     file_left: UploadFile = File(...),
     file_center: UploadFile = File(...),
-    file_right: UploadFile = File(...)
+    file_right: UploadFile = File(...),
 ):
     """
     Multi-angle refinement endpoint.
     Accepts 3 close-up photos and calculates averaged severity verdict.
+    Runs in the admission priority lane.
     """
+    uploads = [await upload_file.read() for upload_file in [file_left, file_center, file_right]]
+    scope = RequestScope.from_headers("refine", request.headers)
+    return await run_guarded(request, scope, "refine", len(uploads), lambda: run_in_threadpool(
+        run_refine_pipeline, damage_id, part_name, damage_type, uploads, scope))
+
+
+@tracing.span("refine.pipeline")
+def run_refine_pipeline(damage_id, part_name, damage_type, uploads, scope=None):
+    """Averaged close-up verdict behind /analyze/refine (runs in the threadpool)."""
+    scope = scope or RequestScope("refine", timeout_s=float("inf"))
+    file_paths = []
     try:
         print(f"🔄 Refining damage {damage_id} with 3 close-up photos...")
         
         # A. Save uploaded files
-        import uuid
         temp_id = str(uuid.uuid4())[:8]
         
-        file_paths = []
-        for idx, upload_file in enumerate([file_left, file_center, file_right], 1):
+        for idx, contents in enumerate(uploads, 1):
             file_path = f"analyzed_images/closeup_{temp_id}_angle{idx}.jpg"
             
             with open(file_path, "wb") as f:
-                f.write(await upload_file.read())
+                f.write(contents)
             
             file_paths.append(file_path)
             print(f"✅ Saved angle {idx}: {file_path}")
@@ -387,10 +713,12 @@ async def refine_damage_analysis(
         images = [cv2.imread(path) for path in file_paths]
         
         # C. Calculate average verdict
+        scope.check("verdict")
         base_cost = get_part_base_cost(part_name)
         verdict = calculate_average_verdict(images, damage_type, part_name, base_cost)
         
         # D. Upload close-ups to Supabase
+        scope.check("upload")
         print("📤 Uploading close-ups to Supabase...")
         closeup_urls = [
             upload_to_storage(file_paths[0], "closeups"),
@@ -408,13 +736,10 @@ async def refine_damage_analysis(
             cost=verdict["cost"],
             confidence=verdict["confidence"]
         )
+        scan_history_service.invalidate_damage(damage_id)
+        report_service.invalidate_damage(damage_id)
         
-        # F. Cleanup local files
-        for path in file_paths:
-            if os.path.exists(path):
-                os.remove(path)
-        
-        # G. Return refined verdict
+        # F. Return refined verdict
         return {
             "status": "success" if success else "error",
             "damage_id": damage_id,
@@ -422,11 +747,213 @@ async def refine_damage_analysis(
             "closeup_urls": closeup_urls
         }
         
+    except (RequestCancelled, InferenceUnavailable):
+        raise
     except Exception as e:
         print(f"❌ Refinement error: {e}")
         import traceback
         traceback.print_exc()
         return {"status": "error", "message": str(e)}
+    
+    finally:
+        # G. Cleanup local files
+        for path in file_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+@app.get("/scans")
+def list_scans(request: Request, limit: int = scan_history_service.DEFAULT_PAGE_SIZE, cursor: Optional[str] = None):
+    """
+    Scan history for the Digital Garage, newest first.
+    Returns summaries only (no damages); pass next_cursor back as
+    `cursor` to get the following page. The user comes from the
+    Supabase session token (Authorization: Bearer ...).
+    """
+    try:
+        user_id = auth.authenticated_user(request.headers)
+    except auth.AuthError as e:
+        return unauthorized_response(e)
+    try:
+        page = scan_history_service.list_user_scans(user_id, limit, cursor)
+    except scan_history_service.InvalidCursor as e:
+        return JSONResponse(status_code=400, content={"error": "Invalid Cursor", "details": str(e)})
+    if page is None:
+        return JSONResponse(status_code=503, content={"error": "Scan history unavailable"})
+    return page
+
+
+@app.get("/scans/{scan_id}")
+def get_scan(scan_id: str, request: Request):
+    """A single scan with its damages (refinement state included), for its owner only."""
+    scan, error = load_owned_scan(request, scan_id)
+    return error or scan
+
+
+@app.get("/scans/{scan_id}/overlay/{view}")
+def get_scan_overlay(scan_id: str, view: str, request: Request, size: str = "web", angle: int = 0,
+                     fmt: str = IMAGE_VARIANT_FORMAT):
+    """
+    Annotated ('processed') or 'heatmap' view of a scan image, rendered
+    from its stored detection data at the requested size (thumb/web/full)
+    on first request, then served from cache with ETag revalidation.
+    angle selects the walkaround image (position among the analyzed ones).
+    Only the scan's owner (Supabase session token) gets it.
+    """
+    try:
+        user_id = auth.authenticated_user(request.headers)
+    except auth.AuthError as e:
+        return unauthorized_response(e)
+    if scan_owner(scan_id) != user_id:
+        return JSONResponse(status_code=404, content={"error": "Scan Not Found"})
+
+    if view not in OVERLAY_VIEWS or size not in OVERLAY_SIZES or fmt not in ("webp", "jpeg"):
+        return JSONResponse(status_code=400, content={
+            "error": "Invalid overlay options",
+            "details": f"view must be one of {list(OVERLAY_VIEWS)}, size one of {list(OVERLAY_SIZES)}, "
+                       f"fmt 'webp' or 'jpeg'"})
+
+    path, etag, media_type = get_or_render_overlay(scan_id, view, size, angle, fmt)
+    if not path:
+        return JSONResponse(status_code=404, content={"error": "Overlay Not Available"})
+
+    quoted_etag = f'"{etag}"'
+    headers = {"ETag": quoted_etag, "Cache-Control": "private, max-age=3600", "Vary": "Authorization"}
+
+    if request.headers.get("if-none-match") == quoted_etag:
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+@app.get("/reports/{scan_id}")
+def get_report(scan_id: str, request: Request):
+    """
+    Download the PDF report for a scan.
+    Rendered on first request from the stored scan data, then served from
+    cache; clients revalidate with If-None-Match and get 304 if unchanged.
+    Only the scan's owner (Supabase session token) gets it.
+    """
+    _, error = load_owned_scan(request, scan_id)
+    if error:
+        return error
+
+    pdf_path, etag = get_or_render_report(scan_id)
+    if not pdf_path:
+        return Response(status_code=404, content="Report not available")
+
+    quoted_etag = f'"{etag}"'
+    headers = {"ETag": quoted_etag, "Cache-Control": "private, no-cache"}
+
+    if request.headers.get("if-none-match") == quoted_etag:
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(
+        pdf_path,
+        media_type="application/pdf",
+        filename=f"damage_report_{scan_id[:8]}.pdf",
+        content_disposition_type="inline",
+        headers=headers
+    )
+
+
+@app.post("/reports/batch")
+def render_report_batch(request: Request, scan_ids: List[str] = Form(...)):
+    """
+    Fleet / insurer export: render the PDF reports of many of the caller's
+    scans at once (process pool) and return their /reports URLs.
+    Scans the caller doesn't own are reported as not_found.
+    """
+    try:
+        user_id = auth.authenticated_user(request.headers)
+    except auth.AuthError as e:
+        return unauthorized_response(e)
+    scan_ids = list(dict.fromkeys(scan_ids))
+    if len(scan_ids) > REPORT_BATCH_MAX_SCANS:
+        return JSONResponse(status_code=400, content={
+            "error": "Too Many Scans", "details": f"At most {REPORT_BATCH_MAX_SCANS} scans per batch"})
+
+    owned = [scan_id for scan_id in scan_ids
+             if (scan_history_service.get_scan_detail(scan_id) or {}).get("user_id") == user_id]
+    etags = render_reports(owned)
+
+    reports = []
+    for scan_id in scan_ids:
+        if scan_id not in etags:
+            status = "not_found"
+        else:
+            status = "ready" if etags[scan_id] else "failed"
+        reports.append({"scan_id": scan_id, "status": status,
+                        "pdf_url": f"{BACKEND_URL}/reports/{scan_id}" if status == "ready" else None})
+    return {"reports": reports}
+
+
+@app.get(storage.ARTIFACT_ROUTE + "/{key:path}")
+def get_artifact(key: str, request: Request):
+    """
+    Locally stored artifact (STORAGE_BACKEND=local). Keys are content
+    hashes, so responses are immutable: cached for a year, ETag = digest
+    (If-None-Match -> 304), byte ranges via Range (206).
+    """
+    path = storage.local_path(key)
+    if not path:
+        return JSONResponse(status_code=404, content={"error": "Artifact Not Found"})
+
+    quoted_etag = f'"{storage.key_digest(key)}"'
+    headers = {"ETag": quoted_etag, "Cache-Control": "public, max-age=31536000, immutable"}
+
+    if request.headers.get("if-none-match") == quoted_etag:
+        return Response(status_code=304, headers=headers)
+
+    # FileResponse answers Range / If-Range requests itself
+    return FileResponse(path, media_type=storage.get_content_type(key), headers=headers)
+
+
+@app.get("/pricing")
+def get_pricing():
+    """Active pricing config version (picks up config file changes)."""
+    return get_pricing_engine().describe()
+
+
+@app.get("/outbox")
+def get_outbox_status():
+    """Write-behind queue depth: pending and dead (parked) Supabase writes."""
+    return get_outbox().stats()
+
+
+@app.get("/admission")
+def get_admission_status():
+    """Admission control state: running and queued requests per endpoint."""
+    return get_admission().stats()
+
+
+@app.get("/inference")
+def get_inference_status():
+    """Inference tier: local models, or the gateway's server pool (health, load, latency)."""
+    pool = inference_client.get_pool()
+    if pool is None:
+        return {"mode": INFERENCE_MODE, "models_loaded": detection_service.models_loaded()}
+    return {"mode": INFERENCE_MODE, **pool.stats()}
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Expose in-process counters and timing summaries."""
+    return metrics.snapshot()
+
+
+# Timelines carry span attributes and trace ids are on every response, so the
+# route only exists in debug mode (TRACE_DEBUG, as for Server-Timing)
+if tracing.TRACE_DEBUG:
+    @app.get("/traces/{trace_id}")
+    def get_trace_timeline(trace_id: str):
+        """Span timeline of a recent request (id from its X-Trace-Id header)."""
+        trace = tracing.get_trace(trace_id)
+        if trace is None:
+            return JSONResponse(status_code=404, content={
+                "error": "Trace Not Found",
+                "details": "Unknown trace id, or evicted (only recent traces are kept in memory)"})
+        return {"trace_id": trace_id, "spans": trace.timeline()}
 
 
 # --- SERVER STARTUP ---
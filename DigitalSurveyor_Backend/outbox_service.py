@@ -0,0 +1,358 @@
+# outbox_service.py
+"""
+Write-behind outbox for Supabase persistence.
+
+/analyze records everything a scan has to persist (storage uploads, the
+scan row, its damage rows) in a local SQLite database in one transaction
+and returns immediately. A background flusher pushes the entries out:
+uploads in parallel (to the STORAGE_BACKEND, utils/storage.py), rows to
+Supabase as batched upserts, with exponential backoff on failure. Entries survive restarts and are replayed on startup,
+so a slow or unavailable Supabase no longer loses scans or adds latency.
+
+Entries of one group (one scan) are applied in order, so damage rows are
+never written before their scan row, and the scan row never before its
+images. Uploads and upserts are idempotent, so an entry that is retried
+after a crash or lost response does no harm.
+"""
+
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import metrics, tracing
+from utils.response_encoding import json_default
+from utils.ttl_cache import TTLCache
+from utils.storage import object_key, public_url, store, get_content_type
+from utils.supabase_client import upsert_rows
+
+OUTBOX_DB_PATH = os.getenv("OUTBOX_DB_PATH", "outbox.db")
+# Max entries claimed per flush pass
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+# Parallel storage uploads per pass
+OUTBOX_UPLOAD_WORKERS = int(os.getenv("OUTBOX_UPLOAD_WORKERS", "4"))
+# Retry backoff: base * 2^attempts seconds, capped, with jitter
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "1"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "300"))
+# Entries failing this many times are parked as 'dead' (kept for manual replay)
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "50"))
+
+# An entry being flushed is leased for this long (protects against a second
+# flusher, e.g. another worker process, picking it up at the same time)
+LEASE_SECONDS = 120
+IDLE_POLL_SECONDS = 5
+
+# group_id -> span its writes are traced under (best effort: not persisted)
+_group_traces = TTLCache("outbox_traces", ttl=3600, max_entries=1024)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    group_id TEXT NOT NULL,
+    kind TEXT NOT NULL,              -- 'upload' | 'upsert'
+    target TEXT NOT NULL,            -- storage object key | table name
+    payload BLOB NOT NULL,           -- file bytes | JSON list of rows
+    content_type TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',   -- 'pending' | 'dead'
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_group ON outbox (group_id, id);
+CREATE TABLE IF NOT EXISTS outbox_groups (
+    group_id TEXT PRIMARY KEY,
+    meta TEXT,
+    created_at REAL NOT NULL
+);
+"""
+
+
+class OutboxBatch:
+    """
+    Collects the writes of one scan; nothing is stored until commit().
+
+    Usage:
+        batch = OutboxBatch(scan_id)
+        url = batch.upload(jpeg_bytes, "original.jpg", "original")
+        batch.upsert("scans", [scan_row])
+        batch.commit(meta={"user_id": user_id})
+    """
+
+    def __init__(self, group_id: str):
+        self.group_id = group_id
+        self.ops = []
+
+    def upload(self, data: bytes, filename: str, folder: str) -> str:
+        """Stage a storage upload; returns the public URL it will have."""
+        key = object_key(data, filename, folder)
+        if not any(op[0] == "upload" and op[1] == key for op in self.ops):
+            self.ops.append(("upload", key, data, get_content_type(filename)))
+        return public_url(key)
+
+    def upsert(self, table: str, rows: list):
+        if rows:
+            payload = json.dumps(rows, default=json_default).encode("utf-8")
+            self.ops.append(("upsert", table, payload, None))
+
+    def commit(self, meta: dict = None):
+        with tracing.span("outbox.enqueue", ops=len(self.ops)) as enqueue_span:
+            get_outbox().enqueue(self.group_id, self.ops, meta)
+        if enqueue_span is not None:
+            _group_traces.set(self.group_id, enqueue_span)
+
+
+class Outbox:
+    """SQLite-backed queue plus the background flusher thread."""
+
+    def __init__(self, path: str = OUTBOX_DB_PATH):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.executescript(_SCHEMA)
+        self._db_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._hooks = []
+
+    # --- PRODUCER SIDE ---
+
+    def enqueue(self, group_id: str, ops: list, meta: dict = None):
+        """Durably store all writes of a group (atomic), then wake the flusher."""
+        now = time.time()
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO outbox_groups (group_id, meta, created_at) VALUES (?, ?, ?)",
+                    (group_id, json.dumps(meta or {}), now))
+                self._conn.executemany(
+                    "INSERT INTO outbox (group_id, kind, target, payload, content_type, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(group_id, kind, target, sqlite3.Binary(payload), content_type, now)
+                     for kind, target, payload, content_type in ops])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        metrics.increment("outbox_enqueued", value=len(ops))
+        self._wake.set()
+
+    def on_group_flushed(self, hook):
+        """Register hook(group_id, meta), called once all of a group's writes landed."""
+        self._hooks.append(hook)
+
+    # --- FLUSHER ---
+
+    def start(self):
+        """
+        Start the flusher thread. Pending entries from a previous run are
+        replayed once due: their timestamps are left alone, since other
+        workers sharing the database may hold leases or backoffs on them
+        (a crashed flusher's leases simply expire).
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        pending = self.stats()["pending"]
+        if pending:
+            print(f"📮 Outbox: replaying {pending} pending write(s)")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="outbox-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=OUTBOX_UPLOAD_WORKERS) as pool:
+            while not self._stop.is_set():
+                try:
+                    flushed = self.flush_once(pool)
+                except Exception as e:
+                    print(f"⚠️ Outbox flusher error: {e}")
+                    flushed = 0
+                if not flushed:
+                    self._wake.wait(self._idle_wait())
+                    self._wake.clear()
+
+    def _idle_wait(self):
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'").fetchone()
+        if row[0] is None:
+            return IDLE_POLL_SECONDS
+        return min(max(row[0] - time.time(), 0.05), IDLE_POLL_SECONDS)
+
+    def _claim_runnable(self):
+        """
+        Lease the entries that may run now. Within a group, uploads have no
+        order among themselves, but an upsert only runs once every earlier
+        entry of its group has landed (rows after the files they point to,
+        damages after their scan).
+        """
+        now = time.time()
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                entries = self._conn.execute(
+                    "SELECT id, group_id, kind, next_attempt_at, status FROM outbox ORDER BY id").fetchall()
+                runnable, blocked = [], set()
+                for entry_id, group_id, kind, next_attempt_at, status in entries:
+                    if group_id in blocked:
+                        continue
+                    is_first = not any(g == group_id for _, g in runnable)
+                    due = status == "pending" and next_attempt_at <= now
+                    if kind == "upload" and due:
+                        runnable.append((entry_id, group_id))
+                    elif kind != "upload" and due and is_first:
+                        runnable.append((entry_id, group_id))
+                        blocked.add(group_id)
+                        continue
+                    if kind != "upload" or not due:
+                        blocked.add(group_id)
+                    if len(runnable) >= OUTBOX_BATCH_SIZE:
+                        break
+                ids = [entry_id for entry_id, _ in runnable]
+                self._conn.executemany("UPDATE outbox SET next_attempt_at = ? WHERE id = ?",
+                                       [(now + LEASE_SECONDS, entry_id) for entry_id in ids])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            if not ids:
+                return []
+            return self._conn.execute(
+                "SELECT id, group_id, kind, target, payload, content_type, attempts FROM outbox "
+                f"WHERE id IN ({','.join('?' * len(ids))}) ORDER BY id", ids).fetchall()
+
+    def flush_once(self, pool=None) -> int:
+        """
+        One flush pass over the runnable entries.
+        Returns the number of entries written to Supabase.
+        """
+        claimed = self._claim_runnable()
+        if not claimed:
+            return 0
+
+        uploads = [row for row in claimed if row[2] == "upload"]
+        upserts = {}
+        for row in claimed:
+            if row[2] == "upsert":
+                upserts.setdefault(row[3], []).append(row)
+
+        done, failed = [], []
+
+        def do_upload(row):
+            with tracing.activate(_group_traces.get(row[1])):
+                store(row[3], bytes(row[4]), row[5])
+
+        # Storage: one request per object, run in parallel
+        if uploads:
+            results = (pool.map(lambda r: _attempt(do_upload, r), uploads) if pool
+                       else (_attempt(do_upload, r) for r in uploads))
+            for row, error in zip(uploads, results):
+                (failed if error else done).append((row, error))
+
+        # Rows: one upsert per table for all due groups
+        for table, rows in upserts.items():
+            batch = [record for row in rows for record in json.loads(bytes(row[4]))]
+            start_ns = time.time_ns()
+            with metrics.timer("outbox_upsert_ms", table=table):
+                error = _attempt(lambda _: upsert_rows(table, batch), None)
+            # One request serves several scans: it shows up in each of their traces
+            groups = {row[1] for row in rows}
+            for group_id in groups:
+                tracing.record(_group_traces.get(group_id), "db.upsert", start_ns, time.time_ns(),
+                               table=table, rows=len(batch), groups=len(groups), failed=error is not None)
+            if error and len(rows) > 1:
+                # One bad group must not block the others: retry them one by one
+                for row in rows:
+                    with tracing.activate(_group_traces.get(row[1])):
+                        row_error = _attempt(lambda r: upsert_rows(table, json.loads(bytes(r[4]))), row)
+                    (failed if row_error else done).append((row, row_error))
+            else:
+                for row in rows:
+                    (failed if error else done).append((row, error))
+
+        self._record(done, failed)
+        return len(done)
+
+    def _record(self, done, failed):
+        now = time.time()
+        finished_groups = []
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("DELETE FROM outbox WHERE id = ?", [(row[0],) for row, _ in done])
+                for row, error in failed:
+                    attempts = row[6] + 1
+                    delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** attempts) * random.uniform(0.8, 1.2)
+                    status = "dead" if attempts >= OUTBOX_MAX_ATTEMPTS else "pending"
+                    self._conn.execute(
+                        "UPDATE outbox SET attempts = ?, next_attempt_at = ?, status = ?, last_error = ? "
+                        "WHERE id = ?", (attempts, now + delay, status, str(error)[:500], row[0]))
+                for group_id in {row[1] for row, _ in done}:
+                    left = self._conn.execute(
+                        "SELECT 1 FROM outbox WHERE group_id = ? LIMIT 1", (group_id,)).fetchone()
+                    if not left:
+                        meta = self._conn.execute(
+                            "SELECT meta FROM outbox_groups WHERE group_id = ?", (group_id,)).fetchone()
+                        self._conn.execute("DELETE FROM outbox_groups WHERE group_id = ?", (group_id,))
+                        finished_groups.append((group_id, json.loads(meta[0]) if meta and meta[0] else {}))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        if done:
+            metrics.increment("outbox_flushed", value=len(done))
+        for row, error in failed:
+            metrics.increment("outbox_failures", kind=row[2])
+            print(f"⚠️ Outbox {row[2]} to {row[3]} failed (attempt {row[6] + 1}): {error}")
+
+        for group_id, meta in finished_groups:
+            for hook in self._hooks:
+                try:
+                    hook(group_id, meta)
+                except Exception as e:
+                    print(f"⚠️ Outbox hook error for {group_id}: {e}")
+
+    def stats(self) -> dict:
+        with self._db_lock:
+            pending, dead, oldest = self._conn.execute(
+                "SELECT SUM(status = 'pending'), SUM(status = 'dead'), MIN(created_at) FROM outbox").fetchone()
+        return {
+            "pending": pending or 0,
+            "dead": dead or 0,
+            "oldest_age_s": round(time.time() - oldest, 1) if oldest else 0
+        }
+
+
+def _attempt(fn, row):
+    """Run fn(row); return None on success or the exception."""
+    try:
+        fn(row)
+        return None
+    except Exception as e:
+        return e
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox() -> Outbox:
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = Outbox()
+    return _outbox
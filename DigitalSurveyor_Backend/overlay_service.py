@@ -0,0 +1,320 @@
+# overlay_service.py
+"""
+On-demand annotated ("processed") and heatmap views of a scan.
+
+A scan stores only its original photo (as image variants) plus compact
+detection data per image: the YOLO boxes with class and confidence, and
+the damage heat spots (box + severity). The overlay endpoint renders a
+view from that data at the requested size, and the encoded result is
+cached on disk keyed by an ETag of everything it was rendered from, so
+no per-scan drawing, encoding or storage happens until someone looks.
+
+Fresh scans render from an in-memory copy of their originals, so views
+work before the write-behind outbox has stored the scan row.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+
+import cv2
+import numpy as np
+
+from utils import metrics, storage
+from utils.image_context import ImageContext
+from utils.image_variants import VARIANTS, resize_longest_side
+from utils.response_encoding import IMAGE_FORMATS, encode_image_bytes
+from utils.ttl_cache import TTLCache
+
+BACKEND_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:8000")
+OVERLAY_CACHE_DIR = os.getenv("OVERLAY_CACHE_DIR", "overlay_cache")
+# Fresh scans whose originals are kept in memory (full-size arrays), bounded
+# by count and by total decoded size (a 12MP frame is ~36 MB)
+OVERLAY_SOURCE_CACHE_ENTRIES = int(os.getenv("OVERLAY_SOURCE_CACHE_ENTRIES", "8"))
+OVERLAY_SOURCE_CACHE_MB = float(os.getenv("OVERLAY_SOURCE_CACHE_MB", "512"))
+OVERLAY_SOURCE_TTL_SECONDS = float(os.getenv("OVERLAY_SOURCE_TTL_SECONDS", "600"))
+# Rendered overlays on disk: oldest (least recently served) evicted past either limit
+OVERLAY_CACHE_MAX_MB = float(os.getenv("OVERLAY_CACHE_MAX_MB", "1024"))
+OVERLAY_CACHE_MAX_AGE_HOURS = float(os.getenv("OVERLAY_CACHE_MAX_AGE_HOURS", "168"))
+OVERLAY_CACHE_PRUNE_SECONDS = 60
+# Bump when the drawing changes so cached overlays are re-rendered
+OVERLAY_TEMPLATE_VERSION = "1"
+
+OVERLAY_VIEWS = ("processed", "heatmap")
+OVERLAY_SIZES = tuple(VARIANTS)
+
+# Heatmap blur kernel at full resolution (scaled down with the image)
+HEATMAP_BLUR_PX = 101
+
+os.makedirs(OVERLAY_CACHE_DIR, exist_ok=True)
+
+_sources = TTLCache("overlay_sources", ttl=OVERLAY_SOURCE_TTL_SECONDS, max_entries=OVERLAY_SOURCE_CACHE_ENTRIES,
+                    max_bytes=int(OVERLAY_SOURCE_CACHE_MB * (1 << 20)),
+                    weigh=lambda images: sum(image.nbytes for image in images))
+_fresh_records = TTLCache("overlay_records", ttl=OVERLAY_SOURCE_TTL_SECONDS, max_entries=1024)
+
+# Striped render locks (fixed memory) so concurrent first requests for a file render once
+_render_locks = [threading.Lock() for _ in range(64)]
+_last_prune = 0.0
+_prune_lock = threading.Lock()
+
+
+def _lock_for(key: str) -> threading.Lock:
+    return _render_locks[zlib.crc32(key.encode("utf-8")) % len(_render_locks)]
+
+
+def prune_overlay_cache(force: bool = False):
+    """Evict rendered overlays past OVERLAY_CACHE_MAX_AGE_HOURS, then oldest first down to OVERLAY_CACHE_MAX_MB."""
+    global _last_prune
+    now = time.time()
+    with _prune_lock:
+        if not force and now - _last_prune < OVERLAY_CACHE_PRUNE_SECONDS:
+            return
+        _last_prune = now
+
+    files = []
+    for entry in os.scandir(OVERLAY_CACHE_DIR):
+        try:
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            continue  # Removed concurrently
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    max_bytes = OVERLAY_CACHE_MAX_MB * (1 << 20)
+    removed = 0
+    for mtime, size, path in files:
+        if now - mtime < OVERLAY_CACHE_MAX_AGE_HOURS * 3600 and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+        total -= size
+    if removed:
+        metrics.increment("overlay_cache_evicted", value=removed)
+
+
+# --- DRAWING ---
+
+def draw_detections(image, boxes, scale: float = 1.0):
+    """Draw YOLO boxes ({box, class, confidence}) on a copy of `image`."""
+    annotated_img = image.copy()
+    for detection in boxes:
+        x1, y1, x2, y2 = (np.asarray(detection["box"], dtype=float) * scale).astype(int)
+        cv2.rectangle(annotated_img, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        label = f"Class {detection['class']}: {detection['confidence']:.2f}"
+        cv2.putText(annotated_img, label, (x1, y1 - 10),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+    return annotated_img
+
+
+def build_scan_heatmap(img, damages, blur_px: int = HEATMAP_BLUR_PX):
+    """
+    Generate the scan-level heatmap image using Gaussian Splatting:
+    one thermal cloud per damage, blended only where there is heat.
+    Work is limited to the region the clouds can reach (blur radius included).
+    """
+    heatmap_img = img.copy()
+    if not damages:
+        return heatmap_img
+
+    h, w = img.shape[:2]
+    blur_px = max(int(blur_px) | 1, 3)
+    margin = blur_px // 2 + 1
+
+    # Calculate center and radius for organic spread
+    spots = []
+    for damage in damages:
+        x1, y1, x2, y2 = map(int, damage["box"])
+        center = ((x1 + x2) // 2, (y1 + y2) // 2)
+        radius = int(max(x2 - x1, y2 - y1) * 0.7)
+        # Intensity based on severity (0-100 → 0-255)
+        intensity = int((damage.get("severity", 50) / 100) * 255)
+        spots.append((center, radius, intensity))
+
+    rx1 = max(0, min(c[0] - r for c, r, _ in spots) - margin)
+    ry1 = max(0, min(c[1] - r for c, r, _ in spots) - margin)
+    rx2 = min(w, max(c[0] + r for c, r, _ in spots) + margin + 1)
+    ry2 = min(h, max(c[1] + r for c, r, _ in spots) + margin + 1)
+    if rx2 <= rx1 or ry2 <= ry1:
+        return heatmap_img
+
+    # Create blank mask for thermal visualization and draw hot spots
+    mask = np.zeros((ry2 - ry1, rx2 - rx1), dtype=np.uint8)
+    for (cx, cy), radius, intensity in spots:
+        cv2.circle(mask, (cx - rx1, cy - ry1), radius, intensity, -1)
+
+    # Apply heavy Gaussian blur to create spreading thermal clouds
+    heatmap_blurred = cv2.GaussianBlur(mask, (blur_px, blur_px), 0)
+
+    # Apply thermal color map (Blue=cold, Red=hot)
+    heatmap_colored = cv2.applyColorMap(heatmap_blurred, cv2.COLORMAP_JET)
+
+    # Smart overlay: blend colored heatmap (40%) only where there's heat,
+    # keeping the car visible where there is no damage
+    region = heatmap_img[ry1:ry2, rx1:rx2]
+    blended = cv2.addWeighted(region, 0.6, heatmap_colored, 0.4, 0)
+    hot = heatmap_blurred > 30
+    region[hot] = blended[hot]
+    return heatmap_img
+
+
+# --- STORED DATA ---
+
+def detection_record(image_index: int, image_shape, boxes: list, damages: list, source: dict) -> dict:
+    """
+    Compact per-image data a scan stores instead of rendered overlays.
+
+    Args:
+        image_index: Index of the photo in the request
+        image_shape: Shape of the analyzed image (boxes are in its pixels)
+        boxes: Detections from extract_detections()
+        damages: Damage dicts with box/severity (heatmap spots)
+        source: Original image variant URLs ({thumb, web, full})
+    """
+    return {
+        "image_index": image_index,
+        "image_shape": [int(image_shape[0]), int(image_shape[1])],
+        "boxes": boxes,
+        "heat": [{"box": [int(v) for v in damage["box"]], "severity": int(damage.get("severity", 50))}
+                 for damage in damages],
+        "source": source,
+    }
+
+
+def overlay_urls(scan_id: str, angle: int = 0) -> dict:
+    """{view: {size: url}} for the overlay endpoint, shaped like image variants."""
+    suffix = f"&angle={angle}" if angle else ""
+    return {view: {size: f"{BACKEND_URL}/scans/{scan_id}/overlay/{view}?size={size}{suffix}"
+                   for size in OVERLAY_SIZES}
+            for view in OVERLAY_VIEWS}
+
+
+def remember_scan(scan_id: str, records: list, images: list, user_id: str):
+    """Keep a fresh scan's owner, data and originals in memory until its row is stored."""
+    _fresh_records.set(scan_id, (user_id, records))
+    _sources.set(scan_id, images)
+
+
+def _load_scan(scan_id: str):
+    """(owner user id, detection records) of a scan, fresh or stored; (None, None) if unknown."""
+    fresh = _fresh_records.get(scan_id)
+    if fresh is not None:
+        return fresh
+    # Imported here: scan_history_service pulls in the Supabase client
+    from scan_history_service import get_scan_detail
+    scan = get_scan_detail(scan_id)
+    return (scan.get("user_id"), scan.get("detections")) if scan else (None, None)
+
+
+def scan_owner(scan_id: str):
+    """User id that owns a scan (fresh or stored), or None."""
+    return _load_scan(scan_id)[0]
+
+
+def _load_source(scan_id: str, angle: int, record: dict, size: str):
+    """Original image at `size`: from memory for fresh scans, else its stored variant."""
+    images = _sources.get(scan_id)
+    if images is not None and angle < len(images):
+        max_side = VARIANTS[size][0]
+        return images[angle] if max_side is None else resize_longest_side(images[angle], max_side)
+
+    url = (record.get("source") or {}).get(size)
+    if not url:
+        return None
+    try:
+        with metrics.timer("overlay_source_download_ms"):
+            data = storage.fetch(url)
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    except Exception as e:
+        print(f"⚠️ Could not load overlay source {url}: {e}")
+        return None
+
+
+def compute_overlay_etag(record: dict, view: str, size: str, fmt: str) -> str:
+    """Hash of everything an overlay is rendered from."""
+    source = {"version": OVERLAY_TEMPLATE_VERSION, "view": view, "size": size, "format": fmt,
+              "record": {k: record.get(k) for k in ("image_shape", "boxes", "heat", "source")}}
+    digest = hashlib.sha1(json.dumps(source, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return digest[:16]
+
+
+def render_overlay(record: dict, source_img, view: str, size: str, fmt: str) -> bytes:
+    """Draw one view of one image and encode it with the size's variant quality."""
+    scale = source_img.shape[1] / max(record["image_shape"][1], 1)
+    if view == "processed":
+        image = draw_detections(ImageContext(source_img).clahe, record["boxes"], scale)
+    else:
+        spots = [{"box": [v * scale for v in spot["box"]], "severity": spot["severity"]}
+                 for spot in record["heat"]]
+        image = build_scan_heatmap(source_img, spots, blur_px=HEATMAP_BLUR_PX * scale)
+    return encode_image_bytes(image, fmt, VARIANTS[size][1])
+
+
+def _touch(path: str) -> bool:
+    """Mark a cached file as just served (eviction is oldest first); False if it is gone."""
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+
+def get_or_render_overlay(scan_id: str, view: str, size: str = "web", angle: int = 0,
+                          fmt: str = "webp", records: list = None):
+    """
+    Return the cached overlay file, rendering it if needed.
+
+    Args:
+        records: The scan's stored detection data (looked up when None)
+
+    Returns:
+        (path, etag, mime_type), or (None, None, None) if the scan, the image
+        or its detection data is not available
+    """
+    records = records if records is not None else _load_scan(scan_id)[1]
+    if not records or not 0 <= angle < len(records):
+        return None, None, None
+
+    record = records[angle]
+    etag = compute_overlay_etag(record, view, size, fmt)
+    ext, _, mime_type = IMAGE_FORMATS[fmt]
+    prefix = f"{scan_id}_{angle}_{view}_{size}_{fmt}_"
+    path = os.path.join(OVERLAY_CACHE_DIR, f"{prefix}{etag}{ext}")
+
+    if _touch(path):
+        metrics.increment("overlay_cache", result="hit")
+        return path, etag, mime_type
+
+    with _lock_for(prefix):
+        if os.path.exists(path):
+            metrics.increment("overlay_cache", result="hit")
+            return path, etag, mime_type
+
+        metrics.increment("overlay_cache", result="miss")
+        source_img = _load_source(scan_id, angle, record, size)
+        if source_img is None:
+            return None, None, None
+
+        with metrics.timer("overlay_render_ms", view=view, size=size):
+            data = render_overlay(record, source_img, view, size, fmt)
+        if not data:
+            return None, None, None
+
+        # Atomic publish, then drop overlays rendered from stale data
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        for name in os.listdir(OVERLAY_CACHE_DIR):
+            if name.startswith(prefix) and name != os.path.basename(path) and not name.endswith(".tmp"):
+                os.remove(os.path.join(OVERLAY_CACHE_DIR, name))
+
+    prune_overlay_cache()
+    return path, etag, mime_type
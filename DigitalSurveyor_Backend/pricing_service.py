@@ -0,0 +1,252 @@
+# pricing_service.py
+"""
+Table-driven pricing and repair-action engine.
+
+All prices, action thresholds, part aliases, brand and region multipliers
+live in a versioned JSON config (pricing_config.json). The config is
+compiled once into numpy lookup tables so every damage of a scan is priced
+in one vectorized call, and scans and refinements share the same tables.
+The config file is re-read when it changes on disk (checked at most every
+PRICING_RELOAD_SECONDS), so prices can be updated without a restart.
+"""
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from utils import metrics
+
+PRICING_CONFIG = os.getenv(
+    "PRICING_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "pricing_config.json")
+)
+# How often get_engine() looks at the config file's mtime
+PRICING_RELOAD_SECONDS = float(os.getenv("PRICING_RELOAD_SECONDS", "5"))
+
+UNKNOWN_PART = "unknown"
+
+
+def _band_bounds(bands):
+    """Upper-inclusive severity bounds of all bands but the last (open-ended) one."""
+    if not bands or bands[-1].get("max_severity") is not None:
+        raise ValueError("the last band must have max_severity null")
+    bounds = [float(b["max_severity"]) for b in bands[:-1]]
+    if bounds != sorted(bounds):
+        raise ValueError("band max_severity values must be increasing")
+    return np.array(bounds, dtype=np.float64)
+
+
+class PricingEngine:
+    """
+    Compiled form of one pricing config version.
+
+    Lookup tables:
+        part index:  part name -> row, plus keyword aliases resolved in config order
+        band table:  (part, severity band) -> base cost
+        overrides:   per-rule part masks / damage keywords / severity floor
+        brand/region multipliers
+    """
+
+    def __init__(self, config: dict, source: str = None):
+        self.version = str(config["version"])
+        self.currency = config.get("currency", "INR")
+        self.source = source
+
+        # --- PART INDEX ---
+        parts = [p for p in config["parts"] if p["name"] != UNKNOWN_PART]
+        unknown = next((p for p in config["parts"] if p["name"] == UNKNOWN_PART), {})
+        parts.append({"replace_cost": 0, "refine_base_cost": 0, **unknown,
+                      "name": UNKNOWN_PART, "keywords": []})
+        self.part_names = [p["name"] for p in parts]
+        self.part_index = {name: idx for idx, name in enumerate(self.part_names)}
+        self._part_keywords = [(kw.lower(), idx) for idx, p in enumerate(parts)
+                               for kw in p.get("keywords", [p["name"]])]
+        self._part_cache = {}
+        replace_cost = np.array([p["replace_cost"] for p in parts], dtype=np.float64)
+        self._refine_base = np.array([p["refine_base_cost"] for p in parts], dtype=np.float64)
+
+        # --- ACTION BANDS (scan pricing) ---
+        self.actions = []
+        bands = config["actions"]["bands"]
+        self._bounds = _band_bounds(bands)
+        self._band_action = np.array([self._action_id(b["action"]) for b in bands])
+        # (n_parts, n_bands): a band costs either a flat amount or the part's replacement cost
+        self._band_cost = np.column_stack([
+            replace_cost if b["cost"] == "replace_cost" else np.full(len(parts), float(b["cost"]))
+            for b in bands
+        ])
+
+        # --- OVERRIDES (first matching rule wins) ---
+        self._overrides = []
+        for rule in config["actions"].get("overrides", []):
+            part_mask = np.ones(len(parts), dtype=bool)
+            if rule.get("parts"):
+                part_mask[:] = False
+                part_mask[[self.part_index[name] for name in rule["parts"]]] = True
+            self._overrides.append({
+                "part_mask": part_mask,
+                "keywords": tuple(k.lower() for k in rule.get("damage_keywords", [])),
+                "min_severity": float(rule.get("min_severity", -np.inf)),
+                "action": self._action_id(rule["action"]),
+                "cost": float(rule["cost"]),
+            })
+
+        # --- REFINEMENT BANDS (multi-angle verdict) ---
+        refine_bands = config["refine_bands"]
+        self._refine_bounds = _band_bounds(refine_bands)
+        self._refine_action = [b["action"] for b in refine_bands]
+        self._refine_multiplier = [float(b["multiplier"]) for b in refine_bands]
+
+        # --- MULTIPLIERS ---
+        self.brands = [(brand.lower(), float(m)) for brand, m in config.get("brands", {}).items()]
+        self.regions = {region.lower(): float(m) for region, m in config.get("regions", {}).items()}
+
+    def _action_id(self, action):
+        if action not in self.actions:
+            self.actions.append(action)
+        return self.actions.index(action)
+
+    # --- LOOKUPS ---
+
+    def part_id(self, label: str) -> int:
+        """Row of a part label: exact name, else first keyword contained in it, else unknown."""
+        label = (label or "").lower()
+        idx = self._part_cache.get(label)
+        if idx is None:
+            idx = self.part_index.get(label)
+            if idx is None:
+                idx = next((i for kw, i in self._part_keywords if kw in label), self.part_index[UNKNOWN_PART])
+            self._part_cache[label] = idx
+        return idx
+
+    def canonical_part(self, label: str) -> str:
+        """Normalize a YOLO/client part label (e.g. 'Front-Door') to a config part name."""
+        return self.part_names[self.part_id(label)]
+
+    def price_multiplier(self, car_name: str = None, region: str = None) -> float:
+        """Brand multiplier (first brand contained in car_name) times region multiplier."""
+        car_name = (car_name or "").lower()
+        brand = next((m for b, m in self.brands if b in car_name), 1.0)
+        region_key = (region or "default").lower()
+        return brand * self.regions.get(region_key, self.regions.get("default", 1.0))
+
+    def is_premium(self, car_name: str = None) -> bool:
+        return self.price_multiplier(car_name) > 1.0
+
+    # --- PRICING ---
+
+    def price(self, parts, damage_types, severities, multiplier=1.0) -> dict:
+        """
+        Price many damages at once.
+
+        Args:
+            parts: Part labels (any alias)
+            damage_types: Damage labels (e.g. 'dent', 'scratch', 'crack')
+            severities: 0-100 scores
+            multiplier: Scalar or per-damage price multiplier
+
+        Returns:
+            {"action": [str], "base_cost": ndarray, "cost": ndarray}
+        """
+        n = len(severities)
+        if n == 0:
+            return {"action": [], "base_cost": np.zeros(0), "cost": np.zeros(0)}
+
+        part_ids = np.fromiter((self.part_id(p) for p in parts), dtype=np.intp, count=n)
+        severity = np.asarray(severities, dtype=np.float64)
+
+        band = np.searchsorted(self._bounds, severity, side="left")
+        action_ids = self._band_action[band].copy()
+        base_cost = self._band_cost[part_ids, band]
+
+        if self._overrides:
+            # Damage-type keyword matches are evaluated once per distinct label
+            type_labels, type_ids = np.unique([t.lower() for t in damage_types], return_inverse=True)
+            resolved = np.zeros(n, dtype=bool)
+            for rule in self._overrides:
+                mask = rule["part_mask"][part_ids] & (severity > rule["min_severity"]) & ~resolved
+                if rule["keywords"]:
+                    type_match = np.array([any(k in t for k in rule["keywords"]) for t in type_labels])
+                    mask &= type_match[type_ids]
+                action_ids[mask] = rule["action"]
+                base_cost[mask] = rule["cost"]
+                resolved |= mask
+
+        return {
+            "action": [self.actions[i] for i in action_ids],
+            "base_cost": base_cost,
+            "cost": base_cost * np.asarray(multiplier, dtype=np.float64),
+        }
+
+    def refine_verdict(self, severity, part_name: str, base_cost=None) -> dict:
+        """Action and cost for a refined (multi-angle) severity."""
+        band = int(np.searchsorted(self._refine_bounds, float(severity), side="left"))
+        if base_cost is None:
+            base_cost = self._refine_base[self.part_id(part_name)]
+        return {
+            "action": self._refine_action[band],
+            "cost": int(base_cost * self._refine_multiplier[band]),
+        }
+
+    def refine_base_cost(self, part_name: str) -> int:
+        return int(self._refine_base[self.part_id(part_name)])
+
+    def describe(self) -> dict:
+        return {
+            "version": self.version,
+            "currency": self.currency,
+            "source": self.source,
+            "parts": self.part_names,
+            "actions": self.actions,
+        }
+
+
+# --- LOADING & HOT RELOAD ---
+
+_engine = None
+_engine_mtime = None
+_last_check = 0.0
+_lock = threading.Lock()
+
+
+def load_engine(path: str = PRICING_CONFIG) -> PricingEngine:
+    """Parse and compile a pricing config file (raises on invalid config)."""
+    with open(path, "r", encoding="utf-8") as f:
+        return PricingEngine(json.load(f), source=path)
+
+
+def reload_engine(force: bool = False) -> PricingEngine:
+    """
+    Re-read the config if it changed on disk (or always when force=True).
+    A broken config never replaces a working one: the previous version stays
+    active and the error is logged.
+    """
+    global _engine, _engine_mtime, _last_check
+    with _lock:
+        _last_check = time.monotonic()
+        try:
+            mtime = os.path.getmtime(PRICING_CONFIG)
+            if _engine is not None and not force and mtime == _engine_mtime:
+                return _engine
+            engine = load_engine(PRICING_CONFIG)
+        except Exception as e:
+            if _engine is None:
+                raise
+            metrics.increment("pricing_reload_errors")
+            print(f"⚠️ Pricing config reload failed, keeping v{_engine.version}: {e}")
+            return _engine
+
+        if _engine is not None:
+            metrics.increment("pricing_reloads")
+            print(f"💱 Pricing config reloaded: v{_engine.version} → v{engine.version}")
+        _engine, _engine_mtime = engine, mtime
+        return _engine
+
+
+def get_engine() -> PricingEngine:
+    """Current pricing engine, picking up config changes on disk."""
+    if _engine is None or time.monotonic() - _last_check >= PRICING_RELOAD_SECONDS:
+        return reload_engine()
+    return _engine
@@ -1,44 +1,151 @@
 # quality_service.py
+import os
+from dataclasses import dataclass, asdict
+from typing import Optional
+
 import cv2
 import numpy as np
 
+from resource_manager import cpu_stage
+
+# --- THRESHOLDS (same accept/reject limits as the full-resolution gate) ---
+BLUR_THRESHOLD = float(os.getenv("QUALITY_BLUR_THRESHOLD", "100"))       # Laplacian variance
+DARK_THRESHOLD = float(os.getenv("QUALITY_DARK_THRESHOLD", "50"))        # Mean gray intensity
+GLARE_PCT_THRESHOLD = float(os.getenv("QUALITY_GLARE_PCT_THRESHOLD", "5"))  # % near-white pixels
+
+# --- FIXED-SIZE SAMPLE ---
+# Statistics are computed on a GRID x GRID mosaic of TILE x TILE full-resolution
+# tiles (~590k pixels) instead of the whole 12MP frame. Tiles keep native
+# resolution, so Laplacian variance stays on the same scale as before (a
+# downsample would hide blur and shift the threshold).
+SAMPLE_GRID = 8
+SAMPLE_TILE = 96
+
+
+@dataclass
+class QualityMetrics:
+    """Outcome of the quality gate, reusable by later stages and metrics."""
+    passed: bool = True
+    reason: Optional[str] = None
+    blur_var: Optional[float] = None
+    mean_intensity: Optional[float] = None
+    glare_pct: Optional[float] = None
+    sampled_pixels: int = 0
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def sample_image(image):
+    """
+    Gather a fixed-size mosaic of evenly spaced full-resolution tiles.
+
+    Returns:
+        (sample, tile): the mosaic and tile size, or (image, None) when the
+        image is already smaller than the sample budget
+    """
+    h, w = image.shape[:2]
+    span = SAMPLE_GRID * SAMPLE_TILE
+    if h <= span or w <= span:
+        return image, None
+
+    offsets = np.arange(SAMPLE_TILE)
+    row_starts = np.linspace(0, h - SAMPLE_TILE, SAMPLE_GRID).astype(int)
+    col_starts = np.linspace(0, w - SAMPLE_TILE, SAMPLE_GRID).astype(int)
+    rows = (row_starts[:, None] + offsets).ravel()
+    cols = (col_starts[:, None] + offsets).ravel()
+    # Row gather first, then columns on the much smaller strip set
+    return image.take(rows, axis=0).take(cols, axis=1), SAMPLE_TILE
+
+
+def _laplacian_var(gray, tile):
+    """Laplacian variance, ignoring the artificial edges between mosaic tiles."""
+    laplacian = cv2.Laplacian(gray, cv2.CV_32F)
+    if tile is not None:
+        grid = laplacian.shape[0] // tile
+        laplacian = laplacian.reshape(grid, tile, grid, tile)[:, 1:-1, :, 1:-1]
+    return float(laplacian.var())
+
+
+def compute_quality_metrics(image, short_circuit=False):
+    """
+    Blur, exposure and glare statistics from one pass over a fixed-size sample.
+
+    Input: OpenCV Image (BGR numpy array)
+           short_circuit=True stops at the first failed check (gate mode)
+    Output: QualityMetrics
+    """
+    sample, tile = sample_image(image)
+    gray = cv2.cvtColor(sample, cv2.COLOR_BGR2GRAY)
+    result = QualityMetrics(sampled_pixels=int(gray.size))
+
+    # --- 1. BLUR CHECK (variance of Laplacian, higher = sharper) ---
+    result.blur_var = _laplacian_var(gray, tile)
+    if result.blur_var < BLUR_THRESHOLD:
+        result.passed, result.reason = False, "Too Blurry"
+        if short_circuit:
+            return result
+
+    # --- 2. DARKNESS CHECK (average pixel intensity) ---
+    result.mean_intensity = float(cv2.mean(gray)[0])
+    if result.mean_intensity < DARK_THRESHOLD and result.passed:
+        result.passed, result.reason = False, "Too Dark"
+        if short_circuit:
+            return result
+
+    # --- 3. GLARE CHECK (pixels near white in all channels) ---
+    white_pixels = cv2.countNonZero(cv2.inRange(sample, (250, 250, 250), (255, 255, 255)))
+    result.glare_pct = white_pixels / gray.size * 100
+    if result.glare_pct > GLARE_PCT_THRESHOLD and result.passed:
+        result.passed, result.reason = False, "Too Much Glare"
+
+    return result
+
 
 def validate_image_quality(image):
     """
     Validate image quality before AI processing.
-    
+
     Input: OpenCV Image (BGR numpy array)
-    Output: True if image passes all checks, otherwise error message string
+    Output: QualityMetrics (passed=False with a reason string on rejection)
     """
     try:
-        # --- 1. BLUR CHECK ---
-        # Convert to grayscale for Laplacian calculation
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Calculate variance of Laplacian (higher = sharper)
-        laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
-        
-        if laplacian_var < 100:
-            return "Too Blurry"
-        
-        # --- 2. DARKNESS CHECK ---
-        # Calculate average pixel intensity
-        mean_intensity = np.mean(gray)
-        
-        if mean_intensity < 50:
-            return "Too Dark"
-        
-        # --- 3. GLARE CHECK ---
-        # Count pixels that are pure white (255 in all channels)
-        white_pixels = np.sum(np.all(image >= 250, axis=2))
-        total_pixels = image.shape[0] * image.shape[1]
-        white_percentage = (white_pixels / total_pixels) * 100
-        
-        if white_percentage > 5:
-            return "Too Much Glare"
-        
-        # All checks passed
-        return True
-        
+        with cpu_stage("opencv"):
+            return compute_quality_metrics(image, short_circuit=True)
     except Exception as e:
-        return f"Quality Check Failed: {str(e)}"
+        return QualityMetrics(passed=False, reason=f"Quality Check Failed: {str(e)}")
+
+
+def legacy_quality_check(image):
+    """Original full-resolution gate, kept for calibration against the sampled one."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if cv2.Laplacian(gray, cv2.CV_64F).var() < BLUR_THRESHOLD:
+        return "Too Blurry"
+    if np.mean(gray) < DARK_THRESHOLD:
+        return "Too Dark"
+    white_pixels = np.sum(np.all(image >= 250, axis=2))
+    if white_pixels / (image.shape[0] * image.shape[1]) * 100 > GLARE_PCT_THRESHOLD:
+        return "Too Much Glare"
+    return True
+
+
+if __name__ == "__main__":
+    # Calibration: python quality_service.py <image dir>
+    # Reports how often the sampled gate agrees with the full-resolution one.
+    import sys
+
+    image_dir = sys.argv[1] if len(sys.argv) > 1 else "."
+    agree = total = 0
+    for name in sorted(os.listdir(image_dir)):
+        img = cv2.imread(os.path.join(image_dir, name))
+        if img is None:
+            continue
+        legacy = legacy_quality_check(img)
+        sampled = validate_image_quality(img)
+        legacy_reason = None if legacy is True else legacy
+        total += 1
+        agree += legacy_reason == sampled.reason
+        if legacy_reason != sampled.reason:
+            print(f"≠ {name}: full-res={legacy_reason} sampled={sampled.reason} ({sampled.to_dict()})")
+    if total:
+        print(f"📊 Agreement: {agree}/{total} ({agree / total * 100:.1f}%)")
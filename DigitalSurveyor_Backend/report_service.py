@@ -0,0 +1,269 @@
+# report_service.py
+"""
+Lazy PDF report generation.
+Reports are rendered from the stored scan data on first request to
+/reports/{scan_id} (or by a background pre-render, or many at once in a
+process pool for POST /reports/batch exports), then cached on disk keyed
+by an ETag of the data they were rendered from.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+from datetime import datetime
+
+from overlay_service import get_or_render_overlay
+from utils import metrics, storage
+from utils.pdf_generator import create_damage_report, render_reports_batch
+from utils.supabase_client import get_scan_by_id, get_damages_by_scan
+from utils.ttl_cache import TTLCache
+
+REPORT_CACHE_DIR = os.getenv("REPORT_CACHE_DIR", "report_cache")
+# Bump when the PDF layout changes so cached reports are re-rendered
+REPORT_TEMPLATE_VERSION = "1"
+# Batch exports (POST /reports/batch): process pool size and scans per request
+REPORT_BATCH_WORKERS = int(os.getenv("REPORT_BATCH_WORKERS", "2"))
+REPORT_BATCH_MAX_SCANS = int(os.getenv("REPORT_BATCH_MAX_SCANS", "50"))
+# How long a scan's report ETag is trusted without re-reading the scan
+REPORT_ETAG_TTL_SECONDS = float(os.getenv("REPORT_ETAG_TTL_SECONDS", "30"))
+
+os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+
+# scan_id -> (etag, pdf_path) of its cached report, so repeat downloads and
+# 304s skip Supabase; tagged by scan and damage ids for invalidation on writes
+_reports = TTLCache("report_etags", ttl=REPORT_ETAG_TTL_SECONDS, max_entries=4096)
+
+# Striped render locks (fixed memory) so concurrent first requests for a scan render once
+_render_locks = [threading.Lock() for _ in range(32)]
+
+
+def _lock_for(scan_id: str) -> threading.Lock:
+    return _render_locks[zlib.crc32(scan_id.encode("utf-8")) % len(_render_locks)]
+
+
+def _report_damages(scan: dict, damage_rows: list) -> list:
+    """
+    Prefer the damages table (reflects multi-angle refinement),
+    fall back to the damages JSON stored on the scan.
+    """
+    if not damage_rows:
+        return scan.get("damages") or []
+
+    return [{
+        "part": row.get("part_name", "Unknown"),
+        "type": row.get("damage_type", "Unknown"),
+        "severity": row.get("final_severity") or row.get("preliminary_severity") or 0,
+        "action": row.get("action") or "Repair",
+        "cost": row.get("cost") or 0,
+    } for row in damage_rows]
+
+
+def compute_report_etag(scan: dict, damages: list) -> str:
+    """Hash of everything the PDF is rendered from."""
+    source = {
+        "version": REPORT_TEMPLATE_VERSION,
+        "car_name": scan.get("car_name"),
+        "created_at": scan.get("created_at"),
+        "original": scan.get("original_image_url"),
+        "processed": scan.get("processed_image_url"),
+        "damages": [{k: d.get(k) for k in ("part", "type", "severity", "action", "cost")} for d in damages],
+    }
+    digest = hashlib.sha1(json.dumps(source, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return digest[:16]
+
+
+def _report_image_url(scan: dict, kind: str) -> str:
+    """Web-sized variant when the scan has one (the PDF never needs full resolution)."""
+    variants = (scan.get("image_variants") or {}).get(kind) or {}
+    return variants.get("web") or scan.get(f"{kind}_image_url")
+
+
+def _report_image(scan: dict, kind: str, dest_path: str) -> str:
+    """Local image for the PDF: overlays are rendered directly, photos downloaded."""
+    if kind == "processed" and scan.get("detections"):
+        path, _, _ = get_or_render_overlay(scan["id"], "processed", "web", fmt="jpeg",
+                                           records=scan["detections"])
+        return path
+    return _download(_report_image_url(scan, kind), dest_path)
+
+
+def _download(url: str, dest_path: str) -> str:
+    """Download an image for embedding; returns the path or None."""
+    if not url:
+        return None
+    try:
+        data = storage.fetch(url)
+        with open(dest_path, "wb") as f:
+            f.write(data)
+        return dest_path
+    except Exception as e:
+        print(f"⚠️ Could not download {url} for report: {e}")
+        return None
+
+
+def _parse_date(value):
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except Exception:
+        return None
+
+
+def _prepare(scan_id: str):
+    """
+    (scan, damages, etag, cached pdf path, cache tags) of a stored scan,
+    or None if it doesn't exist.
+    """
+    scan = get_scan_by_id(scan_id)
+    if not scan:
+        return None
+    damage_rows = get_damages_by_scan(scan_id)
+    damages = _report_damages(scan, damage_rows)
+    etag = compute_report_etag(scan, damages)
+    tags = [f"scan:{scan_id}"] + [f"damage:{row['id']}" for row in damage_rows or [] if row.get("id")]
+    return scan, damages, etag, os.path.join(REPORT_CACHE_DIR, f"{scan_id}_{etag}.pdf"), tags
+
+
+def _cached_report(scan_id: str):
+    """(pdf_path, etag) remembered for the scan while its file exists, else None."""
+    entry = _reports.get(scan_id)
+    if entry is None or not os.path.exists(entry[1]):
+        return None
+    metrics.increment("report_cache", result="hit")
+    return entry[1], entry[0]
+
+
+def invalidate_scan(scan_id: str):
+    """Call after writing a scan row: its report ETag is read again."""
+    _reports.invalidate_tag(f"scan:{scan_id}")
+
+
+def invalidate_damage(damage_id: str):
+    """Call after refining a damage: the report of its scan is re-checked."""
+    _reports.invalidate_tag(f"damage:{damage_id}")
+
+
+def _pdf_data(scan: dict, damages: list, work_dir: str) -> dict:
+    """create_damage_report() input, with the images fetched into work_dir."""
+    return {
+        "car_name": scan.get("car_name"),
+        "user_id": scan.get("user_id"),
+        "scan_id": scan["id"],
+        "scan_date": _parse_date(scan.get("created_at")),
+        "damages": damages,
+        "total_estimate": sum(d.get("cost", 0) for d in damages),
+        "currency": "INR",
+        "original_image_path": _report_image(scan, "original",
+                                             os.path.join(work_dir, "original.jpg")),
+        "processed_image_path": _report_image(scan, "processed",
+                                              os.path.join(work_dir, "processed.jpg")),
+    }
+
+
+def _publish(scan_id: str, tmp_pdf: str, pdf_path: str):
+    """Atomic publish, then drop reports rendered from stale data."""
+    os.replace(tmp_pdf, pdf_path)
+    for name in os.listdir(REPORT_CACHE_DIR):
+        if name.startswith(f"{scan_id}_") and name != os.path.basename(pdf_path):
+            os.remove(os.path.join(REPORT_CACHE_DIR, name))
+
+
+def get_or_render_report(scan_id: str):
+    """
+    Return the cached PDF for a scan, rendering it if needed.
+
+    Returns:
+        (pdf_path, etag), or (None, None) if the scan does not exist
+        or rendering failed
+    """
+    cached = _cached_report(scan_id)
+    if cached:
+        return cached
+
+    prepared = _prepare(scan_id)
+    if not prepared:
+        return None, None
+    scan, damages, etag, pdf_path, tags = prepared
+
+    if os.path.exists(pdf_path):
+        metrics.increment("report_cache", result="hit")
+        _reports.set(scan_id, (etag, pdf_path), tags=tags)
+        return pdf_path, etag
+
+    with _lock_for(scan_id):
+        # Another request may have rendered it while we waited
+        if os.path.exists(pdf_path):
+            metrics.increment("report_cache", result="hit")
+            _reports.set(scan_id, (etag, pdf_path), tags=tags)
+            return pdf_path, etag
+
+        metrics.increment("report_cache", result="miss")
+        work_dir = tempfile.mkdtemp(prefix="report_")
+        try:
+            tmp_pdf = os.path.join(work_dir, "report.pdf")
+            success = create_damage_report(_pdf_data(scan, damages, work_dir), tmp_pdf)
+            if not success:
+                return None, None
+
+            _publish(scan_id, tmp_pdf, pdf_path)
+            _reports.set(scan_id, (etag, pdf_path), tags=tags)
+            return pdf_path, etag
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def render_reports(scan_ids: list, max_workers: int = REPORT_BATCH_WORKERS) -> dict:
+    """
+    Warm the report cache for many scans at once (fleet / insurer exports).
+    Reports not cached yet are rendered together in a process pool.
+
+    Returns:
+        {scan_id: etag}, etag None if the scan does not exist or rendering failed
+    """
+    etags, pending = {}, []
+    work_dir = tempfile.mkdtemp(prefix="reports_")
+    try:
+        for scan_id in dict.fromkeys(scan_ids):
+            cached = _cached_report(scan_id)
+            if cached:
+                etags[scan_id] = cached[1]
+                continue
+            prepared = _prepare(scan_id)
+            if not prepared:
+                etags[scan_id] = None
+                continue
+            scan, damages, etag, pdf_path, tags = prepared
+            if os.path.exists(pdf_path):
+                metrics.increment("report_cache", result="hit")
+                _reports.set(scan_id, (etag, pdf_path), tags=tags)
+                etags[scan_id] = etag
+                continue
+
+            metrics.increment("report_cache", result="miss")
+            job_dir = os.path.join(work_dir, str(len(pending)))
+            os.makedirs(job_dir)
+            job = (_pdf_data(scan, damages, job_dir), os.path.join(job_dir, "report.pdf"))
+            pending.append((scan_id, etag, pdf_path, tags, job))
+
+        results = render_reports_batch([job for *_, job in pending], max_workers=max_workers)
+        for (scan_id, etag, pdf_path, tags, _), result in zip(pending, results):
+            etags[scan_id] = None
+            if result["success"]:
+                with _lock_for(scan_id):
+                    _publish(scan_id, result["output_path"], pdf_path)
+                _reports.set(scan_id, (etag, pdf_path), tags=tags)
+                etags[scan_id] = etag
+        return etags
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def prerender_report(scan_id: str):
+    """Background-task entry point: warm the report cache for a new scan."""
+    try:
+        get_or_render_report(scan_id)
+    except Exception as e:
+        print(f"⚠️ Report pre-render failed for {scan_id}: {e}")
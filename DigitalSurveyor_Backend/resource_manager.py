@@ -0,0 +1,271 @@
+# resource_manager.py
+"""
+CPU thread budgets for the inference pipeline.
+
+torch (YOLO), the transformers depth pipeline, OpenCV and NumPy/BLAS each
+default to one thread per core. With several uvicorn workers and
+concurrent requests that oversubscribes the CPU and tail latency explodes.
+
+Each worker gets CPU_THREADS_PER_WORKER threads (default: available cores
+divided by WEB_CONCURRENCY), applied to every library at startup:
+configure_process() must run before numpy/torch/cv2 are imported, because
+the BLAS/OpenMP pools read their size from the environment at import.
+
+Inference stages run inside cpu_stage(name): a stage holds its thread
+budget (CPU_STAGE_THREADS, e.g. "yolo=4,depth=2") from the worker's pool
+while it runs, so concurrent stages in one worker never use more threads
+than the worker owns. torch's intra-op pool is process-wide (as is
+OpenCV's): it is sized once at startup to the largest torch stage share,
+and the torch stages (yolo, depth) each hold that many threads while they
+run, whatever their own setting, since that is what torch will use. The
+OpenCV work (quality gate, CLAHE/letterbox views, severity, heatmaps) runs
+in the "opencv" stage, on OpenCV's pool sized to that stage's share.
+
+Benchmark mode sweeps thread/concurrency settings on this machine:
+    python resource_manager.py --image sample.jpg [--requests 12]
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+def available_cpus():
+    """Cores this process may run on (respects affinity/cgroup cpusets)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# Worker processes sharing the machine (uvicorn --workers / gunicorn)
+WEB_CONCURRENCY = max(int(os.getenv("WEB_CONCURRENCY", "1")), 1)
+CPU_THREADS_PER_WORKER = int(os.getenv("CPU_THREADS_PER_WORKER", "0")) or max(available_cpus() // WEB_CONCURRENCY, 1)
+# torch inter-op pool (parallel independent ops); inference graphs here are sequential
+CPU_INTEROP_THREADS = int(os.getenv("CPU_INTEROP_THREADS", "1"))
+
+STAGES = ("yolo", "depth", "opencv")
+# Stages that run on torch's process-wide intra-op pool
+TORCH_STAGES = ("yolo", "depth")
+
+# Libraries that size their pools from the environment at import time
+_THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                    "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS")
+
+
+def parse_stage_threads(spec: str, total: int) -> dict:
+    """'yolo=4,depth=2' -> per-stage threads (unlisted stages get the whole budget)."""
+    threads = {stage: total for stage in STAGES}
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        stage, _, value = item.partition("=")
+        if stage.strip() in threads and value.strip().isdigit():
+            threads[stage.strip()] = min(max(int(value), 1), total)
+    return threads
+
+
+STAGE_THREADS = parse_stage_threads(os.getenv("CPU_STAGE_THREADS", ""), CPU_THREADS_PER_WORKER)
+
+
+def torch_threads() -> int:
+    """Size of torch's intra-op pool: the largest torch stage share."""
+    return max(STAGE_THREADS[stage] for stage in TORCH_STAGES)
+
+
+class CpuBudget:
+    """Counting pool of this worker's threads; a running stage holds its share."""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.free = total
+        self._cond = threading.Condition()
+
+    def acquire(self, n: int):
+        n = min(n, self.total)
+        with self._cond:
+            while self.free < n:
+                self._cond.wait()
+            self.free -= n
+        return n
+
+    def release(self, n: int):
+        with self._cond:
+            self.free += n
+            self._cond.notify_all()
+
+
+_budget = CpuBudget(CPU_THREADS_PER_WORKER)
+_remote_stages = set()      # Stages run by another process (INFERENCE_MODE=gateway)
+_held = threading.local()   # Threads already inside a stage (nested stages reuse its share)
+_configured = False
+
+
+def configure_process(threads: int = None, interop: int = None):
+    """
+    Apply this worker's thread budget to every library. Call once, first
+    thing in the process (before numpy/torch/cv2 imports) for the
+    environment-driven pools to pick it up; later calls still resize torch
+    and OpenCV.
+    """
+    global _configured
+    threads = threads or CPU_THREADS_PER_WORKER
+    interop = interop or CPU_INTEROP_THREADS
+
+    for var in _THREAD_ENV_VARS:
+        os.environ.setdefault(var, str(threads))
+
+    # Both pools are process-wide: sized here once, never per stage
+    import cv2
+    cv2.setNumThreads(STAGE_THREADS["opencv"])
+
+    try:
+        import torch
+        torch.set_num_threads(torch_threads())
+        if not _configured:
+            try:
+                torch.set_num_interop_threads(interop)
+            except RuntimeError:
+                pass  # Inter-op pool already started; its size can't change any more
+    except ImportError:
+        pass
+
+    # BLAS pools that were already loaded ignore the environment
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=threads)
+    except ImportError:
+        pass
+
+    if not _configured:
+        print(f"🧮 CPU budget: {threads} thread(s)/worker of {available_cpus()} core(s), "
+              f"{WEB_CONCURRENCY} worker(s) | stages: {STAGE_THREADS}, torch pool: {torch_threads()}")
+    _configured = True
+
+
+@contextmanager
+def cpu_stage(stage: str):
+    """
+    Run a pipeline stage within its thread budget. Blocks while the
+    worker's other running stages hold the threads it needs. A stage
+    entered from inside another one runs on the outer stage's share.
+    Torch stages hold torch's process-wide pool size (torch_threads()).
+    """
+    from utils import metrics
+
+    if getattr(_held, "threads", 0):
+        yield _held.threads
+        return
+    if stage in _remote_stages:
+        yield 0
+        return
+
+    wait_start = time.perf_counter()
+    share = torch_threads() if stage in TORCH_STAGES else STAGE_THREADS.get(stage, _budget.total)
+    n = _budget.acquire(share)
+    metrics.observe("cpu_stage_wait_ms", (time.perf_counter() - wait_start) * 1000, stage=stage)
+    budget = _budget
+    _held.threads = n
+    try:
+        with metrics.timer("cpu_stage_ms", stage=stage):
+            yield n
+    finally:
+        _held.threads = 0
+        budget.release(n)
+
+
+def mark_remote(*stages):
+    """Stages whose work runs on another process: waiting on them holds none of this worker's threads."""
+    _remote_stages.update(stages)
+
+
+def set_budget(threads: int, stage_threads: dict = None):
+    """Resize the worker budget at runtime (used by the benchmark sweep)."""
+    global _budget
+    _budget = CpuBudget(threads)
+    STAGE_THREADS.update(stage_threads or {stage: threads for stage in STAGES})
+    configure_process(threads)
+
+
+# --- BENCHMARK MODE ---
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+def run_benchmark(image_path: str, requests: int = 12, thread_options=None, concurrency_options=None):
+    """
+    Sweep intra-op threads x concurrent requests on one worker and report
+    throughput and latency per setting. Each request runs the inference
+    stages of /analyze (parts + damage YOLO, frame depth) on the image.
+    """
+    import cv2
+    from concurrent.futures import ThreadPoolExecutor
+    from ultralytics import YOLO
+    from depth_service import estimate_frame_depth_batch, DEPTH_FRAME_MAX_SIDE
+    from utils.image_context import ImageContext
+
+    image = cv2.imread(image_path)
+    if image is None:
+        raise SystemExit(f"Could not read {image_path}")
+    model_parts, model_damage = YOLO("parts.pt"), YOLO("damage.pt")
+
+    cores = available_cpus()
+    thread_options = thread_options or sorted({1, 2, 4, cores // 2, cores} - {0})
+    concurrency_options = concurrency_options or [1, 2, 4]
+
+    def one_request():
+        start = time.perf_counter()
+        ctx = ImageContext(image)
+        with cpu_stage("yolo"):
+            model_parts(ctx.letterboxed(640).image, imgsz=640, verbose=False)
+            model_damage(ctx.letterboxed(1280, source="clahe").image, conf=0.25, imgsz=1280, verbose=False)
+        estimate_frame_depth_batch([ctx.resized(DEPTH_FRAME_MAX_SIDE)], [ctx.shape])
+        return time.perf_counter() - start
+
+    set_budget(cores)
+    one_request()  # Warm-up (model load, allocator)
+
+    rows = []
+    for threads in thread_options:
+        for concurrency in concurrency_options:
+            # Same total CPU as `concurrency` workers with `threads` threads each
+            set_budget(threads * concurrency, {stage: threads for stage in STAGES})
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                latencies = list(pool.map(lambda _: one_request(), range(requests)))
+            elapsed = time.perf_counter() - start
+            rows.append({
+                "threads": threads,
+                "concurrency": concurrency,
+                "oversubscribed": threads * concurrency > cores,
+                "throughput": requests / elapsed,
+                "p50_ms": _percentile(latencies, 50) * 1000,
+                "p95_ms": _percentile(latencies, 95) * 1000,
+            })
+            row = rows[-1]
+            print(f"threads={threads:<3} concurrency={concurrency:<3} "
+                  f"{row['throughput']:6.2f} img/s  p50={row['p50_ms']:7.0f}ms  p95={row['p95_ms']:7.0f}ms"
+                  f"{'  (oversubscribed)' if row['oversubscribed'] else ''}")
+
+    best_throughput = max(rows, key=lambda r: r["throughput"])
+    best_latency = min(rows, key=lambda r: r["p95_ms"])
+    for label, row in [("Best throughput", best_throughput), ("Best p95 latency", best_latency)]:
+        print(f"🏁 {label}: WEB_CONCURRENCY={row['concurrency']} "
+              f"CPU_THREADS_PER_WORKER={row['threads']} "
+              f"({row['throughput']:.2f} img/s, p95 {row['p95_ms']:.0f}ms)")
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Sweep CPU thread budgets for the inference pipeline")
+    parser.add_argument("--image", required=True, help="Sample car photo")
+    parser.add_argument("--requests", type=int, default=12, help="Requests per setting")
+    parser.add_argument("--threads", type=int, nargs="*", help="Intra-op thread counts to try")
+    parser.add_argument("--concurrency", type=int, nargs="*", help="Concurrent requests to try")
+    args = parser.parse_args()
+
+    configure_process(available_cpus())
+    run_benchmark(args.image, args.requests, args.threads, args.concurrency)
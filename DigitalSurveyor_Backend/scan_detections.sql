@@ -0,0 +1,7 @@
+-- Migration: Detection data for on-demand overlays
+-- Run this in Supabase SQL Editor
+
+-- Per analyzed image: {"image_index", "image_shape", "boxes": [{box, class, confidence}],
+--                      "heat": [{box, severity}], "source": {thumb, web, full}}
+-- processed/heatmap images are rendered from this by GET /scans/{id}/overlay/{view}
+ALTER TABLE scans ADD COLUMN IF NOT EXISTS detections jsonb;
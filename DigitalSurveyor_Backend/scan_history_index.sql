@@ -0,0 +1,7 @@
+-- Migration: Index for scan history keyset pagination (GET /scans)
+-- Run this in Supabase SQL Editor
+
+-- Serves: WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT n
+-- (and the (created_at, id) < cursor condition) without scanning all of a user's scans
+CREATE INDEX IF NOT EXISTS idx_scans_user_created
+  ON scans (user_id, created_at DESC, id DESC);
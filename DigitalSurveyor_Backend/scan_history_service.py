@@ -0,0 +1,125 @@
+# scan_history_service.py
+"""
+Read side of the scan history (Digital Garage).
+
+Lists use keyset pagination on (user_id, created_at, id) with a
+lightweight projection (no damages JSON), so a page costs the same no
+matter how many scans a user has. Lists and scan details sit behind a
+short-TTL cache that is invalidated when a scan is inserted or one of
+its damages is refined.
+"""
+
+import base64
+import binascii
+import json
+import os
+import uuid
+from datetime import datetime
+
+from utils import metrics
+from utils.supabase_client import list_scans_page, get_scan_by_id, get_damages_by_scan
+from utils.ttl_cache import TTLCache
+
+SCAN_CACHE_TTL_SECONDS = float(os.getenv("SCAN_CACHE_TTL_SECONDS", "30"))
+SCAN_CACHE_MAX_ENTRIES = int(os.getenv("SCAN_CACHE_MAX_ENTRIES", "2048"))
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Columns the garage cards need (the damages JSON blob is left out)
+SCAN_SUMMARY_COLUMNS = ",".join([
+    "id", "user_id", "car_name", "processed_image_url", "image_variants", "total_cost",
+    "damage_count", "status", "created_at"
+])
+
+_cache = TTLCache("scan_history", ttl=SCAN_CACHE_TTL_SECONDS, max_entries=SCAN_CACHE_MAX_ENTRIES)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(row: dict) -> str:
+    """Opaque cursor pointing just after `row`."""
+    raw = json.dumps([row["created_at"], row["id"]], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """
+    (created_at, id) from a cursor. Both end up inside a PostgREST filter
+    string, so only an ISO timestamp and a UUID are accepted.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, scan_id = json.loads(raw)
+        return datetime.fromisoformat(created_at).isoformat(), str(uuid.UUID(scan_id))
+    except (binascii.Error, ValueError, TypeError, AttributeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {e}")
+
+
+def list_user_scans(user_id: str, limit: int = DEFAULT_PAGE_SIZE, cursor: str = None) -> dict:
+    """
+    One page of a user's scan summaries, newest first.
+
+    Returns:
+        {"scans": [...], "next_cursor": str | None}, or None on database error
+    Raises:
+        InvalidCursor
+    """
+    limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+    after = decode_cursor(cursor) if cursor else None
+
+    def load():
+        with metrics.timer("scan_list_query_ms"):
+            # One extra row tells us whether there is a next page
+            rows = list_scans_page(user_id, limit + 1, after=after, columns=SCAN_SUMMARY_COLUMNS)
+        if rows is None:
+            return None
+        page = rows[:limit]
+        return {
+            "scans": page,
+            "next_cursor": encode_cursor(page[-1]) if len(rows) > limit else None
+        }
+
+    return _cache.get_or_load(("list", user_id, limit, cursor), load, tags=(f"user:{user_id}",))
+
+
+def get_scan_detail(scan_id: str) -> dict:
+    """
+    A scan with its damages: rows from the damages table (ids, refinement
+    state) when present, else the damages JSON stored on the scan.
+
+    Returns:
+        Scan dict with "damages" and "damage_source", or None if not found
+    """
+    def load():
+        with metrics.timer("scan_detail_query_ms"):
+            scan = get_scan_by_id(scan_id)
+            if not scan:
+                return None
+            damage_rows = get_damages_by_scan(scan_id)
+        stored = scan.pop("damages", None) or []
+        scan["damages"] = damage_rows or stored
+        scan["damage_source"] = "damages" if damage_rows else "scan"
+        return scan
+
+    # The tags are only known once loaded, so cache manually
+    scan = _cache.get(("scan", scan_id))
+    if scan is None:
+        scan = load()
+        if scan is not None:
+            tags = [f"scan:{scan_id}", f"user:{scan.get('user_id')}"]
+            tags += [f"damage:{row['id']}" for row in scan["damages"] if row.get("id")]
+            _cache.set(("scan", scan_id), scan, tags=tags)
+    return scan
+
+
+def invalidate_user(user_id: str):
+    """Call after inserting a scan: drops the user's cached list pages."""
+    _cache.invalidate_tag(f"user:{user_id}")
+
+
+def invalidate_damage(damage_id: str):
+    """Call after refining a damage: drops the cached scan detail it belongs to."""
+    _cache.invalidate_tag(f"damage:{damage_id}")
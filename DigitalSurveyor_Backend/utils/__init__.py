@@ -1,13 +1,24 @@
 # utils/__init__.py
-from .core import calculate_severity, generate_heatmap, encode_image_to_base64
-from .supabase_client import upload_to_storage, insert_scan_record
+from .core import calculate_severity, calculate_severities, generate_heatmap, encode_image_to_base64
 from .pdf_generator import create_damage_report
 
+# Imported on first use: the Supabase client needs credentials, which
+# offline tools (batch_process.py) and local storage don't have
+_LAZY_EXPORTS = {"upload_to_storage": "storage", "insert_scan_record": "supabase_client"}
+
 __all__ = [
     'calculate_severity',
+    'calculate_severities',
     'generate_heatmap', 
     'encode_image_to_base64',
     'upload_to_storage',
     'insert_scan_record',
     'create_damage_report'
 ]
+
+
+def __getattr__(name):
+    if name in _LAZY_EXPORTS:
+        import importlib
+        return getattr(importlib.import_module(f".{_LAZY_EXPORTS[name]}", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,64 @@
+# utils/auth.py
+"""
+Caller identity from the Supabase session token.
+
+The backend talks to Supabase with the service-role key, which bypasses
+row level security, so any endpoint returning a user's data must take the
+user id from a verified token, never from the request parameters:
+
+    Authorization: Bearer <session access_token>
+
+Supabase access tokens are HS256 JWTs signed with the project's JWT secret
+(SUPABASE_JWT_SECRET); the user id is the `sub` claim.
+"""
+
+import os
+
+from dotenv import load_dotenv
+from jose import JWTError, jwt
+
+load_dotenv()
+
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+SUPABASE_JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+
+
+class AuthError(Exception):
+    pass
+
+
+def bearer_token(headers) -> str:
+    """The token of an `Authorization: Bearer ...` header, or None."""
+    scheme, _, token = (headers.get("authorization") or "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return token.strip()
+
+
+def verify_token(token: str) -> str:
+    """User id (`sub`) of a valid session token. Raises AuthError."""
+    if not SUPABASE_JWT_SECRET:
+        raise AuthError("Authentication is not configured (SUPABASE_JWT_SECRET)")
+    try:
+        claims = jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=["HS256"], audience=SUPABASE_JWT_AUDIENCE)
+    except JWTError as e:
+        raise AuthError(f"Invalid session token: {e}")
+    if not claims.get("sub"):
+        raise AuthError("Session token has no subject")
+    return claims["sub"]
+
+
+def authenticated_user(headers) -> str:
+    """User id from the request's bearer token. Raises AuthError if missing or invalid."""
+    token = bearer_token(headers)
+    if not token:
+        raise AuthError("Missing bearer token")
+    return verify_token(token)
+
+
+def optional_user(headers) -> str:
+    """User id from a valid bearer token, or None (no token or an invalid one)."""
+    try:
+        return authenticated_user(headers)
+    except AuthError:
+        return None
@@ -0,0 +1,99 @@
+# utils/deadline.py
+"""
+Per-request deadline and cancellation.
+
+A RequestScope travels with one request into the threadpool. The async
+side cancels it when the client disconnects or the deadline passes; the
+pipeline calls scope.check("stage") between stages and stops with
+RequestCancelled instead of running depth, heatmaps and uploads for a
+response nobody will read. Compute spent before the stop is recorded as
+wasted_compute_ms.
+"""
+
+import os
+import time
+
+from . import metrics
+
+# Default budget per request; X-Request-Timeout-Ms can only shorten it
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "120"))
+DEADLINE_HEADER = "X-Request-Timeout-Ms"
+
+
+class RequestCancelled(Exception):
+    """Raised by RequestScope.check() once the request is cancelled."""
+
+    def __init__(self, reason: str, stage: str):
+        super().__init__(f"Request cancelled ({reason}) before stage '{stage}'")
+        self.reason = reason
+        self.stage = stage
+
+
+class RequestScope:
+    """
+    Usage:
+        scope = RequestScope("analyze", timeout_s=30)
+        scope.start()                 # Work begins (after admission)
+        scope.check("depth")          # Raises RequestCancelled if cancelled/expired
+        scope.cancel("client_disconnected")   # From another thread / the event loop
+    """
+
+    def __init__(self, endpoint: str, timeout_s: float = None):
+        self.endpoint = endpoint
+        self.timeout_s = REQUEST_DEADLINE_SECONDS if timeout_s is None else timeout_s
+        self.deadline = time.monotonic() + self.timeout_s
+        self.reason = None
+        self.stage = "queued"
+        self.work_started = None
+        self._recorded = False
+
+    @classmethod
+    def from_headers(cls, endpoint: str, headers) -> "RequestScope":
+        """Scope with the configured deadline, shortened by the client's timeout header."""
+        timeout_s = REQUEST_DEADLINE_SECONDS
+        value = headers.get(DEADLINE_HEADER) if headers is not None else None
+        if value:
+            try:
+                timeout_s = min(timeout_s, max(float(value), 0.0) / 1000)
+            except ValueError:
+                pass  # Malformed header: keep the configured deadline
+        return cls(endpoint, timeout_s)
+
+    @property
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining <= 0
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def start(self):
+        self.work_started = time.perf_counter()
+        self.stage = "started"
+
+    def cancel(self, reason: str):
+        if self.reason is None:
+            self.reason = reason
+
+    def check(self, stage: str):
+        """Stage boundary: stop here if the request was cancelled or ran out of time."""
+        if self.reason is None and self.expired:
+            self.cancel("deadline")
+        if self.reason is not None:
+            self.record()
+            raise RequestCancelled(self.reason, stage)
+        self.stage = stage
+
+    def record(self):
+        """Count the cancellation and the compute already spent on it (once)."""
+        if self._recorded or self.reason is None:
+            return
+        self._recorded = True
+        metrics.increment("requests_cancelled", endpoint=self.endpoint, reason=self.reason, stage=self.stage)
+        if self.work_started is not None:
+            metrics.observe("wasted_compute_ms", (time.perf_counter() - self.work_started) * 1000,
+                            endpoint=self.endpoint, reason=self.reason)
@@ -0,0 +1,190 @@
+# utils/image_context.py
+"""
+Per-request image context.
+One decoded frame is converted into many derived views (gray, LAB, CLAHE,
+resized, letterboxed, Laplacian integrals) by different stages.
+ImageContext computes each view lazily on first use and memoizes it, so no
+conversion runs twice per request.
+"""
+
+import threading
+
+import cv2
+import numpy as np
+
+# CLAHE settings used for scratch enhancement
+CLAHE_CLIP_LIMIT = 3.0
+CLAHE_TILE_GRID = (8, 8)
+
+# YOLO letterbox conventions (match ultralytics' rect LetterBox)
+LETTERBOX_STRIDE = 32
+LETTERBOX_COLOR = (114, 114, 114)
+
+# cv2 CLAHE objects are not thread-safe: one per thread, built once
+_thread_local = threading.local()
+
+
+def get_clahe():
+    """Thread-local cached CLAHE object."""
+    clahe = getattr(_thread_local, "clahe", None)
+    if clahe is None:
+        clahe = cv2.createCLAHE(clipLimit=CLAHE_CLIP_LIMIT, tileGridSize=CLAHE_TILE_GRID)
+        _thread_local.clahe = clahe
+    return clahe
+
+
+class LetterboxView:
+    """A letterboxed frame plus what's needed to map boxes back."""
+
+    def __init__(self, image, ratio, pad, source_shape):
+        self.image = image
+        self.ratio = ratio
+        self.pad = pad                    # (pad_x, pad_y) in letterboxed pixels
+        self.source_shape = source_shape  # (h, w) of the frame it came from
+
+    def to_source(self, boxes):
+        """Map Nx4 xyxy boxes from letterboxed to source coordinates."""
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4).copy()
+        boxes[:, [0, 2]] = (boxes[:, [0, 2]] - self.pad[0]) / self.ratio
+        boxes[:, [1, 3]] = (boxes[:, [1, 3]] - self.pad[1]) / self.ratio
+        h, w = self.source_shape
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, w)
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, h)
+        return boxes
+
+
+class LaplacianIntegrals:
+    """
+    Summed-area tables of a frame's Laplacian and its square, so the
+    Laplacian variance inside any box costs four lookups per table.
+    """
+
+    def __init__(self, total, squares, scale):
+        self.total = total      # (h+1, w+1) float64, cv2.integral2 layout
+        self.squares = squares
+        self.scale = scale      # (sx, sy) from source to table pixels
+
+    def variances(self, boxes):
+        """Laplacian variance inside each Nx4 xyxy box (source coordinates); NaN for empty boxes."""
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        h, w = self.total.shape[0] - 1, self.total.shape[1] - 1
+        sx, sy = self.scale
+        x1 = np.clip(np.floor(boxes[:, 0] * sx), 0, w).astype(np.intp)
+        y1 = np.clip(np.floor(boxes[:, 1] * sy), 0, h).astype(np.intp)
+        x2 = np.clip(np.ceil(boxes[:, 2] * sx), 0, w).astype(np.intp)
+        y2 = np.clip(np.ceil(boxes[:, 3] * sy), 0, h).astype(np.intp)
+        count = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        # Degenerate source boxes stay empty even though floor/ceil would widen them to a pixel
+        count[(boxes[:, 2] <= boxes[:, 0]) | (boxes[:, 3] <= boxes[:, 1])] = 0
+
+        def box_sums(table):
+            return table[y2, x2] - table[y1, x2] - table[y2, x1] + table[y1, x1]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = box_sums(self.total) / count
+            variance = box_sums(self.squares) / count - mean ** 2
+        # Clamp the tiny negatives float cancellation leaves on flat regions
+        return np.where(count > 0, np.maximum(variance, 0), np.nan)
+
+
+def as_context(image):
+    """Wrap a raw frame in an ImageContext (contexts pass through)."""
+    return image if isinstance(image, ImageContext) else ImageContext(image)
+
+
+class ImageContext:
+    """
+    Lazily computed, memoized views of one BGR frame.
+
+    Usage:
+        ctx = ImageContext(img)
+        ctx.gray, ctx.lab, ctx.clahe        # computed once, on first access
+        ctx.letterboxed(1280, source="clahe")
+        ctx.laplacian_integrals(1280).variances(boxes)
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self._views = {}
+        self.quality = None  # QualityMetrics, set by the quality gate
+        self.depth = None    # depth_service.FrameDepth, set in "frame" depth mode
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    def _memo(self, key, build):
+        view = self._views.get(key)
+        if view is None:
+            view = build()
+            self._views[key] = view
+        return view
+
+    @property
+    def gray(self):
+        return self._memo("gray", lambda: cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY))
+
+    @property
+    def lab(self):
+        return self._memo("lab", lambda: cv2.cvtColor(self.image, cv2.COLOR_BGR2LAB))
+
+    @property
+    def clahe(self):
+        """CLAHE on the L channel (LAB), back in BGR - the scratch-enhanced frame."""
+        def build():
+            lab = self.lab.copy()
+            lab[:, :, 0] = get_clahe().apply(np.ascontiguousarray(lab[:, :, 0]))
+            return cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+        return self._memo("clahe", build)
+
+    def view(self, source="image"):
+        """A named full-resolution view: 'image', 'gray', 'lab' or 'clahe'."""
+        return self.image if source == "image" else getattr(self, source)
+
+    def resized(self, max_side, source="image"):
+        """Downscaled copy whose long side is at most max_side (never upscaled)."""
+        def build():
+            frame = self.view(source)
+            h, w = frame.shape[:2]
+            scale = max_side / max(h, w)
+            if scale >= 1:
+                return frame
+            return cv2.resize(frame, (max(1, round(w * scale)), max(1, round(h * scale))),
+                              interpolation=cv2.INTER_AREA)
+        return self._memo(("resized", source, max_side), build)
+
+    def letterboxed(self, size, source="image"):
+        """
+        Letterbox exactly like ultralytics' rect inference (long side to
+        `size`, pad to a stride multiple), so YOLO skips its own resize.
+        """
+        def build():
+            frame = self.view(source)
+            h, w = frame.shape[:2]
+            ratio = size / max(h, w)
+            new_w, new_h = int(round(w * ratio)), int(round(h * ratio))
+            if (new_w, new_h) != (w, h):
+                frame = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+            dw = (size - new_w) % LETTERBOX_STRIDE / 2
+            dh = (size - new_h) % LETTERBOX_STRIDE / 2
+            top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+            left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+            if top or bottom or left or right:
+                frame = cv2.copyMakeBorder(frame, top, bottom, left, right,
+                                           cv2.BORDER_CONSTANT, value=LETTERBOX_COLOR)
+            return LetterboxView(frame, ratio, (left, top), (h, w))
+        return self._memo(("letterboxed", source, size), build)
+
+    def laplacian_integrals(self, max_side):
+        """
+        Integral images of the Laplacian of the (3x3-blurred) gray frame,
+        downscaled to max_side first: one pass per frame, however many
+        boxes are scored against it.
+        """
+        def build():
+            gray = self.resized(max_side, source="gray")
+            laplacian = cv2.Laplacian(cv2.GaussianBlur(gray, (3, 3), 0), cv2.CV_32F)
+            total, squares = cv2.integral2(laplacian, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+            h, w = self.image.shape[:2]
+            return LaplacianIntegrals(total, squares, (gray.shape[1] / w, gray.shape[0] / h))
+        return self._memo(("laplacian", max_side), build)
@@ -0,0 +1,98 @@
+# utils/image_variants.py
+"""
+Derivative sets for the images stored with a scan.
+
+Each stored image (original, processed, heatmap) is written as three
+variants: a thumbnail for garage cards, a web-sized copy for the result
+page and the full-resolution image, encoded as WebP (or JPEG) with a
+quality tuned per size. All variants of a scan are encoded in parallel
+(cv2.imencode releases the GIL).
+"""
+
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from . import metrics, tracing
+from .response_encoding import IMAGE_FORMATS, encode_image_bytes
+
+IMAGE_VARIANT_FORMAT = os.getenv("IMAGE_VARIANT_FORMAT", "webp")
+IMAGE_THUMB_PX = int(os.getenv("IMAGE_THUMB_PX", "320"))
+IMAGE_WEB_PX = int(os.getenv("IMAGE_WEB_PX", "1280"))
+IMAGE_ENCODE_WORKERS = int(os.getenv("IMAGE_ENCODE_WORKERS", "4"))
+
+# variant -> (longest side in px or None for full size, encoder quality)
+# Small variants tolerate lower quality: artifacts are hidden by the downscale
+VARIANTS = {
+    "thumb": (IMAGE_THUMB_PX, 70),
+    "web": (IMAGE_WEB_PX, 80),
+    "full": (None, 88),
+}
+
+_pool = ThreadPoolExecutor(max_workers=IMAGE_ENCODE_WORKERS, thread_name_prefix="image-variants")
+
+
+def resize_longest_side(image, max_side):
+    """Downscale so the longest side is at most `max_side` (never upscales)."""
+    h, w = image.shape[:2]
+    scale = max_side / max(h, w)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (max(int(w * scale), 1), max(int(h * scale), 1)), interpolation=cv2.INTER_AREA)
+
+
+def _encode_variant(image, variant, fmt):
+    max_side, quality = VARIANTS[variant]
+    if max_side is not None:
+        image = resize_longest_side(image, max_side)
+    with tracing.span("image_variant.encode", variant=variant), \
+            metrics.timer("image_variant_encode_ms", variant=variant, format=fmt):
+        data = encode_image_bytes(image, fmt, quality)
+    if data is None:
+        raise ValueError(f"{fmt} encoding failed for the {variant} variant")
+    metrics.observe("image_variant_bytes", len(data), variant=variant, format=fmt)
+    return data
+
+
+@tracing.span("image_variants")
+def stage_image_variants(upload_fn, images: list, name: str, fmt: str = None) -> dict:
+    """
+    Encode every variant of every image in parallel and stage the uploads.
+
+    A variant that would not be smaller than the next larger one (small
+    source image) reuses that variant's URL instead of storing a copy.
+
+    Args:
+        upload_fn: Callable(bytes, filename, folder) -> url (e.g. OutboxBatch.upload)
+        images: List of (kind, BGR image, storage folder)
+        name: Unique part of the file names (e.g. the short scan id)
+        fmt: 'webp' | 'jpeg' (default IMAGE_VARIANT_FORMAT)
+
+    Returns:
+        {kind: {"thumb": url, "web": url, "full": url}}
+    """
+    fmt = fmt or IMAGE_VARIANT_FORMAT
+    ext = IMAGE_FORMATS[fmt][0]
+
+    jobs = []
+    for kind, image, folder in images:
+        longest = max(image.shape[:2])
+        for variant, (max_side, _) in VARIANTS.items():
+            if max_side is None or max_side < longest:
+                # Encoder threads continue the request's trace
+                jobs.append((kind, folder, variant, _pool.submit(contextvars.copy_context().run,
+                                                                 _encode_variant, image, variant, fmt)))
+
+    urls = {kind: {} for kind, _, _ in images}
+    for kind, folder, variant, future in jobs:
+        urls[kind][variant] = upload_fn(future.result(), f"{kind}_{name}_{variant}{ext}", folder)
+
+    # Variants skipped for small images point at the next larger one
+    for kind, encoded in urls.items():
+        fallback = encoded["full"]
+        for variant in reversed(list(VARIANTS)):
+            fallback = encoded.setdefault(variant, fallback)
+        urls[kind] = {variant: encoded[variant] for variant in VARIANTS}
+    return urls
@@ -0,0 +1,104 @@
+# utils/metrics.py
+"""
+In-process metrics registry.
+Counters and value summaries (count/sum/min/max/percentiles) that the
+pipeline stages record into, exposed as JSON by the /metrics endpoint.
+"""
+
+import threading
+import time
+from collections import defaultdict, deque
+
+# Keep a bounded window of raw samples per summary for percentiles
+_MAX_SAMPLES = 1000
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_summaries = {}
+
+
+def _key(name: str, labels: dict = None) -> str:
+    """Build a flat metric key like 'name{a=1,b=2}'."""
+    if not labels:
+        return name
+    label_str = ",".join(f"{k}={labels[k]}" for k in sorted(labels))
+    return f"{name}{{{label_str}}}"
+
+
+def increment(name: str, value: int = 1, **labels):
+    """Increase a counter (e.g. increment('quality_rejections', reason='Too Dark'))."""
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def observe(name: str, value: float, **labels):
+    """Record one sample of a value (sizes, durations, scores)."""
+    key = _key(name, labels)
+    with _lock:
+        summary = _summaries.get(key)
+        if summary is None:
+            summary = {"count": 0, "sum": 0.0, "min": value, "max": value,
+                       "samples": deque(maxlen=_MAX_SAMPLES)}
+            _summaries[key] = summary
+        summary["count"] += 1
+        summary["sum"] += value
+        summary["min"] = min(summary["min"], value)
+        summary["max"] = max(summary["max"], value)
+        summary["samples"].append(value)
+
+
+class timer:
+    """
+    Context manager that records elapsed milliseconds into a summary.
+
+    Usage:
+        with metrics.timer("pdf_render_ms"):
+            ...
+    """
+
+    def __init__(self, name: str, **labels):
+        self.name = name
+        self.labels = labels
+        self.elapsed_ms = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed_ms = (time.perf_counter() - self._start) * 1000
+        observe(self.name, self.elapsed_ms, **self.labels)
+        return False
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def snapshot() -> dict:
+    """Return all counters and summaries as a JSON-serializable dict."""
+    with _lock:
+        counters = dict(_counters)
+        summaries = {}
+        for key, summary in _summaries.items():
+            values = sorted(summary["samples"])
+            summaries[key] = {
+                "count": summary["count"],
+                "avg": round(summary["sum"] / summary["count"], 3),
+                "min": round(summary["min"], 3),
+                "max": round(summary["max"], 3),
+                "p50": round(_percentile(values, 50), 3),
+                "p95": round(_percentile(values, 95), 3),
+                "p99": round(_percentile(values, 99), 3),
+            }
+    return {"counters": counters, "summaries": summaries}
+
+
+def reset():
+    """Clear all metrics (used by benchmarks)."""
+    with _lock:
+        _counters.clear()
+        _summaries.clear()
@@ -1,27 +1,132 @@
 # utils/pdf_generator.py
 from fpdf import FPDF
 import os
+import io
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
 from datetime import datetime
+from functools import lru_cache
+
+import cv2
+from PIL import Image
+
+from . import metrics, tracing
+
+# --- LAYOUT ---
+# Images are shown 90mm wide; embedding more pixels than ~150 DPI at that
+# width only bloats the file, so images are downscaled before embedding.
+IMAGE_WIDTH_MM = 90
+IMAGE_DPI = 150
+IMAGE_JPEG_QUALITY = 75
+
+
+class ReportTemplate:
+    """
+    Static parts of the report (styles, table layout, fixed text), resolved
+    once per process and shared by every report instead of being rebuilt.
+    """
+
+    def __init__(self):
+        # name -> (font family, style, size, text RGB)
+        self.styles = {
+            'title': ('Arial', 'B', 16, (30, 58, 138)),
+            'footer': ('Arial', 'I', 8, (128, 128, 128)),
+            'section': ('Arial', 'B', 14, (0, 0, 0)),
+            'subsection': ('Arial', 'B', 12, (0, 0, 0)),
+            'body': ('Arial', '', 11, (0, 0, 0)),
+            'table_header': ('Arial', 'B', 10, (255, 255, 255)),
+            'table_row': ('Arial', '', 9, (0, 0, 0)),
+            'total': ('Arial', 'B', 12, (0, 0, 0)),
+            'note': ('Arial', 'I', 9, (100, 100, 100)),
+        }
+        self.title = 'Digital Surveyor - Damage Assessment Report'
+        self.col_widths = [40, 35, 25, 50, 30]
+        self.headers = ['Part', 'Damage Type', 'Severity', 'Recommended Action', 'Cost']
+        self.disclaimer = (
+            "Note: This is an AI-generated estimate. Actual repair costs may vary based on "
+            "location, parts availability, and labor rates. Please consult a certified mechanic "
+            "for a final quote."
+        )
+        self.image_max_px = int(IMAGE_WIDTH_MM / 25.4 * IMAGE_DPI)
+
+    def apply(self, pdf, style_name):
+        """Set font and text color for a named style."""
+        family, style, size, color = self.styles[style_name]
+        pdf.set_font(family, style, size)
+        pdf.set_text_color(*color)
+
+
+@lru_cache(maxsize=1)
+def get_report_template() -> ReportTemplate:
+    """Process-wide cached report template."""
+    return ReportTemplate()
 
 
 class DamagePDF(FPDF):
     """Custom PDF class for Digital Surveyor damage reports."""
     
+    def __init__(self, template: ReportTemplate = None):
+        super().__init__()
+        self.template = template or get_report_template()
+    
     def header(self):
         """Page header with branding."""
-        self.set_font('Arial', 'B', 16)
-        self.set_text_color(30, 58, 138)  # Blue
-        self.cell(0, 10, 'Digital Surveyor - Damage Assessment Report', align='C', ln=True)
+        self.template.apply(self, 'title')
+        self.cell(0, 10, self.template.title, align='C', ln=True)
         self.ln(5)
     
     def footer(self):
         """Page footer with page number."""
         self.set_y(-15)
-        self.set_font('Arial', 'I', 8)
-        self.set_text_color(128, 128, 128)
+        self.template.apply(self, 'footer')
         self.cell(0, 10, f'Page {self.page_no()}', align='C')
 
 
+@tracing.span("pdf.prepare_image")
+def prepare_report_image(image, max_width_px: int = None, quality: int = IMAGE_JPEG_QUALITY):
+    """
+    Downscale and recompress an image to the size it is displayed at.
+    
+    Args:
+        image: Local file path or BGR numpy array
+        max_width_px: Target width (defaults to the template's layout width)
+        quality: JPEG quality for the embedded copy
+    
+    Returns:
+        io.BytesIO with JPEG data, or None if the image can't be read
+    """
+    max_width_px = max_width_px or get_report_template().image_max_px
+    
+    if isinstance(image, str):
+        # JPEG draft mode decodes straight at a reduced scale (DCT scaling),
+        # so a 12MP photo is never fully decoded just to be shrunk
+        with Image.open(image) as pil_image:
+            target_h = max(1, pil_image.height * max_width_px // pil_image.width)
+            pil_image.draft('RGB', (max_width_px, target_h))
+            pil_image = pil_image.convert('RGB')
+            if pil_image.width > max_width_px:
+                pil_image = pil_image.resize((max_width_px, target_h), Image.BILINEAR)
+            buffer = io.BytesIO()
+            pil_image.save(buffer, 'JPEG', quality=quality)
+            buffer.seek(0)
+            return buffer
+    
+    if image is None or image.size == 0:
+        return None
+    
+    h, w = image.shape[:2]
+    if w > max_width_px:
+        new_h = max(1, int(h * max_width_px / w))
+        image = cv2.resize(image, (max_width_px, new_h), interpolation=cv2.INTER_AREA)
+    
+    is_success, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return io.BytesIO(buffer.tobytes()) if is_success else None
+
+
+@tracing.span("pdf.render")
 def create_damage_report(scan_data: dict, output_path: str) -> bool:
     """
     Generate a branded PDF report for the damage assessment.
@@ -33,6 +138,7 @@ def create_damage_report(scan_data: dict, output_path: str) -> bool:
             - damages: list of damage dicts
             - total_estimate: float
             - currency: str
+            - scan_date: datetime (optional, defaults to now)
             - original_image_path: str (optional, local path)
             - processed_image_path: str (optional, local path)
         output_path: Where to save the PDF
@@ -41,61 +147,62 @@ def create_damage_report(scan_data: dict, output_path: str) -> bool:
         bool: True if successful
     """
     try:
-        pdf = DamagePDF()
+        start = time.perf_counter()
+        template = get_report_template()
+        pdf = DamagePDF(template)
         pdf.add_page()
         
         # === VEHICLE INFORMATION ===
-        pdf.set_font('Arial', 'B', 14)
-        pdf.set_text_color(0, 0, 0)
+        template.apply(pdf, 'section')
         pdf.cell(0, 10, 'Vehicle Information', ln=True)
         pdf.ln(2)
         
-        pdf.set_font('Arial', '', 11)
+        template.apply(pdf, 'body')
         pdf.cell(0, 8, f"Vehicle: {scan_data.get('car_name', 'Unknown')}",ln=True)
-        pdf.cell(0, 8, f"Scan Date: {datetime.now().strftime('%B %d, %Y at %H:%M')}",  ln=True)
+        scan_date = scan_data.get('scan_date') or datetime.now()
+        pdf.cell(0, 8, f"Scan Date: {scan_date.strftime('%B %d, %Y at %H:%M')}",  ln=True)
         pdf.cell(0, 8, f"Report ID: {scan_data.get('scan_id', 'N/A')[:8]}...", ln=True)
         pdf.ln(5)
         
-        # === IMAGES (if local paths available) ===
-        if scan_data.get('original_image_path') and os.path.exists(scan_data['original_image_path']):
-            pdf.set_font('Arial', 'B', 12)
-            pdf.cell(0, 10, 'Original Image', ln=True)
-            try:
-                pdf.image(scan_data['original_image_path'], x=10, w=90)
-                pdf.ln(5)
-            except Exception as e:
-                print(f"Could not embed original image: {e}")
+        # === IMAGES (if local paths available, downscaled to layout size) ===
+        # Decoding dominates and releases the GIL, so both are prepared in parallel
+        image_sections = [(key, title) for key, title in [
+            ('original_image_path', 'Original Image'),
+            ('processed_image_path', 'AI Detection Results')
+        ] if scan_data.get(key) and os.path.exists(scan_data[key])]
+        
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [pool.submit(prepare_report_image, scan_data[key], template.image_max_px)
+                       for key, _ in image_sections]
         
-        if scan_data.get('processed_image_path') and os.path.exists(scan_data['processed_image_path']):
-            pdf.set_font('Arial', 'B', 12)
-            pdf.cell(0, 10, 'AI Detection Results', ln=True)
+        for (key, title), future in zip(image_sections, futures):
+            template.apply(pdf, 'subsection')
+            pdf.cell(0, 10, title, ln=True)
             try:
-                pdf.image(scan_data['processed_image_path'], x=10, w=90)
-                pdf.ln(5)
+                image_data = future.result()
+                if image_data is not None:
+                    pdf.image(image_data, x=10, w=IMAGE_WIDTH_MM)
+                    pdf.ln(5)
             except Exception as e:
-                print(f"Could not embed processed image: {e}")
+                print(f"Could not embed {title.lower()}: {e}")
         
         # === DAMAGE BREAKDOWN TABLE ===
         pdf.add_page()
-        pdf.set_font('Arial', 'B', 14)
+        template.apply(pdf, 'section')
         pdf.cell(0, 10, 'Damage Breakdown', ln=True)
         pdf.ln(3)
         
         # Table Header
-        pdf.set_font('Arial', 'B', 10)
+        template.apply(pdf, 'table_header')
         pdf.set_fill_color(30, 58, 138)  # Blue background
-        pdf.set_text_color(255, 255, 255)  # White text
         
-        col_widths = [40, 35, 25, 50, 30]
-        headers = ['Part', 'Damage Type', 'Severity', 'Recommended Action', 'Cost']
-        
-        for i, header in enumerate(headers):
+        col_widths = template.col_widths
+        for i, header in enumerate(template.headers):
             pdf.cell(col_widths[i], 10, header, border=1, align='C', fill=True)
         pdf.ln()
         
         # Table Rows
-        pdf.set_font('Arial', '', 9)
-        pdf.set_text_color(0, 0, 0)
+        template.apply(pdf, 'table_row')
         
         damages = scan_data.get('damages', [])
         currency_symbol = 'Rs.' if scan_data.get('currency') == 'INR' else '$'
@@ -110,7 +217,7 @@ def create_damage_report(scan_data: dict, output_path: str) -> bool:
         
         # Total Cost
         pdf.ln(5)
-        pdf.set_font('Arial', 'B', 12)
+        template.apply(pdf, 'total')
         pdf.set_fill_color(240, 240, 240)
         pdf.cell(sum(col_widths[:4]), 10, 'TOTAL ESTIMATED COST:', border=1, fill=True)
         pdf.set_text_color(220, 38, 38)  # Red for emphasis
@@ -119,19 +226,90 @@ def create_damage_report(scan_data: dict, output_path: str) -> bool:
         pdf.ln(10)
         
         # === FOOTER NOTE ===
-        pdf.set_font('Arial', 'I', 9)
-        pdf.set_text_color(100, 100, 100)
-        pdf.multi_cell(0, 5, 
-            "Note: This is an AI-generated estimate. Actual repair costs may vary based on "
-            "location, parts availability, and labor rates. Please consult a certified mechanic "
-            "for a final quote."
-        )
+        template.apply(pdf, 'note')
+        pdf.multi_cell(0, 5, template.disclaimer)
         
         # Save PDF
         pdf.output(output_path)
+        
+        # Track render time and output size
+        metrics.observe("pdf_render_ms", (time.perf_counter() - start) * 1000)
+        metrics.observe("pdf_bytes", os.path.getsize(output_path))
         print(f"✅ PDF generated: {output_path}")
         return True
         
     except Exception as e:
         print(f"⚠️ PDF generation error: {e}")
         return False
+
+
+def _render_report_job(job):
+    """Process-pool worker: render one report and report its cost."""
+    scan_data, output_path = job
+    start = time.perf_counter()
+    success = create_damage_report(scan_data, output_path)
+    return {
+        "output_path": output_path,
+        "success": success,
+        "render_ms": round((time.perf_counter() - start) * 1000, 2),
+        "bytes": os.path.getsize(output_path) if success else 0
+    }
+
+
+# One long-lived pool per process, created on first batch
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+
+def _get_batch_pool(max_workers: int = None) -> ProcessPoolExecutor:
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            # spawn: forking a threaded server after torch/OpenMP initialized is unsafe
+            _batch_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context("spawn"))
+        return _batch_pool
+
+
+def shutdown_batch_pool():
+    """Stop the batch render workers (server shutdown)."""
+    global _batch_pool
+    with _batch_pool_lock:
+        pool, _batch_pool = _batch_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def render_reports_batch(jobs: list, max_workers: int = None) -> list:
+    """
+    Render many reports in a process pool (fleet / insurer exports).
+    
+    Args:
+        jobs: List of (scan_data, output_path) tuples, same scan_data as create_damage_report
+        max_workers: Pool size on first use (defaults to CPU count); the pool is kept for later batches
+    
+    Returns:
+        List of {"output_path", "success", "render_ms", "bytes"} in job order
+    """
+    global _batch_pool
+    if not jobs:
+        return []
+    
+    pool = _get_batch_pool(max_workers)
+    try:
+        results = list(pool.map(_render_report_job, jobs, chunksize=max(1, len(jobs) // 32)))
+    except BrokenProcessPool:
+        # A worker died: start a fresh pool for the next batch
+        with _batch_pool_lock:
+            if _batch_pool is pool:
+                _batch_pool = None
+        raise
+    
+    # Workers record into their own process; mirror the totals here
+    for result in results:
+        if result["success"]:
+            metrics.observe("pdf_render_ms", result["render_ms"], mode="batch")
+            metrics.observe("pdf_bytes", result["bytes"], mode="batch")
+    
+    succeeded = sum(1 for r in results if r["success"])
+    print(f"✅ Batch rendered {succeeded}/{len(jobs)} reports")
+    return results
@@ -0,0 +1,170 @@
+# utils/response_encoding.py
+"""
+Compact encodings for the per-damage heatmaps in /analyze responses.
+
+Modes (chosen by the client with the `heatmap_mode` form field):
+    inline    - base64 inside the JSON (legacy: PNG for dents, full-frame JPEG for scratches)
+    crop      - base64 inside the JSON, cropped to the damage and encoded as WebP/JPEG
+    url       - cropped heatmaps uploaded to storage, only URLs in the JSON
+    multipart - multipart/mixed response: JSON part + one binary part per heatmap
+"""
+
+import base64
+import json
+import uuid
+
+import cv2
+import numpy as np
+from fastapi.responses import Response
+
+from . import metrics, tracing
+
+HEATMAP_MODES = ("inline", "crop", "url", "multipart")
+
+# format -> (file extension, OpenCV quality flag, MIME type)
+IMAGE_FORMATS = {
+    "webp": (".webp", cv2.IMWRITE_WEBP_QUALITY, "image/webp"),
+    "jpeg": (".jpg", cv2.IMWRITE_JPEG_QUALITY, "image/jpeg"),
+    "png": (".png", None, "image/png"),
+}
+
+# Extra context kept around the damage box when cropping (fraction of box size)
+CROP_MARGIN = 0.15
+
+
+def encode_image_bytes(image, fmt: str = "jpeg", quality: int = None) -> bytes:
+    """
+    Encode a BGR image to bytes.
+
+    Args:
+        image: BGR numpy array
+        fmt: 'webp' | 'jpeg' | 'png'
+        quality: 1-100 for webp/jpeg (None = OpenCV default)
+
+    Returns:
+        Encoded bytes, or None on failure
+    """
+    ext, quality_flag, _ = IMAGE_FORMATS[fmt]
+    params = [quality_flag, int(quality)] if quality_flag is not None and quality is not None else []
+    is_success, buffer = cv2.imencode(ext, image, params)
+    return buffer.tobytes() if is_success else None
+
+
+def crop_to_box(image, box, margin: float = CROP_MARGIN):
+    """Crop an image to a damage box plus a small margin of context."""
+    h, w = image.shape[:2]
+    x1, y1, x2, y2 = map(int, box)
+    pad_x = int((x2 - x1) * margin)
+    pad_y = int((y2 - y1) * margin)
+    x1, y1 = max(0, x1 - pad_x), max(0, y1 - pad_y)
+    x2, y2 = min(w, x2 + pad_x), min(h, y2 + pad_y)
+    if x2 <= x1 or y2 <= y1:
+        return image
+    return image[y1:y2, x1:x2]
+
+
+@tracing.span("encode_heatmaps")
+def encode_damage_heatmaps(damages: list, mode: str = "inline", fmt: str = "webp",
+                           quality: int = 80, upload_fn=None) -> list:
+    """
+    Replace the raw heatmap arrays left by process_damage() with the
+    encoding requested by the client. Mutates `damages` in place.
+
+    Args:
+        damages: Damage dicts carrying the private '_heatmap_image' / '_heatmap_is_crop' keys
+                 (all other '_'-prefixed keys are removed as well)
+        mode: One of HEATMAP_MODES
+        fmt: 'webp' | 'jpeg' for the crop/url/multipart modes
+        quality: Encoder quality (1-100) for the crop/url/multipart modes
+        upload_fn: Callable(bytes, filename, folder) -> url, required for 'url' mode
+
+    Returns:
+        List of (content_id, bytes, mime_type) binary parts (only filled in 'multipart' mode)
+    """
+    parts = []
+
+    for idx, damage in enumerate(damages):
+        image = damage.pop("_heatmap_image", None)
+        is_crop = damage.pop("_heatmap_is_crop", False)
+        # Drop any other pipeline-internal keys
+        for key in [k for k in damage if k.startswith("_")]:
+            del damage[key]
+        damage["heatmap"] = None
+
+        if image is None:
+            continue
+
+        # Legacy inline: dents were PNG overlays, scratches full-frame JPEGs
+        if mode == "inline":
+            data = encode_image_bytes(image, "png" if is_crop else "jpeg")
+            if data:
+                damage["heatmap"] = base64.b64encode(data).decode("utf-8")
+            continue
+
+        if not is_crop:
+            image = crop_to_box(image, damage["box"])
+        data = encode_image_bytes(image, fmt, quality)
+        if not data:
+            continue
+
+        damage["heatmap_format"] = fmt
+        metrics.observe("heatmap_bytes", len(data), mode=mode)
+
+        if mode == "crop":
+            damage["heatmap"] = base64.b64encode(data).decode("utf-8")
+        elif mode == "url":
+            ext = IMAGE_FORMATS[fmt][0]
+            damage["heatmap_url"] = upload_fn(data, f"heatmap_{idx}{ext}", "heatmaps") if upload_fn else None
+        elif mode == "multipart":
+            content_id = f"heatmap-{idx}"
+            damage["heatmap_part"] = content_id
+            parts.append((content_id, data, IMAGE_FORMATS[fmt][2]))
+
+    return parts
+
+
+def json_default(value):
+    """Serialize numpy scalars/arrays that slip into the payload."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def build_analyze_response(payload: dict, parts: list = None, mode: str = "inline") -> Response:
+    """
+    Serialize an analysis payload into a JSON or multipart/mixed response,
+    recording payload size and serialization time.
+
+    Args:
+        payload: JSON-serializable response dict
+        parts: Binary parts from encode_damage_heatmaps() (multipart mode)
+        mode: Heatmap mode, used as a metrics label
+
+    Returns:
+        fastapi Response
+    """
+    with metrics.timer("response_serialize_ms", mode=mode):
+        body = json.dumps(payload, separators=(",", ":"), default=json_default).encode("utf-8")
+        media_type = "application/json"
+
+        if mode == "multipart":
+            boundary = uuid.uuid4().hex
+            chunks = [
+                f"--{boundary}\r\nContent-Type: application/json\r\nContent-ID: <report>\r\n\r\n".encode(),
+                body,
+                b"\r\n",
+            ]
+            for content_id, data, mime_type in parts or []:
+                chunks.append(
+                    f"--{boundary}\r\nContent-Type: {mime_type}\r\nContent-ID: <{content_id}>\r\n\r\n".encode()
+                )
+                chunks.append(data)
+                chunks.append(b"\r\n")
+            chunks.append(f"--{boundary}--\r\n".encode())
+            body = b"".join(chunks)
+            media_type = f"multipart/mixed; boundary={boundary}"
+
+    metrics.observe("response_bytes", len(body), mode=mode)
+    return Response(content=body, media_type=media_type)
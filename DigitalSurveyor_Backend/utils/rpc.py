@@ -0,0 +1,143 @@
+# utils/rpc.py
+"""
+Framing for the gateway <-> inference server RPC.
+
+One message = fixed prefix, JSON header, then the raw bytes of each array:
+
+    b"DSRP" | u32 header length | u32 array count | header JSON
+    | (u64 byte count | array bytes) per inline array
+
+Arrays travel as their raw buffers (no pickle, no image encoding), so
+nothing received can execute code and nothing is re-encoded. When both
+ends share a host, the sender may instead put an array in its shared-memory
+ring (utils.shm_ring) and send only the slot handle; the receiver reads
+it in place and releases the slot when done (Message.release()). Only
+rings announced during the connection handshake are read from.
+"""
+
+import json
+import os
+import socket
+import struct
+
+import numpy as np
+
+from .shm_ring import FrameHandle, FrameTooLarge, RingFull, ShmRing, StaleHandle
+
+MAGIC = b"DSRP"
+_PREFIX = struct.Struct("!4sII")
+_LENGTH = struct.Struct("!Q")
+MAX_HEADER_BYTES = 1 << 20
+# Sizes come from the peer: anything larger is refused before allocating.
+# A 1280px letterboxed frame is ~5 MB, a 12MP frame ~36 MB.
+MAX_ARRAY_BYTES = int(float(os.getenv("RPC_MAX_ARRAY_MB", "64")) * (1 << 20))
+MAX_MESSAGE_BYTES = int(float(os.getenv("RPC_MAX_MESSAGE_MB", "512")) * (1 << 20))
+
+
+class ProtocolError(Exception):
+    """The peer sent something that isn't a valid message."""
+
+
+class Message:
+    """A received message: `header` dict and `arrays` (shared-memory ones are views)."""
+
+    def __init__(self, header: dict, arrays: list, leases: list):
+        self.header = header
+        self.arrays = arrays
+        self._leases = leases  # (ring, handle) to release once the arrays are no longer needed
+
+    def release(self):
+        """Give shared-memory slots back to the sender (arrays from them become invalid)."""
+        leases, self._leases = self._leases, []
+        self.arrays = None
+        for ring, handle in leases:
+            ring.release(handle)
+
+
+def _recv_exact(sock: socket.socket, n: int) -> bytearray:
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        chunk = sock.recv_into(view[got:], n - got)
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        got += chunk
+    return buf
+
+
+def send_message(sock: socket.socket, header: dict, arrays=(), ring: ShmRing = None):
+    """
+    Send `header` plus `arrays`. With `ring`, arrays are handed over through
+    shared memory when they fit (falling back to inline bytes otherwise).
+
+    Returns:
+        Handles of the slots used; the sender releases them once the reply
+        is in (a no-op if the peer already did), so a lost peer leaks nothing.
+    """
+    specs, inline, handles = [], [], []
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        if ring is not None:
+            try:
+                handles.append(ring.put(array, tag=header.get("method", "")))
+                specs.append({"shm": handles[-1].to_dict()})
+                continue
+            except (RingFull, FrameTooLarge):
+                pass  # Counted by the ring as shm_fallbacks
+        specs.append({"shape": list(array.shape), "dtype": array.dtype.str})
+        inline.append(array)
+
+    encoded = json.dumps({**header, "arrays": specs}, separators=(",", ":")).encode("utf-8")
+    sock.sendall(_PREFIX.pack(MAGIC, len(encoded), len(specs)) + encoded)
+    for array in inline:
+        sock.sendall(_LENGTH.pack(array.nbytes))
+        if array.nbytes:
+            sock.sendall(memoryview(array).cast("B"))
+    return handles
+
+
+def recv_message(sock: socket.socket, rings: dict = None) -> Message:
+    """
+    Receive one message. `rings` maps the peer's ring names (from the
+    handshake) to attached rings; shared-memory arrays from any other ring,
+    or from a peer without one, are refused. Inline arrays above
+    MAX_ARRAY_BYTES (or MAX_MESSAGE_BYTES in total) are refused unread.
+    """
+    magic, header_len, count = _PREFIX.unpack(_recv_exact(sock, _PREFIX.size))
+    if magic != MAGIC or header_len > MAX_HEADER_BYTES:
+        raise ProtocolError("Bad message prefix")
+    header = json.loads(bytes(_recv_exact(sock, header_len)))
+    specs = header.pop("arrays", [])
+    if len(specs) != count:
+        raise ProtocolError("Array count mismatch")
+
+    arrays, leases, inline_bytes = [], [], 0
+    try:
+        for spec in specs:
+            if "shm" in spec:
+                handle = FrameHandle.from_dict(spec["shm"])
+                ring = (rings or {}).get(handle.ring)
+                if ring is None:
+                    raise ProtocolError(f"Shared-memory array from unknown ring {handle.ring}")
+                if handle.nbytes > ring.slot_bytes:
+                    raise ProtocolError("Shared-memory array larger than its slot")
+                leases.append((ring, handle))
+                arrays.append(ring.view(handle))
+                continue
+            dtype = np.dtype(spec["dtype"])
+            if dtype.hasobject:
+                raise ProtocolError("Object arrays are not accepted")
+            (nbytes,) = _LENGTH.unpack(_recv_exact(sock, _LENGTH.size))
+            shape = tuple(int(v) for v in spec["shape"])
+            inline_bytes += nbytes
+            if nbytes > MAX_ARRAY_BYTES or inline_bytes > MAX_MESSAGE_BYTES:
+                raise ProtocolError(f"Array of {nbytes} bytes exceeds the message size limits")
+            if any(v < 0 for v in shape) or nbytes != int(np.prod(shape, dtype=np.int64)) * dtype.itemsize:
+                raise ProtocolError("Array size mismatch")
+            arrays.append(np.frombuffer(_recv_exact(sock, nbytes), dtype=dtype).reshape(shape))
+    except (StaleHandle, ValueError, TypeError, ProtocolError) as e:
+        for ring, handle in leases:
+            ring.release(handle)
+        raise e if isinstance(e, ProtocolError) else ProtocolError(f"Unreadable array: {e}")
+    return Message(header, arrays, leases)
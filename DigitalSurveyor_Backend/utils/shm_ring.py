@@ -0,0 +1,380 @@
+# utils/shm_ring.py
+"""
+Shared-memory ring buffers for handing decoded frames between processes.
+
+Pickling a decoded 12MP BGR frame (36MB) through a pipe costs tens of
+milliseconds and a second copy in the receiver. Instead, the sending
+process writes the array once into a slot of a ring it owns and sends a
+small FrameHandle; the receiver maps the same memory and reads the array
+in place (zero-copy), then releases the slot.
+
+    ring = ShmRing.create(slots=8, slot_bytes=40 << 20)   # owner (sender)
+    handle = ring.put(frame, tag="analyze")              # copy in once
+    send(handle.to_dict())                               # a few bytes on the wire
+
+    peer = ShmRing.attach(handle.ring)                   # receiver
+    frame = peer.view(FrameHandle.from_dict(msg))        # no copy
+    ...
+    peer.release(handle)                                 # slot reusable
+
+Lifetime rules:
+- A ring belongs to the process that created it; only that process puts
+  into it, and it unlinks the segment on close() or at exit. Each side of
+  a connection owns the ring for the data it sends (frames one way,
+  CLAHE frames or depth maps the other).
+- A slot is leased from put() until release() by whichever process is
+  done with it. Every lease carries a generation number, so a late or
+  repeated release can never free a slot that was reused meanwhile.
+- Arrays returned by view() are only valid until their slot is released.
+
+Leak detection:
+- Slots leased longer than SHM_LEASE_SECONDS (a receiver that crashed or
+  forgot to release) are reclaimed by reap(), logged with their tag and
+  counted as shm_slots_leaked. put() reaps automatically when the ring is full.
+- Segments of processes that died without unlinking them are found by
+  their name (dsr_<pid>_...) and removed by cleanup_stale_segments(),
+  run when a ring is created and available as a CLI:
+      python -m utils.shm_ring --cleanup
+"""
+
+import atexit
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from . import metrics
+
+SHM_RING_SLOTS = int(os.getenv("SHM_RING_SLOTS", "8"))
+# One slot holds a 12MP BGR frame (36MB) with room to spare
+SHM_SLOT_MB = float(os.getenv("SHM_SLOT_MB", "40"))
+SHM_LEASE_SECONDS = float(os.getenv("SHM_LEASE_SECONDS", "60"))
+
+SEGMENT_PREFIX = "dsr"
+_MAGIC = 0x44535231  # "DSR1"
+_GLOBAL_FIELDS = 4   # magic, slots, slot_bytes, owner pid
+_SLOT_FIELDS = 4     # state, generation, nbytes, leased_at_ns
+FREE, LEASED = 0, 1
+_ALIGN = 4096
+
+_owned = {}          # name -> ShmRing created by this process
+_owned_lock = threading.Lock()
+
+
+class RingFull(Exception):
+    """No free slot (and none past its lease); the caller should fall back to inline transfer."""
+
+
+class FrameTooLarge(Exception):
+    """The array doesn't fit in one slot."""
+
+
+class StaleHandle(Exception):
+    """The handle's slot was released (or reclaimed as leaked) and may hold another frame."""
+
+
+class FrameHandle:
+    """Reference to an array in a ring slot; small and JSON-serializable."""
+
+    __slots__ = ("ring", "slot", "generation", "shape", "dtype")
+
+    def __init__(self, ring: str, slot: int, generation: int, shape, dtype):
+        self.ring = ring
+        self.slot = int(slot)
+        self.generation = int(generation)
+        self.shape = tuple(int(v) for v in shape)
+        self.dtype = str(dtype)
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape, dtype=np.int64)) * np.dtype(self.dtype).itemsize
+
+    def to_dict(self) -> dict:
+        return {"ring": self.ring, "slot": self.slot, "generation": self.generation,
+                "shape": list(self.shape), "dtype": self.dtype}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FrameHandle":
+        return cls(data["ring"], data["slot"], data["generation"], data["shape"], data["dtype"])
+
+    def __repr__(self):
+        return f"FrameHandle({self.ring}[{self.slot}]#{self.generation} {self.shape} {self.dtype})"
+
+
+def _data_offset(slots: int) -> int:
+    header = (_GLOBAL_FIELDS + slots * _SLOT_FIELDS) * 8
+    return -(-header // _ALIGN) * _ALIGN
+
+
+def _open_untracked(name: str) -> shared_memory.SharedMemory:
+    """
+    Map an existing segment without registering it with the resource
+    tracker: the tracker would unlink it when this process exits, under
+    the owner's feet (and a spawned child shares its parent's tracker, so
+    unregistering afterwards would drop the owner's registration instead).
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    with _owned_lock:
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class ShmRing:
+    """Fixed-size slots in one shared-memory segment, with a lease table in its header."""
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        self.shm = shm
+        self.name = shm.name
+        self.owner = owner
+        header = np.ndarray((_GLOBAL_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        if header[0] != _MAGIC:
+            raise ValueError(f"{shm.name} is not a frame ring")
+        self.slots = int(header[1])
+        self.slot_bytes = int(header[2])
+        self.owner_pid = int(header[3])
+        self._table = np.ndarray((self.slots, _SLOT_FIELDS), dtype=np.int64, buffer=shm.buf,
+                                 offset=_GLOBAL_FIELDS * 8)
+        self._offset = _data_offset(self.slots)
+        self._lock = threading.Lock()
+        self._cursor = 0
+        self._tags = {}  # slot -> tag of its current lease (owner side, for leak reports)
+
+    # --- LIFECYCLE ---
+
+    @classmethod
+    def create(cls, slots: int = SHM_RING_SLOTS, slot_bytes: int = None) -> "ShmRing":
+        """New ring owned by this process (unlinked on close() or at exit)."""
+        cleanup_stale_segments()
+        slot_bytes = int(slot_bytes or SHM_SLOT_MB * (1 << 20))
+        slot_bytes = -(-slot_bytes // _ALIGN) * _ALIGN
+        name = f"{SEGMENT_PREFIX}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+        shm = shared_memory.SharedMemory(name=name, create=True, size=_data_offset(slots) + slots * slot_bytes)
+        header = np.ndarray((_GLOBAL_FIELDS + slots * _SLOT_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        header[:] = 0
+        header[:_GLOBAL_FIELDS] = (_MAGIC, slots, slot_bytes, os.getpid())
+        del header
+        ring = cls(shm, owner=True)
+        with _owned_lock:
+            _owned[name] = ring
+        metrics.increment("shm_rings_created")
+        print(f"🧵 Shared-memory ring {name}: {slots} x {slot_bytes / (1 << 20):.0f}MB")
+        return ring
+
+    @classmethod
+    def attach(cls, name: str) -> "ShmRing":
+        """Map a ring created by another process (this side never unlinks it)."""
+        with _owned_lock:
+            if name in _owned:
+                return _owned[name]
+        return cls(_open_untracked(name), owner=False)
+
+    def close(self):
+        """Unmap (and unlink, for the owner). Views into the ring must be dropped first."""
+        self._table = None
+        try:
+            self.shm.close()
+        except BufferError:
+            print(f"⚠️ Ring {self.name} still has live views; unmapped at exit")
+        if self.owner:
+            with _owned_lock:
+                _owned.pop(self.name, None)
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+    # --- PRODUCER (owner) ---
+
+    def reserve(self, shape, dtype, tag: str = ""):
+        """
+        Lease a slot for an array of `shape`/`dtype` and return (handle, writable view),
+        so a producer can write its output straight into shared memory.
+        """
+        if not self.owner:
+            raise RuntimeError("Only the process that created a ring may write to it")
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        if nbytes > self.slot_bytes:
+            metrics.increment("shm_fallbacks", reason="too_large")
+            raise FrameTooLarge(f"{nbytes} bytes > slot size {self.slot_bytes}")
+
+        with self._lock:
+            slot = self._find_free()
+            if slot is None:
+                self.reap()
+                slot = self._find_free()
+            if slot is None:
+                metrics.increment("shm_fallbacks", reason="ring_full")
+                raise RingFull(f"All {self.slots} slots of {self.name} are leased")
+            generation = int(self._table[slot, 1]) + 1
+            self._table[slot, 1] = generation
+            self._table[slot, 2] = nbytes
+            self._table[slot, 3] = time.time_ns()
+            self._table[slot, 0] = LEASED
+            self._tags[slot] = tag
+
+        handle = FrameHandle(self.name, slot, generation, shape, dtype)
+        return handle, self._array(handle)
+
+    def put(self, array: np.ndarray, tag: str = "") -> FrameHandle:
+        """Copy `array` into a free slot (the only copy of the handoff)."""
+        handle, view = self.reserve(array.shape, array.dtype, tag)
+        view[...] = array
+        metrics.observe("shm_put_bytes", handle.nbytes)
+        return handle
+
+    @contextmanager
+    def lease(self, array: np.ndarray, tag: str = ""):
+        """put() for the duration of a `with` block (released even if the peer didn't)."""
+        handle = self.put(array, tag)
+        try:
+            yield handle
+        finally:
+            self.release(handle)
+
+    def _find_free(self):
+        for step in range(self.slots):
+            slot = (self._cursor + step) % self.slots
+            if self._table[slot, 0] == FREE:
+                self._cursor = (slot + 1) % self.slots
+                return slot
+        return None
+
+    # --- CONSUMER (any process) ---
+
+    def view(self, handle: FrameHandle) -> np.ndarray:
+        """The handle's array, read in place. Valid until the slot is released."""
+        self._check(handle)
+        return self._array(handle)
+
+    def take(self, handle: FrameHandle) -> np.ndarray:
+        """Copy the array out and release its slot (for small results kept beyond the call)."""
+        array = self.view(handle).copy()
+        self.release(handle)
+        return array
+
+    def release(self, handle: FrameHandle) -> bool:
+        """Free the handle's slot. Idempotent; returns False if it was already released or reused."""
+        table = self._table
+        if table is None or table[handle.slot, 1] != handle.generation or table[handle.slot, 0] == FREE:
+            return False
+        held_ms = (time.time_ns() - int(table[handle.slot, 3])) / 1e6
+        table[handle.slot, 0] = FREE
+        metrics.observe("shm_lease_ms", held_ms)
+        return True
+
+    def _check(self, handle: FrameHandle):
+        if handle.ring != self.name:
+            raise StaleHandle(f"{handle} belongs to another ring")
+        row = self._table[handle.slot]
+        if row[0] != LEASED or row[1] != handle.generation:
+            raise StaleHandle(f"{handle} was released or reclaimed")
+
+    def _array(self, handle: FrameHandle) -> np.ndarray:
+        return np.ndarray(handle.shape, dtype=handle.dtype, buffer=self.shm.buf,
+                          offset=self._offset + handle.slot * self.slot_bytes)
+
+    # --- LEAK DETECTION ---
+
+    def reap(self, max_age_s: float = SHM_LEASE_SECONDS) -> int:
+        """Reclaim slots leased longer than `max_age_s`. Returns how many were leaked."""
+        now = time.time_ns()
+        leaked = 0
+        for slot in range(self.slots):
+            state, generation, nbytes, leased_at = (int(v) for v in self._table[slot])
+            age_s = (now - leased_at) / 1e9
+            if state == LEASED and age_s > max_age_s:
+                self._table[slot, 0] = FREE
+                leaked += 1
+                print(f"⚠️ Leaked shared-memory slot {self.name}[{slot}]#{generation} "
+                      f"({nbytes / (1 << 20):.1f}MB, tag '{self._tags.get(slot, '')}', held {age_s:.0f}s); reclaimed")
+        if leaked:
+            metrics.increment("shm_slots_leaked", value=leaked)
+        return leaked
+
+    def stats(self) -> dict:
+        now = time.time_ns()
+        leased = [(int(row[2]), (now - int(row[3])) / 1e9) for row in self._table if row[0] == LEASED]
+        return {
+            "name": self.name,
+            "owner_pid": self.owner_pid,
+            "slots": self.slots,
+            "slot_mb": round(self.slot_bytes / (1 << 20), 1),
+            "leased": len(leased),
+            "leased_mb": round(sum(nbytes for nbytes, _ in leased) / (1 << 20), 1),
+            "oldest_lease_s": round(max((age for _, age in leased), default=0.0), 1),
+        }
+
+
+# --- PROCESS-LEVEL HOUSEKEEPING ---
+
+def owned_rings() -> list:
+    with _owned_lock:
+        return list(_owned.values())
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def cleanup_stale_segments(shm_dir: str = "/dev/shm") -> list:
+    """Unlink ring segments whose owning process is gone. Returns their names."""
+    if not os.path.isdir(shm_dir):
+        return []  # Not Linux: segments can't be listed
+    removed = []
+    for name in os.listdir(shm_dir):
+        parts = name.split("_")
+        if len(parts) != 3 or parts[0] != SEGMENT_PREFIX or not parts[1].isdigit():
+            continue
+        if _pid_alive(int(parts[1])):
+            continue
+        try:
+            os.unlink(os.path.join(shm_dir, name))
+            removed.append(name)
+        except OSError:
+            continue
+    if removed:
+        metrics.increment("shm_segments_reclaimed", value=len(removed))
+        print(f"🧹 Removed {len(removed)} shared-memory segment(s) left by dead processes: {removed}")
+    return removed
+
+
+@atexit.register
+def _close_owned_rings():
+    for ring in owned_rings():
+        ring.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect / clean up frame ring segments")
+    parser.add_argument("--cleanup", action="store_true", help="Unlink segments of dead processes")
+    args = parser.parse_args()
+
+    if args.cleanup:
+        cleanup_stale_segments()
+    for entry in sorted(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else []:
+        if entry.startswith(f"{SEGMENT_PREFIX}_"):
+            try:
+                ring = ShmRing.attach(entry)
+                print(ring.stats())
+                ring.close()
+            except (ValueError, FileNotFoundError) as e:
+                print(f"⚠️ {entry}: {e}")
@@ -0,0 +1,227 @@
+# utils/storage.py
+"""
+Artifact storage (photos, image variants, heatmaps, close-ups) behind one
+interface, so the pipeline doesn't care where files live.
+
+STORAGE_BACKEND selects the backend:
+- 'supabase': the Supabase Storage bucket (STORAGE_BUCKET), public URLs
+- 'local':    a content-addressed directory (STORAGE_LOCAL_DIR) served by
+              the app itself at /artifacts/<key>: on-prem deployments and
+              tests store and read artifacts without any network round trip
+
+Object keys are content-addressed in both: '<folder>/<sha256><ext>'. A key
+names exactly one byte string, so objects never change (clients may cache
+them forever), retried uploads are idempotent, and identical bytes get the
+same key: a key already stored is skipped instead of uploaded again
+(storage_dedup_hits). The local backend keeps one file per digest, even
+when the same bytes are stored under several folders.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+
+from . import metrics, tracing
+from .ttl_cache import TTLCache
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase")
+STORAGE_LOCAL_DIR = os.getenv("STORAGE_LOCAL_DIR", "artifacts")
+# Base URL local artifacts are served from (this app)
+STORAGE_PUBLIC_URL = os.getenv("STORAGE_PUBLIC_URL", os.getenv("BACKEND_URL", "http://127.0.0.1:8000"))
+
+ARTIFACT_ROUTE = "/artifacts"
+# Keys stored by this process (skips re-uploads without asking the backend)
+_stored = TTLCache("storage_keys", ttl=24 * 3600, max_entries=10000)
+_KEY_NAME = re.compile(r"^([0-9a-f]{64})(\.[a-z0-9]{1,5})?$")
+
+CONTENT_TYPES = {
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'pdf': 'application/pdf'
+}
+
+
+def get_content_type(filename: str) -> str:
+    """Get MIME type based on file extension."""
+    return CONTENT_TYPES.get(filename.lower().split('.')[-1], 'application/octet-stream')
+
+
+def object_key(data: bytes, filename: str, folder: str) -> str:
+    """Content-addressed key, e.g. 'heatmaps/<sha256>.webp' (extension kept from filename)."""
+    ext = os.path.splitext(filename)[1].lower()
+    return f"{folder}/{hashlib.sha256(data).hexdigest()}{ext}"
+
+
+def key_digest(key: str):
+    """sha256 hex digest named by a key, or None if it isn't a valid content-addressed key."""
+    match = _KEY_NAME.match(key.rsplit("/", 1)[-1])
+    return match.group(1) if match else None
+
+
+# --- BACKENDS ---
+
+class LocalStorage:
+    """Content-addressed files under `root` (<root>/<ab>/<sha256><ext>)."""
+
+    name = "local"
+
+    def __init__(self, root: str = STORAGE_LOCAL_DIR, public_url: str = STORAGE_PUBLIC_URL):
+        self.root = root
+        self.public_base = f"{public_url.rstrip('/')}{ARTIFACT_ROUTE}"
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, key: str):
+        name = key.rsplit("/", 1)[-1]
+        digest = key_digest(name)
+        return os.path.join(self.root, digest[:2], name) if digest else None
+
+    def public_url(self, key: str) -> str:
+        return f"{self.public_base}/{key}"
+
+    def exists(self, key: str) -> bool:
+        path = self.path_for(key)
+        return path is not None and os.path.exists(path)
+
+    def put(self, key: str, data: bytes, content_type: str):
+        path = self.path_for(key)
+        if path is None or hashlib.sha256(data).hexdigest() != key_digest(key):
+            raise ValueError(f"Key {key} does not match its content")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write-then-rename: readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def read(self, key: str) -> bytes:
+        with open(self.path_for(key), "rb") as f:
+            return f.read()
+
+
+class SupabaseStorage:
+    """The Supabase Storage bucket (client created on first use)."""
+
+    name = "supabase"
+
+    def public_url(self, key: str) -> str:
+        from .supabase_client import public_url_for
+        return public_url_for(key)
+
+    def exists(self, key: str) -> bool:
+        return False  # Unknown without a request; re-uploads are idempotent upserts
+
+    def put(self, key: str, data: bytes, content_type: str):
+        from .supabase_client import upload_object
+        upload_object(key, data, content_type)
+
+
+_backend = None
+
+
+def get_storage():
+    global _backend
+    if _backend is None:
+        _backend = LocalStorage() if STORAGE_BACKEND == "local" else SupabaseStorage()
+    return _backend
+
+
+def set_storage(backend):
+    """Swap the backend (tools and tests)."""
+    global _backend
+    _backend = backend
+    _stored.clear()
+
+
+# --- API ---
+
+def public_url(key: str) -> str:
+    """Public URL of an object (computed locally, the object may not exist yet)."""
+    return get_storage().public_url(key)
+
+
+def store(key: str, data: bytes, content_type: str):
+    """
+    Store bytes under their content-addressed key unless already stored.
+    Raises on failure (used by the outbox flusher).
+    """
+    backend = get_storage()
+    if _stored.get(key) or backend.exists(key):
+        metrics.increment("storage_dedup_hits", backend=backend.name)
+        _stored.set(key, True)
+        return
+    with tracing.span("storage.upload", backend=backend.name, bytes=len(data)):
+        backend.put(key, data, content_type)
+    metrics.increment("storage_uploads", backend=backend.name)
+    metrics.observe("storage_upload_bytes", len(data), backend=backend.name)
+    _stored.set(key, True)
+
+
+def upload_bytes_to_storage(file_data: bytes, filename: str, folder: str) -> str:
+    """
+    Store in-memory bytes (no temp file needed).
+
+    Args:
+        file_data: Encoded file contents
+        filename: Name the extension and content type come from
+        folder: Folder for the object key (e.g. 'heatmaps')
+
+    Returns:
+        Public URL of the stored file, or None on failure
+    """
+    try:
+        key = object_key(file_data, filename, folder)
+        store(key, file_data, get_content_type(filename))
+        print(f"✅ Uploaded {filename} to {folder}")
+        return public_url(key)
+    except Exception as e:
+        print(f"⚠️ Upload error for {filename}: {e}")
+        return None
+
+
+def upload_to_storage(file_path: str, folder: str) -> str:
+    """
+    Store a local file.
+
+    Args:
+        file_path: Local path to the file
+        folder: Folder for the object key (e.g., 'original', 'processed', 'heatmaps', 'closeups')
+
+    Returns:
+        Public URL of the stored file, or None on failure
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            file_data = f.read()
+    except Exception as e:
+        print(f"⚠️ Upload error for {file_path}: {e}")
+        return None
+
+    return upload_bytes_to_storage(file_data, os.path.basename(file_path), folder)
+
+
+def local_path(key: str):
+    """File of a locally stored object, or None (other backend, bad key, not stored)."""
+    backend = get_storage()
+    if not isinstance(backend, LocalStorage):
+        return None
+    path = backend.path_for(key)
+    return path if path and os.path.exists(path) else None
+
+
+def fetch(url: str, timeout: float = 15) -> bytes:
+    """Bytes of a stored object by URL: read from disk when it is local, else downloaded."""
+    backend = get_storage()
+    if isinstance(backend, LocalStorage) and url.startswith(backend.public_base + "/"):
+        return backend.read(url[len(backend.public_base) + 1:].split("?", 1)[0])
+    import requests
+    response = requests.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.content
@@ -5,6 +5,8 @@ from dotenv import load_dotenv
 import uuid
 from datetime import datetime
 
+from . import tracing
+
 # Load environment variables
 load_dotenv()
 
@@ -16,43 +18,35 @@ STORAGE_BUCKET = os.getenv("STORAGE_BUCKET", "images")
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 
-def upload_to_storage(file_path: str, folder: str) -> str:
+def public_url_for(object_key: str) -> str:
+    """Public URL of a storage object (computed locally, the object may not exist yet)."""
+    return supabase.storage.from_(STORAGE_BUCKET).get_public_url(object_key)
+
+
+def upload_object(object_key: str, file_data: bytes, content_type: str):
     """
-    Upload a file to Supabase Storage.
-    
-    Args:
-        file_path: Local path to the file
-        folder: Folder name in bucket (e.g., 'original', 'processed', 'heatmaps', 'reports')
-    
-    Returns:
-        Public URL of the uploaded file
+    Upload bytes under a fixed key. Overwrites, so retries are idempotent.
+    Raises on failure (used by the outbox flusher).
     """
-    try:
-        filename = os.path.basename(file_path)
-        unique_filename = f"{folder}/{uuid.uuid4()}_{filename}"
-        
-        with open(file_path, 'rb') as f:
-            file_data = f.read()
-        
-        # Upload to Supabase Storage
-        supabase.storage.from_(STORAGE_BUCKET).upload(
-            unique_filename,
-            file_data,
-            file_options={"content-type": get_content_type(filename)}
-        )
-        
-        # Get public URL
-        public_url = supabase.storage.from_(STORAGE_BUCKET).get_public_url(unique_filename)
-        
-        print(f"✅ Uploaded {filename} to {folder}")
-        return public_url
-        
-    except Exception as e:
-        print(f"⚠️ Upload error for {file_path}: {e}")
-        return None
+    supabase.storage.from_(STORAGE_BUCKET).upload(
+        object_key,
+        file_data,
+        file_options={"content-type": content_type, "upsert": "true"}
+    )
 
 
-def insert_scan_record(user_id: str, car_name: str, damage_data: dict, image_urls: dict) -> str:
+@tracing.span("db.upsert")
+def upsert_rows(table: str, rows: list):
+    """
+    Insert-or-update rows by primary key in one request. Idempotent, so a
+    retried batch never duplicates rows. Raises on failure.
+    """
+    if rows:
+        supabase.table(table).upsert(rows).execute()
+
+
+def insert_scan_record(user_id: str, car_name: str, damage_data: dict, image_urls: dict,
+                       scan_id: str = None) -> str:
     """
     Insert a scan record into the scans table.
     
@@ -60,30 +54,18 @@ def insert_scan_record(user_id: str, car_name: str, damage_data: dict, image_url
         user_id: User's UUID
         car_name: Name of the vehicle
         damage_data: Dictionary containing damages list and total_estimate
-        image_urls: Dict with keys: original, processed, heatmap, pdf
+        image_urls: Dict with keys: original, processed, heatmap, pdf (+ optional variants)
+        scan_id: Pre-generated scan UUID (optional, generated if missing)
     
     Returns:
         Scan ID (UUID)
     """
     try:
-        scan_id = str(uuid.uuid4())
+        scan_record = build_scan_record(user_id, car_name, damage_data, image_urls, scan_id)
+        scan_id = scan_record["id"]
         
-        scan_record = {
-            "id": scan_id,
-            "user_id": user_id,
-            "car_name": car_name,
-            "original_image_url": image_urls.get("original"),
-            "processed_image_url": image_urls.get("processed"),
-            "heatmap_image_url": image_urls.get("heatmap"),
-            "report_pdf_url": image_urls.get("pdf"),
-            "total_cost": int(damage_data.get("total_estimate", 0)),
-            "damage_count": int(len(damage_data.get("damages", []))),
-            "damages": damage_data.get("damages", []),  # TODO: Add this column to Supabase table first
-            "status": "complete",
-            "created_at": datetime.utcnow().isoformat()
-        }
-        
-        result = supabase.table("scans").insert(scan_record).execute()
+        with tracing.span("db.insert", table="scans"):
+            result = supabase.table("scans").insert(scan_record).execute()
         
         print(f"✅ Scan record created: {scan_id}")
         return scan_id
@@ -93,16 +75,25 @@ def insert_scan_record(user_id: str, car_name: str, damage_data: dict, image_url
         return None
 
 
-def get_content_type(filename: str) -> str:
-    """Get MIME type based on file extension."""
-    ext = filename.lower().split('.')[-1]
-    types = {
-        'jpg': 'image/jpeg',
-        'jpeg': 'image/jpeg',
-        'png': 'image/png',
-        'pdf': 'application/pdf'
+def build_scan_record(user_id: str, car_name: str, damage_data: dict, image_urls: dict,
+                      scan_id: str = None) -> dict:
+    """Row for the scans table (see insert_scan_record for the arguments)."""
+    return {
+        "id": scan_id or str(uuid.uuid4()),
+        "user_id": user_id,
+        "car_name": car_name,
+        "original_image_url": image_urls.get("original"),
+        "processed_image_url": image_urls.get("processed"),
+        "heatmap_image_url": image_urls.get("heatmap"),
+        "report_pdf_url": image_urls.get("pdf"),
+        "image_variants": image_urls.get("variants"),  # {kind: {thumb, web, full}} (image_variants.sql)
+        "total_cost": int(damage_data.get("total_estimate", 0)),
+        "damage_count": int(len(damage_data.get("damages", []))),
+        "damages": damage_data.get("damages", []),  # TODO: Add this column to Supabase table first
+        "detections": damage_data.get("detections"),  # Overlay source data (scan_detections.sql)
+        "status": "complete",
+        "created_at": datetime.utcnow().isoformat()
     }
-    return types.get(ext, 'application/octet-stream')
 
 
 def create_damage_records(scan_id: str, damages_list: list):
@@ -119,26 +110,10 @@ def create_damage_records(scan_id: str, damages_list: list):
     try:
         damage_ids = []
         
-        for damage in damages_list:
-            damage_id = str(uuid.uuid4())
-            
-            damage_record = {
-                "id": damage_id,
-                "scan_id": scan_id,
-                "part_name": damage.get("part", "Unknown"),
-                "damage_type": damage.get("type", "Unknown"),
-                "is_manual": False,
-                "detection_source": "ai",
-                "global_box": damage.get("box", []),
-                "preliminary_severity": int(damage.get("severity", 50)),
-                "preliminary_cost": int(damage.get("cost", 0)),
-                "final_severity": int(damage.get("severity", 50)),
-                "action": damage.get("action", "Repair"),
-                "cost": int(damage.get("cost", 0)),
-                "status": "preliminary"
-            }
-            
-            supabase.table("damages").insert(damage_record).execute()
+        for damage_record in build_damage_records(scan_id, damages_list):
+            damage_id = damage_record["id"]
+            with tracing.span("db.insert", table="damages"):
+                supabase.table("damages").insert(damage_record).execute()
             damage_ids.append(damage_id)
             print(f"✅ Created damage record: {damage_id}")
         
@@ -149,6 +124,26 @@ def create_damage_records(scan_id: str, damages_list: list):
         return []
 
 
+def build_damage_records(scan_id: str, damages_list: list) -> list:
+    """Rows for the damages table, one per damage (ids generated here)."""
+    return [{
+        "id": str(uuid.uuid4()),
+        "scan_id": scan_id,
+        "part_name": damage.get("part", "Unknown"),
+        "damage_type": damage.get("type", "Unknown"),
+        "is_manual": False,
+        "detection_source": "ai",
+        "global_box": damage.get("box", []),
+        "preliminary_severity": int(damage.get("severity", 50)),
+        "preliminary_cost": int(damage.get("cost", 0)),
+        "final_severity": int(damage.get("severity", 50)),
+        "action": damage.get("action", "Repair"),
+        "cost": int(damage.get("cost", 0)),
+        "status": "preliminary"
+    } for damage in damages_list]
+
+
+@tracing.span("db.update", table="damages")
 def update_damage_refinement(
     damage_id: str,
     closeup_urls: list,
@@ -191,6 +186,52 @@ def update_damage_refinement(
         return False
 
 
+@tracing.span("db.select", table="scans")
+def get_scan_by_id(scan_id: str):
+    """Get a single scan record, or None if it does not exist."""
+    try:
+        result = supabase.table("scans").select("*").eq("id", scan_id).limit(1).execute()
+        return result.data[0] if result.data else None
+    except Exception as e:
+        print(f"⚠️ Error fetching scan {scan_id}: {e}")
+        return None
+
+
+@tracing.span("db.select", table="scans")
+def list_scans_page(user_id: str, limit: int, after: tuple = None, columns: str = "*"):
+    """
+    One page of a user's scans, newest first (keyset pagination).
+    
+    Args:
+        user_id: Owner of the scans
+        limit: Max rows to return
+        after: (created_at, id) of the last row of the previous page, or None
+               (validated by scan_history_service.decode_cursor)
+        columns: PostgREST select projection
+    
+    Returns:
+        List of scan rows (None on error)
+    """
+    try:
+        query = (supabase.table("scans").select(columns)
+                 .eq("user_id", user_id)
+                 .order("created_at", desc=True)
+                 .order("id", desc=True)
+                 .limit(limit))
+        if after:
+            created_at, scan_id = after
+            # Rows strictly after the cursor in (created_at DESC, id DESC) order
+            query = query.or_(
+                f'created_at.lt."{created_at}",'
+                f'and(created_at.eq."{created_at}",id.lt."{scan_id}")'
+            )
+        return query.execute().data or []
+    except Exception as e:
+        print(f"⚠️ Error listing scans for {user_id}: {e}")
+        return None
+
+
+@tracing.span("db.select", table="damages")
 def get_damages_by_scan(scan_id: str):
     """Get all damages for a specific scan."""
     try:
@@ -0,0 +1,365 @@
+# utils/tracing.py
+"""
+Request-scoped tracing: a timeline of spans for one request.
+
+TraceMiddleware opens a root span per HTTP request (continuing an incoming
+W3C `traceparent`), returns its id in X-Trace-Id and, in debug mode
+(TRACE_DEBUG=true or an `X-Debug-Timings: 1` request header), a compact
+per-stage summary in a Server-Timing header. Code marks stages with
+
+    with tracing.span("depth.inference", crops=4):
+        ...
+
+or by decorating a function with @tracing.span("name"). Outside a traced
+request, span() is a no-op. The current span lives in a contextvar, so it
+follows run_in_threadpool; other threads continue a trace explicitly with
+activate(span) (e.g. the outbox flusher).
+
+Finished spans are kept per trace in memory for /traces/{trace_id} (served
+with TRACE_DEBUG=true only) and
+handed to the exporter (TRACE_EXPORTER):
+- 'none': in-memory only
+- 'file': OTLP/JSON export requests appended to TRACE_FILE, one per line
+  (readable by the OpenTelemetry collector's otlpjsonfile receiver)
+- 'otlp': POSTed to an OTLP/HTTP collector at TRACE_OTLP_ENDPOINT
+"""
+
+import contextvars
+import json
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from . import metrics
+from .ttl_cache import TTLCache
+
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://127.0.0.1:4318/v1/traces")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "digital-surveyor-backend")
+# Share of requests traced (debug requests always are)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_DEBUG = os.getenv("TRACE_DEBUG", "false").lower() == "true"
+# Recent traces kept in memory for /traces/{trace_id}
+TRACE_RETENTION = int(os.getenv("TRACE_RETENTION", "200"))
+TRACE_RETENTION_SECONDS = float(os.getenv("TRACE_RETENTION_SECONDS", "900"))
+
+TRACE_HEADER = "X-Trace-Id"
+DEBUG_HEADER = "X-Debug-Timings"
+MAX_SPANS_PER_TRACE = 2000
+EXPORT_BATCH_SIZE = 256
+EXPORT_INTERVAL_SECONDS = 1.0
+
+_current = contextvars.ContextVar("trace_span", default=None)
+_traces = TTLCache("traces", ttl=TRACE_RETENTION_SECONDS, max_entries=TRACE_RETENTION)
+
+
+class Trace:
+    """Spans of one trace seen by this process."""
+
+    def __init__(self, trace_id: str, debug: bool = False):
+        self.trace_id = trace_id
+        self.debug = debug
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            if len(self.spans) >= MAX_SPANS_PER_TRACE:
+                metrics.increment("trace_spans_dropped", reason="trace_full")
+                return
+            self.spans.append(span)
+
+    def stage_summary(self) -> dict:
+        """{span name: (count, total ms)} over the finished spans."""
+        summary = {}
+        with self._lock:
+            for span in self.spans:
+                count, total = summary.get(span.name, (0, 0.0))
+                summary[span.name] = (count + 1, total + span.duration_ms)
+        return summary
+
+    def timeline(self) -> list:
+        """Finished spans in start order, with offsets from the first one."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start_ns)
+        origin = spans[0].start_ns if spans else 0
+        return [{
+            "name": span.name,
+            "span_id": span.span_id,
+            "parent_id": span.parent_id,
+            "start_ms": round((span.start_ns - origin) / 1e6, 3),
+            "duration_ms": round(span.duration_ms, 3),
+            "status": span.status,
+            "thread": span.thread,
+            "attributes": span.attributes,
+        } for span in spans]
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attributes", "start_ns", "end_ns",
+                 "status", "thread")
+
+    def __init__(self, trace: Trace, name: str, parent_id: str = None, attributes: dict = None):
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = "ok"
+        self.thread = threading.current_thread().name
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.trace.add(self)
+            _exporter.submit(self)
+
+
+# --- API ---
+
+def current_span():
+    return _current.get()
+
+
+def current_trace_id():
+    span = _current.get()
+    return span.trace_id if span is not None else None
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Child span of the current one; a no-op outside a trace. Also usable as a decorator."""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(parent.trace, name, parent.span_id, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.status = "error"
+        child.attributes["error"] = f"{type(e).__name__}: {e}"[:200]
+        raise
+    finally:
+        _current.reset(token)
+        child.end()
+
+
+def annotate(**attributes):
+    """Add attributes to the current span (no-op outside a trace)."""
+    current = _current.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+@contextmanager
+def activate(parent):
+    """Continue `parent`'s trace in this thread (parent may be None: no-op)."""
+    if parent is None:
+        yield
+        return
+    token = _current.set(parent)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def record(parent, name: str, start_ns: int, end_ns: int, **attributes):
+    """Add an already-timed span under `parent` (work shared by several traces, e.g. a batched insert)."""
+    if parent is None:
+        return
+    finished = Span(parent.trace, name, parent.span_id, attributes)
+    finished.start_ns = start_ns
+    finished.end_ns = end_ns
+    finished.trace.add(finished)
+    _exporter.submit(finished)
+
+
+def start_trace(name: str, traceparent: str = None, debug: bool = False, **attributes):
+    """
+    Root span of a new trace, or None when the request isn't sampled.
+    `traceparent` (W3C) continues a caller's trace.
+    """
+    trace_id, parent_id = _parse_traceparent(traceparent)
+    if not debug and trace_id is None and random.random() >= TRACE_SAMPLE_RATE:
+        return None
+    trace = Trace(trace_id or f"{random.getrandbits(128):032x}", debug)
+    _traces.set(trace.trace_id, trace)
+    return Span(trace, name, parent_id, attributes)
+
+
+def get_trace(trace_id: str):
+    return _traces.get(trace_id)
+
+
+def server_timing(trace: Trace, total_ms: float) -> str:
+    """Server-Timing header value: total plus time per stage (summed over repeats)."""
+    entries = [f"total;dur={total_ms:.1f}"]
+    summary = sorted(trace.stage_summary().items(), key=lambda item: -item[1][1])
+    for name, (count, total) in summary:
+        token = "".join(c if c.isalnum() or c in "_-" else "_" for c in name)
+        entries.append(f"{token};dur={total:.1f}" + (f';desc="x{count}"' if count > 1 else ""))
+    return ", ".join(entries)
+
+
+def _parse_traceparent(value):
+    """'00-<trace id>-<span id>-<flags>' -> (trace id, parent span id), or (None, None)."""
+    parts = (value or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None, None
+    if set(parts[1]) == {"0"}:
+        return None, None
+    return parts[1], parts[2]
+
+
+# --- MIDDLEWARE ---
+
+class TraceMiddleware:
+    """ASGI middleware: one root span per HTTP request, trace id and timings as headers."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        debug = TRACE_DEBUG or headers.get(DEBUG_HEADER.lower()) in ("1", "true")
+        root = start_trace(f"{scope['method']} {scope['path']}", headers.get("traceparent"), debug,
+                           method=scope["method"], path=scope["path"])
+        if root is None:
+            return await self.app(scope, receive, send)
+
+        token = _current.set(root)
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                root.set(status_code=message["status"])
+                extra = [(TRACE_HEADER.lower().encode(), root.trace_id.encode())]
+                if debug:
+                    extra.append((b"server-timing", server_timing(root.trace, root.duration_ms).encode()))
+                message = {**message, "headers": list(message.get("headers", [])) + extra}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        except BaseException:
+            root.status = "error"
+            raise
+        finally:
+            _current.reset(token)
+            root.end()
+
+
+# --- EXPORT ---
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans: list) -> dict:
+    """OTLP/JSON ExportTraceServiceRequest for a batch of finished spans."""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+        "scopeSpans": [{
+            "scope": {"name": "digital-surveyor"},
+            "spans": [{
+                "traceId": span.trace_id,
+                "spanId": span.span_id,
+                **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns),
+                "attributes": [{"key": key, "value": _otlp_value(value)}
+                               for key, value in {**span.attributes, "thread.name": span.thread}.items()],
+                "status": {"code": 2 if span.status == "error" else 1},
+            } for span in spans],
+        }],
+    }]}
+
+
+class Exporter:
+    """Background thread shipping finished spans in batches (bounded queue, drops when full)."""
+
+    def __init__(self, kind: str = TRACE_EXPORTER):
+        self.kind = kind
+        self._queue = queue.Queue(maxsize=EXPORT_BATCH_SIZE * 20)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, span):
+        if self.kind == "none":
+            return
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            metrics.increment("trace_spans_dropped", reason="export_queue_full")
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + EXPORT_INTERVAL_SECONDS
+            while len(batch) < EXPORT_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self.export(batch)
+                metrics.increment("trace_spans_exported", value=len(batch), exporter=self.kind)
+            except Exception as e:
+                metrics.increment("trace_export_failures", exporter=self.kind)
+                print(f"⚠️ Trace export ({self.kind}) failed: {e}")
+
+    def export(self, spans: list):
+        payload = json.dumps(to_otlp(spans), separators=(",", ":"))
+        if self.kind == "file":
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(payload + "\n")
+        elif self.kind == "otlp":
+            import requests
+            response = requests.post(TRACE_OTLP_ENDPOINT, data=payload, timeout=5,
+                                     headers={"Content-Type": "application/json"})
+            response.raise_for_status()
+
+
+_exporter = Exporter()
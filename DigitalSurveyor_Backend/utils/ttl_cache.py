@@ -0,0 +1,103 @@
+# utils/ttl_cache.py
+"""
+Small thread-safe in-process cache with per-entry expiry and tag-based
+invalidation (e.g. drop every cached page of one user's scan list).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from . import metrics
+
+
+class TTLCache:
+    """
+    LRU-bounded cache whose entries expire after `ttl` seconds.
+
+    Bounded by entry count, and optionally by size: with `max_bytes`, each
+    value is weighed with `weigh(value)` and least recently used entries are
+    evicted until the total fits (a value larger than the budget isn't kept).
+
+    Usage:
+        cache = TTLCache("scans", ttl=30)
+        value = cache.get_or_load(key, loader, tags=("user:123",))
+        cache.invalidate_tag("user:123")
+    """
+
+    def __init__(self, name: str, ttl: float = 30, max_entries: int = 1024,
+                 max_bytes: int = None, weigh=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.weigh = weigh
+        self._bytes = 0
+        self._entries = OrderedDict()   # key -> (expires_at, value, tags, size)
+        self._tags = {}                 # tag -> set of keys
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                metrics.increment("cache", cache=self.name, result="miss")
+                return default
+            self._entries.move_to_end(key)
+        metrics.increment("cache", cache=self.name, result="hit")
+        return entry[1]
+
+    def set(self, key, value, tags=()):
+        size = self.weigh(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                metrics.increment("cache", cache=self.name, result="too_large")
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value, tuple(tags), size)
+            self._bytes += size
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries or \
+                    (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._drop(next(iter(self._entries)))
+
+    def get_or_load(self, key, loader, tags=()):
+        """Cached value, or loader() result (cached unless it is None)."""
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = loader()
+            if value is not None:
+                self.set(key, value, tags)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._drop(key)
+
+    def invalidate_tag(self, tag):
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry[3]
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
@@ -0,0 +1,72 @@
+# vehicle_gate_service.py
+"""
+Vehicle-presence gate.
+
+Runs right after the quality gate, on a low-resolution parts-model pass
+(VEHICLE_GATE_IMGSZ, ~1/4 the pixels of the regular parts pass). Photos
+with no car parts, or where the car covers too little of the frame, are
+rejected with a framing hint before the damage model and depth run.
+"""
+
+import os
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+import numpy as np
+
+VEHICLE_GATE = os.getenv("VEHICLE_GATE", "true").lower() == "true"
+VEHICLE_GATE_IMGSZ = int(os.getenv("VEHICLE_GATE_IMGSZ", "320"))
+VEHICLE_GATE_CONF = float(os.getenv("VEHICLE_GATE_CONF", "0.25"))
+# Share of the frame the detected parts must span
+VEHICLE_MIN_COVERAGE = float(os.getenv("VEHICLE_MIN_COVERAGE", "0.10"))
+
+NO_VEHICLE = "No Vehicle Detected"
+VEHICLE_TOO_SMALL = "Vehicle Too Small"
+
+
+@dataclass
+class VehiclePresence:
+    """Outcome of the vehicle gate."""
+    passed: bool = True
+    reason: Optional[str] = None
+    details: Optional[str] = None
+    parts_found: int = 0
+    coverage: float = 0.0
+    max_confidence: float = 0.0
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def assess_vehicle_presence(boxes, image_shape) -> VehiclePresence:
+    """
+    Decide from the gate pass's part boxes whether the photo frames a car.
+
+    Args:
+        boxes: Nx6 array (x1, y1, x2, y2, conf, cls) in source coordinates
+        image_shape: Shape of the photo
+
+    Returns:
+        VehiclePresence (coverage = area spanned by all parts / frame area)
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 6)
+    boxes = boxes[boxes[:, 4] >= VEHICLE_GATE_CONF]
+    if len(boxes) == 0:
+        return VehiclePresence(
+            passed=False, reason=NO_VEHICLE,
+            details="No car was found in this photo. Photograph the damaged side of the vehicle "
+                    "from 1-2 metres away, with the car filling most of the frame.")
+
+    h, w = image_shape[:2]
+    span_w = boxes[:, 2].max() - boxes[:, 0].min()
+    span_h = boxes[:, 3].max() - boxes[:, 1].min()
+    coverage = float(span_w * span_h / (h * w))
+    presence = VehiclePresence(parts_found=int(len(boxes)), coverage=round(coverage, 4),
+                               max_confidence=round(float(boxes[:, 4].max()), 4))
+
+    if coverage < VEHICLE_MIN_COVERAGE:
+        presence.passed = False
+        presence.reason = VEHICLE_TOO_SMALL
+        presence.details = (f"The car fills only {coverage * 100:.1f}% of the photo. "
+                            f"Move closer so the damaged area fills most of the frame.")
+    return presence
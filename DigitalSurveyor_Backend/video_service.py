@@ -0,0 +1,139 @@
+# video_service.py
+"""
+Keyframe selection for video walkarounds.
+The video is decoded as a stream (only sampled frames are decoded, at most
+a handful of full-resolution frames are held in memory) and each sampled
+frame is scored cheaply on a downsampled copy: sharpness/exposure/glare from
+the quality gate metrics, plus motion and novelty against previous frames.
+Only the selected keyframes go through the analyze pipeline.
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+from quality_service import compute_quality_metrics, DARK_THRESHOLD, GLARE_PCT_THRESHOLD
+from utils import metrics
+
+# Frames sampled per second of video for scoring
+SAMPLE_FPS = float(os.getenv("VIDEO_SAMPLE_FPS", "3"))
+# Hard cap on keyframes sent to the models (cost control)
+MAX_KEYFRAMES = int(os.getenv("MAX_VIDEO_KEYFRAMES", "6"))
+# Hard cap on frames read from the stream (~2 min at 30fps)
+MAX_FRAMES_READ = int(os.getenv("MAX_VIDEO_FRAMES", "3600"))
+
+# Width of the copy used for scoring, and of the novelty thumbnail
+SCORE_WIDTH = 320
+THUMB_SIZE = (32, 18)
+# Mean abs thumbnail difference (0-1) that starts a new view/segment
+NOVELTY_THRESHOLD = 0.12
+
+
+def _thumbnail(small_bgr):
+    gray = cv2.cvtColor(small_bgr, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, THUMB_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32) / 255.0
+
+
+def score_frame(frame, prev_thumb=None):
+    """
+    Score one frame on a downsampled copy.
+
+    Returns:
+        (score, thumb): score is 0 for frames the quality gate would reject,
+        otherwise log-sharpness damped by motion vs the previous sample
+    """
+    h, w = frame.shape[:2]
+    small = cv2.resize(frame, (SCORE_WIDTH, max(1, int(h * SCORE_WIDTH / w))), interpolation=cv2.INTER_AREA)
+    thumb = _thumbnail(small)
+
+    # Blur is ranked, not gated, here: the downsampled copy is sharper than
+    # the frame, and the chosen keyframes pass the real gate in the pipeline
+    quality = compute_quality_metrics(small)
+    if quality.mean_intensity < DARK_THRESHOLD or quality.glare_pct > GLARE_PCT_THRESHOLD:
+        return 0.0, thumb
+
+    score = float(np.log1p(quality.blur_var))
+    if prev_thumb is not None:
+        # Fast camera motion between samples means motion blur
+        motion = float(np.mean(np.abs(thumb - prev_thumb)))
+        score /= 1.0 + 10.0 * motion
+    return score, thumb
+
+
+def select_keyframes(video_path, max_keyframes=MAX_KEYFRAMES, sample_fps=SAMPLE_FPS):
+    """
+    Stream-decode a video and pick sharp, diverse keyframes.
+
+    The stream is split into segments of similar views (novelty vs the
+    segment's first frame); the best-scoring frame of each segment becomes
+    a keyframe. If there are more segments than max_keyframes, the weakest
+    keyframes are dropped as new ones arrive, so memory stays bounded at
+    max_keyframes + 1 full frames.
+
+    Returns:
+        (keyframes, stats): list of BGR frames in video order, and a dict of
+        decoding/selection stats for the response
+    """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        return [], {"error": "Could not decode video"}
+
+    video_fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    step = max(1, int(round(video_fps / sample_fps)))
+
+    keyframes = []          # [(frame_idx, score, frame)]
+    segment_best = None     # (frame_idx, score, frame)
+    segment_ref = None      # thumbnail of the segment's first frame
+    prev_thumb = None
+    frames_read = frames_scored = 0
+
+    def commit(candidate):
+        if candidate is None or candidate[1] <= 0:
+            return
+        keyframes.append(candidate)
+        if len(keyframes) > max_keyframes:
+            keyframes.remove(min(keyframes, key=lambda k: k[1]))
+
+    try:
+        while frames_read < MAX_FRAMES_READ:
+            # grab() advances without decoding; only sampled frames are decoded
+            if not capture.grab():
+                break
+            frames_read += 1
+            if (frames_read - 1) % step:
+                continue
+
+            ok, frame = capture.retrieve()
+            if not ok:
+                continue
+            frames_scored += 1
+
+            score, thumb = score_frame(frame, prev_thumb)
+            prev_thumb = thumb
+
+            if segment_ref is None or float(np.mean(np.abs(thumb - segment_ref))) > NOVELTY_THRESHOLD:
+                commit(segment_best)
+                segment_ref = thumb
+                segment_best = None
+
+            if segment_best is None or score > segment_best[1]:
+                segment_best = (frames_read - 1, score, frame)
+
+        commit(segment_best)
+    finally:
+        capture.release()
+
+    keyframes.sort(key=lambda k: k[0])
+    stats = {
+        "video_fps": round(video_fps, 2),
+        "frames_read": frames_read,
+        "frames_scored": frames_scored,
+        "keyframe_indices": [k[0] for k in keyframes],
+        "truncated": frames_read >= MAX_FRAMES_READ
+    }
+    metrics.observe("video_frames_scored", frames_scored)
+    metrics.observe("video_keyframes", len(keyframes))
+    print(f"🎞️ Video: read {frames_read} frames, scored {frames_scored}, selected {len(keyframes)} keyframes")
+
+    return [k[2] for k in keyframes], stats
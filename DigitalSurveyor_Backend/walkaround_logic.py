@@ -0,0 +1,101 @@
+# walkaround_logic.py
+"""
+Cross-image damage merging for multi-angle walkaround scans.
+The same dent photographed from several angles must only be priced once,
+so damages from all images are merged by part, type and their position
+relative to the part they sit on. Parts are compared by their raw,
+side-aware detector label (front vs rear bumper, left vs right door): the
+priced part name collapses those, and merging across them would drop a
+real damage.
+"""
+
+import numpy as np
+
+# Max distance between damage centers, in part-relative units (0-1),
+# for two detections from different images to count as the same damage
+MERGE_DISTANCE = 0.2
+
+
+def relative_position(damage: dict):
+    """
+    Center of a damage box relative to its part box (0-1 on each axis).
+    Returns None when the part box is unknown (no reliable cross-image anchor).
+    """
+    part_box = damage.get("_part_box")
+    if not part_box:
+        return None
+
+    px1, py1, px2, py2 = part_box
+    part_w, part_h = px2 - px1, py2 - py1
+    if part_w <= 0 or part_h <= 0:
+        return None
+
+    x1, y1, x2, y2 = damage["box"]
+    return (
+        float(np.clip(((x1 + x2) / 2 - px1) / part_w, 0.0, 1.0)),
+        float(np.clip(((y1 + y2) / 2 - py1) / part_h, 0.0, 1.0)),
+    )
+
+
+def merge_walkaround_damages(per_image_damages: list, merge_distance: float = MERGE_DISTANCE) -> dict:
+    """
+    Merge damages detected across several photos of one vehicle.
+
+    Args:
+        per_image_damages: One damages list (process_damage output) per image
+        merge_distance: Max part-relative center distance for a match
+
+    Returns:
+        {
+            "damages": [...],        # one entry per physical damage, with
+                                     # "image_index" and "views" (all image indices)
+            "total_estimate": float,
+            "duplicates_merged": int
+        }
+    """
+    candidates = []
+    for image_idx, damages in enumerate(per_image_damages):
+        for damage in damages:
+            candidates.append((image_idx, damage, relative_position(damage)))
+
+    # Most severe view first, so it becomes the representative of its group
+    candidates.sort(key=lambda c: c[1].get("severity", 0), reverse=True)
+
+    groups = []
+    for image_idx, damage, position in candidates:
+        match = None
+        if position is not None:
+            for group in groups:
+                if group["position"] is None or image_idx in group["views"]:
+                    continue  # Two detections in the same photo are distinct damages
+                if (group["damage"]["part"] != damage["part"] or group["damage"]["type"] != damage["type"]
+                        or group["damage"].get("_part_label") != damage.get("_part_label")):
+                    continue
+                distance = np.hypot(group["position"][0] - position[0], group["position"][1] - position[1])
+                if distance < merge_distance:
+                    match = group
+                    break
+
+        if match:
+            match["views"].append(image_idx)
+        else:
+            groups.append({"damage": damage, "image_index": image_idx,
+                           "position": position, "views": [image_idx]})
+
+    merged = []
+    total_cost = 0
+    for group in groups:
+        damage = group["damage"]
+        damage["image_index"] = group["image_index"]
+        damage["views"] = sorted(group["views"])
+        total_cost += damage.get("cost", 0)
+        merged.append(damage)
+
+    duplicates = len(candidates) - len(merged)
+    print(f"🔗 Walkaround merge: {len(candidates)} detections → {len(merged)} damages ({duplicates} duplicates)")
+
+    return {
+        "damages": merged,
+        "total_estimate": round(total_cost, 2),
+        "duplicates_merged": duplicates
+    }
@@ -0,0 +1,40 @@
+// src/components/AuthImage.jsx
+import React, { useState, useEffect } from 'react';
+import { authHeaders } from '../supabase';
+
+// Scan overlays are served only to the scan's owner, so they are fetched with
+// the session token and shown from a blob URL; other images load directly.
+const OVERLAY_PATH = /\/scans\/[^/]+\/overlay\//;
+
+export default function AuthImage({ src, ...props }) {
+    const [objectUrl, setObjectUrl] = useState(null);
+    const needsAuth = Boolean(src) && OVERLAY_PATH.test(src);
+
+    useEffect(() => {
+        if (!needsAuth) return;
+        let url = null;
+        let cancelled = false;
+
+        (async () => {
+            try {
+                const response = await fetch(src, { headers: await authHeaders() });
+                if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                const blob = await response.blob();
+                if (cancelled) return;
+                url = URL.createObjectURL(blob);
+                setObjectUrl(url);
+            } catch (error) {
+                console.error('Error loading image:', error);
+            }
+        })();
+
+        return () => {
+            cancelled = true;
+            if (url) URL.revokeObjectURL(url);
+            setObjectUrl(null);
+        };
+    }, [src, needsAuth]);
+
+    if (needsAuth && !objectUrl) return null;
+    return <img src={needsAuth ? objectUrl : src} {...props} />;
+}
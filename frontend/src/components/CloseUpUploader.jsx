@@ -1,6 +1,7 @@
 import React, { useState } from 'react';
 import { Upload, X, Camera, Check, AlertCircle } from 'lucide-react';
 import config from '../config';
+import { authHeaders } from '../supabase';
 
 export default function CloseUpUploader({ damage, onVerify, onClose }) {
     const [photos, setPhotos] = useState({
@@ -76,6 +77,7 @@ export default function CloseUpUploader({ damage, onVerify, onClose }) {
 
             const response = await fetch(`${config.API_BASE_URL}/analyze/refine`, {
                 method: 'POST',
+                headers: await authHeaders(),
                 body: formData
             });
 
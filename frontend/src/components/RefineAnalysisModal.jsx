@@ -1,6 +1,7 @@
 // RefineAnalysisModal.jsx
 import React, { useState } from 'react';
 import { X, Upload, Camera } from 'lucide-react';
+import { authHeaders } from '../supabase';
 
 export function RefineAnalysisModal({ damage, onClose, onRefineComplete }) {
     const [files, setFiles] = useState({ left: null, center: null, right: null });
@@ -42,6 +43,7 @@ export function RefineAnalysisModal({ damage, onClose, onRefineComplete }) {
 
             const response = await fetch('http://127.0.0.1:8000/analyze/refine', {
                 method: 'POST',
+                headers: await authHeaders(),
                 body: formData
             });
 
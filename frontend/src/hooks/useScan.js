@@ -1,6 +1,7 @@
 // src/hooks/useScan.js
 import { useState } from 'react';
 import axios from 'axios';
+import { authHeaders } from '../supabase';
 
 const BACKEND_URL = 'http://127.0.0.1:8000';
 
@@ -23,6 +24,7 @@ export const useScan = () => {
             const response = await axios.post(`${BACKEND_URL}/analyze`, formData, {
                 headers: {
                     'Content-Type': 'multipart/form-data',
+                    ...(await authHeaders()),
                 },
                 onUploadProgress: (progressEvent) => {
                     const percentCompleted = Math.round(
@@ -1,11 +1,12 @@
 // src/pages/AnalysisResult.jsx
 import React, { useState, useEffect } from 'react';
 import { useParams, useNavigate, useLocation } from 'react-router-dom';
-import { supabase } from '../supabase';
+import { supabase, authHeaders } from '../supabase';
 import { Download, ArrowLeft, Loader2, DollarSign, Camera, Plus, Trash2, Image, Zap, Activity, AlertCircle, CheckCircle } from 'lucide-react';
 import { motion } from 'framer-motion';
 import { RefineAnalysisModal } from '../components/RefineAnalysisModal';
 import ManualDamageMarker from '../components/ManualDamageMarker';
+import AuthImage from '../components/AuthImage';
 
 export default function AnalysisResult() {
     const { id } = useParams();
@@ -48,7 +49,7 @@ export default function AnalysisResult() {
         }
     };
 
-    const loadDamages = async () => {
+    const loadDamages = async (retriesLeft = 5) => {
         try {
             console.log('Loading damages for scan:', id);
             // Load damages from database (source of truth)
@@ -57,6 +58,15 @@ export default function AnalysisResult() {
                 .select('*')
                 .eq('scan_id', id);
 
+            // Fresh scans are written to the database in the background:
+            // poll briefly until the rows land
+            const queuedScan = location.state?.scanData;
+            if (!error && !data?.length && retriesLeft > 0
+                && queuedScan?.persistence === 'queued' && queuedScan.damages?.length) {
+                setTimeout(() => loadDamages(retriesLeft - 1), 1000);
+                return;
+            }
+
             if (error) {
                 console.error('Error loading damages:', error);
                 setDamages([]);
@@ -72,6 +82,23 @@ export default function AnalysisResult() {
         }
     };
 
+    // The report is served only to the scan's owner, so it is fetched with the session token
+    const handleDownloadReport = async (url) => {
+        try {
+            const response = await fetch(url, { headers: await authHeaders() });
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const blobUrl = URL.createObjectURL(await response.blob());
+            const link = document.createElement('a');
+            link.href = blobUrl;
+            link.download = `damage_report_${id.slice(0, 8)}.pdf`;
+            link.click();
+            setTimeout(() => URL.revokeObjectURL(blobUrl), 60000);
+        } catch (err) {
+            console.error('Error downloading report:', err);
+            alert('Could not download the report. Please try again.');
+        }
+    };
+
     const handleRefine = (damage) => {
         setSelectedDamage(damage);
         setShowRefineModal(true);
@@ -264,15 +291,13 @@ export default function AnalysisResult() {
                     </div>
 
                     {scanData.pdf_url && (
-                        <a
-                            href={scanData.pdf_url}
-                            target="_blank"
-                            rel="noopener noreferrer"
+                        <button
+                            onClick={() => handleDownloadReport(scanData.pdf_url)}
                             className="flex items-center gap-2 px-6 py-3 bg-white/10 backdrop-blur-lg border border-white/20 text-white rounded-lg hover:bg-white/20 hover:shadow-[0_0_30px_rgba(255,255,255,0.2)] transition-all font-semibold"
                         >
                             <Download size={20} />
                             Download PDF Report
-                        </a>
+                        </button>
                     )}
                 </motion.div>
 
@@ -291,7 +316,7 @@ export default function AnalysisResult() {
                         </div>
                         {scanData.original_image_url && (
                             <img
-                                src={scanData.original_image_url}
+                                src={scanData.image_variants?.original?.web || scanData.original_image_url}
                                 alt="Original"
                                 className="w-full h-64 object-cover"
                             />
@@ -305,8 +330,8 @@ export default function AnalysisResult() {
                             <h3 className="font-semibold">AI Detections</h3>
                         </div>
                         {scanData.processed_image_url && (
-                            <img
-                                src={scanData.processed_image_url}
+                            <AuthImage
+                                src={scanData.image_variants?.processed?.web || scanData.processed_image_url}
                                 alt="Detections"
                                 className="w-full h-64 object-cover"
                             />
@@ -320,8 +345,8 @@ export default function AnalysisResult() {
                             <h3 className="font-semibold">Heatmap</h3>
                         </div>
                         {scanData.heatmap_image_url && (
-                            <img
-                                src={scanData.heatmap_image_url}
+                            <AuthImage
+                                src={scanData.image_variants?.heatmap?.web || scanData.heatmap_image_url}
                                 alt="Heatmap"
                                 className="w-full h-64 object-cover"
                             />
@@ -496,14 +521,13 @@ export default function AnalysisResult() {
                                 {damages.length} damage{damages.length !== 1 ? 's' : ''} detected
                             </div>
                             {scanData.report_pdf_url && (
-                                <a
-                                    href={scanData.report_pdf_url}
-                                    download
+                                <button
+                                    onClick={() => handleDownloadReport(scanData.report_pdf_url)}
                                     className="inline-flex items-center gap-2 bg-white/10 backdrop-blur-lg border border-white/20 text-white px-6 py-3 rounded-lg font-semibold hover:bg-white/20 hover:shadow-[0_0_30px_rgba(255,255,255,0.2)] transition-all"
                                 >
                                     <Download size={20} />
                                     Download PDF Report
-                                </a>
+                                </button>
                             )}
                         </div>
                     </div>
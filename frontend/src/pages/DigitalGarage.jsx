@@ -2,13 +2,17 @@
 import React, { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { useAuth } from '../hooks/useAuth';
-import { supabase } from '../supabase';
+import config from '../config';
+import { authHeaders } from '../supabase';
+import AuthImage from '../components/AuthImage';
 import { Plus, Car, Loader2, LogOut, Calendar, DollarSign } from 'lucide-react';
 import { motion } from 'framer-motion';
 
 export default function DigitalGarage() {
     const [scans, setScans] = useState([]);
     const [loading, setLoading] = useState(true);
+    const [nextCursor, setNextCursor] = useState(null);
+    const [loadingMore, setLoadingMore] = useState(false);
     const { user, signOut } = useAuth();
     const navigate = useNavigate();
 
@@ -16,19 +20,26 @@ export default function DigitalGarage() {
         loadScans();
     }, [user]);
 
+    // Scan summaries come from the backend, one keyset page at a time
+    const fetchScanPage = async (cursor) => {
+        const params = new URLSearchParams({ limit: '24' });
+        if (cursor) params.set('cursor', cursor);
+
+        const response = await fetch(`${config.API_BASE_URL}/scans?${params}`, {
+            headers: await authHeaders(),
+        });
+        if (!response.ok) throw new Error(`Failed to load scans (${response.status})`);
+        return await response.json();
+    };
+
     const loadScans = async () => {
         if (!user) return;
 
         try {
             setLoading(true);
-            const { data, error } = await supabase
-                .from('scans')
-                .select('*')
-                .eq('user_id', user.id)
-                .order('created_at', { ascending: false });
-
-            if (error) throw error;
-            setScans(data || []);
+            const page = await fetchScanPage(null);
+            setScans(page.scans || []);
+            setNextCursor(page.next_cursor);
         } catch (err) {
             console.error('Error loading scans:', err);
         } finally {
@@ -36,6 +47,21 @@ export default function DigitalGarage() {
         }
     };
 
+    const loadMoreScans = async () => {
+        if (!nextCursor || loadingMore) return;
+
+        try {
+            setLoadingMore(true);
+            const page = await fetchScanPage(nextCursor);
+            setScans((prev) => [...prev, ...(page.scans || [])]);
+            setNextCursor(page.next_cursor);
+        } catch (err) {
+            console.error('Error loading more scans:', err);
+        } finally {
+            setLoadingMore(false);
+        }
+    };
+
     return (
         <div className="min-h-screen bg-black">
             {/* Navbar */}
@@ -100,9 +126,10 @@ export default function DigitalGarage() {
                                 className="bg-white/10 backdrop-blur-lg border border-white/20 rounded-xl overflow-hidden hover:bg-white/15 hover:shadow-[0_0_30px_rgba(255,255,255,0.1)] transition-all cursor-pointer"
                             >
                                 {scan.processed_image_url && (
-                                    <img
-                                        src={scan.processed_image_url}
+                                    <AuthImage
+                                        src={scan.image_variants?.processed?.thumb || scan.processed_image_url}
                                         alt={scan.car_name}
+                                        loading="lazy"
                                         className="w-full h-48 object-cover"
                                     />
                                 )}
@@ -146,6 +173,20 @@ export default function DigitalGarage() {
                     </motion.div>
                 )}
 
+                {/* Load More */}
+                {!loading && nextCursor && (
+                    <div className="flex justify-center mt-8">
+                        <button
+                            onClick={loadMoreScans}
+                            disabled={loadingMore}
+                            className="bg-white/10 backdrop-blur-lg border border-white/20 text-white px-6 py-3 rounded-lg font-semibold hover:bg-white/20 flex items-center gap-2 transition-all duration-300 disabled:opacity-50"
+                        >
+                            {loadingMore && <Loader2 className="animate-spin" size={20} />}
+                            Load More
+                        </button>
+                    </div>
+                )}
+
                 {/* Empty State */}
                 {!loading && scans.length === 0 && (
                     <motion.div
@@ -1,6 +1,7 @@
 // API helper functions for damage management
 
 import config from '../config';
+import { authHeaders } from '../supabase';
 
 const API_BASE_URL = config.API_BASE_URL;
 
@@ -18,6 +19,7 @@ export async function verifyDamageWithAI(damageId, partName, damageType, photos)
 
     const response = await fetch(`${API_BASE_URL}/analyze/refine`, {
         method: 'POST',
+        headers: await authHeaders(),
         body: formData
     });
 